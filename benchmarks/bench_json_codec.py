@@ -0,0 +1,62 @@
+"""Times the JSON codec layer on the raw API test fixtures, scaled up.
+
+Reports the time spent decoding pages of API data and filling the `*_obj` columns with stdlib
+json and the historical repr (before) against orjson (after).
+
+    python benchmarks/bench_json_codec.py --rows 200000
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+file_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(1, f'{file_dir}/../orchestration/dag')
+from json_codec import dumps, loads
+import json_codec
+
+
+def scaled_pages(api_type, num_rows, page_size):
+    """Returns the fixture's records repeated to `num_rows`, as encoded pages of `page_size`."""
+    with open(f'{file_dir}/../tests/inputs/response_{api_type}.json') as f:
+        fixture = json.load(f)
+    records = [dict(fixture[i % len(fixture)], _id=f"{fixture[i % len(fixture)]['_id']}-{i}")
+               for i in range(num_rows)]
+    return [json.dumps({"data": records[i:i + page_size], "next_page_uri": None}).encode("utf-8")
+            for i in range(0, num_rows, page_size)]
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--page-size", type=int, default=100)
+    args = parser.parse_args()
+
+    if json_codec.orjson is None:
+        sys.exit("orjson is not installed, both columns would time the stdlib.")
+    for api_type in ("messages", "conversations"):
+        pages = scaled_pages(api_type, args.rows, args.page_size)
+        print(f"{api_type}: {args.rows} rows in {len(pages)} pages")
+
+        records, stdlib_decode = timed(lambda: [record for page in pages
+                                                for record in json.loads(page)["data"]])
+        _, orjson_decode = timed(lambda: [record for page in pages
+                                          for record in loads(page)["data"]])
+        _, repr_obj = timed(lambda: [str(record) for record in records])
+        _, json_obj = timed(lambda: [json.dumps(record) for record in records])
+        _, orjson_obj = timed(lambda: [dumps(record) for record in records])
+
+        print(f"  decode pages   json {stdlib_decode:6.2f} s  orjson {orjson_decode:6.2f} s")
+        print(f"  *_obj column   repr {repr_obj:6.2f} s  json   {json_obj:6.2f} s  "
+              f"orjson {orjson_obj:6.2f} s")
+
+
+if __name__ == "__main__":
+    main()
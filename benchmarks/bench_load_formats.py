@@ -0,0 +1,98 @@
+"""Compares the BigQuery load formats on the parsed test fixtures, scaled up.
+
+For each format the script reports the time spent encoding the spool file and the number of
+bytes that would be uploaded. With `--dataset`, it also runs the load jobs against scratch
+tables in that dataset and reports their wall-clock time, using application default
+credentials.
+
+    python benchmarks/bench_load_formats.py --rows 200000
+    python benchmarks/bench_load_formats.py --rows 200000 --dataset my-project.scratch
+"""
+import argparse
+import copy
+import json
+import os
+import sys
+import time
+
+file_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(1, f'{file_dir}/../orchestration/dag')
+from bq_loader import make_load_sink
+
+
+class Object():
+    pass
+
+
+# Records the size of the uploaded file instead of loading it.
+class SizingClient():
+    def __init__(self):
+        self.num_bytes = 0
+
+    def load_table_from_json(self, records, table_id, job_config):
+        self.num_bytes += len(json.dumps(records).encode("utf-8"))
+        return self._job()
+
+    def load_table_from_file(self, file_obj, table_id, job_config):
+        self.num_bytes += len(file_obj.read())
+        return self._job()
+
+    @staticmethod
+    def _job():
+        job = Object()
+        job.result = lambda: None
+        return job
+
+
+def scaled_records(table_type, num_rows):
+    with open(f'{file_dir}/../tests/outputs/response_{table_type}.json') as f:
+        fixture = json.load(f)
+    id_key = "message_id" if table_type == "messages" else "conversation_id"
+    records = []
+    for i in range(num_rows):
+        record = copy.deepcopy(fixture[i % len(fixture)])
+        record[id_key] = f"{record[id_key]}-{i}"
+        records.append(record)
+    return records
+
+
+def run(load_format, client, table_type, table_id, records, chunk_size):
+    start = time.perf_counter()
+    sink = make_load_sink(load_format, client, table_type, table_id)
+    for i in range(0, len(records), chunk_size):
+        sink.write(records[i:i + chunk_size])
+    sink.close()
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--chunk-size", type=int, default=10000)
+    parser.add_argument("--formats", default="json,ndjson,parquet,avro")
+    parser.add_argument("--dataset", help="project.dataset to run real load jobs into")
+    args = parser.parse_args()
+
+    bq_client = None
+    if args.dataset:
+        from google.cloud import bigquery
+        bq_client = bigquery.Client()
+    for table_type in ("messages", "conversations"):
+        records = scaled_records(table_type, args.rows)
+        print(f"{table_type}: {args.rows} rows")
+        for load_format in args.formats.split(","):
+            sizing_client = SizingClient()
+            encode_seconds = run(load_format, sizing_client, table_type, "sizing", records,
+                                 args.chunk_size)
+            line = (f"  {load_format:8} {sizing_client.num_bytes / 1e6:9.2f} MB uploaded "
+                    f"{encode_seconds:7.2f} s encode")
+            if bq_client is not None:
+                table_id = f"{args.dataset}.bench_{table_type}_{load_format}"
+                load_seconds = run(load_format, bq_client, table_type, table_id, records,
+                                   args.chunk_size)
+                line += f" {load_seconds:7.2f} s load"
+            print(line)
+
+
+if __name__ == "__main__":
+    main()
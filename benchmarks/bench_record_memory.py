@@ -0,0 +1,81 @@
+"""Compares the memory held by parsed rows as dicts and as slotted records, scaled up.
+
+Parses the raw API test fixtures repeated to `--rows` rows in each record format and reports,
+with tracemalloc, the bytes the parsed rows keep alive once the raw data is dropped, and the
+parse time. The `*_obj` columns are the same in both formats and are reported separately.
+
+    python benchmarks/bench_record_memory.py --rows 200000
+"""
+import argparse
+import copy
+import gc
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+file_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(1, f'{file_dir}/../orchestration/dag')
+from parse_ada_data import RECORD_FORMATS, parse_api_data
+
+
+# Leaves the text as it is instead of calling DLP.
+class NoDlpDeidentifier():
+    def enqueue(self, record, key):
+        pass
+
+    def allow(self, texts):
+        pass
+
+    def flush(self):
+        pass
+
+
+def scaled_records(api_type, num_rows):
+    with open(f'{file_dir}/../tests/inputs/response_{api_type}.json') as f:
+        fixture = json.load(f)
+    records = []
+    for i in range(num_rows):
+        record = copy.deepcopy(fixture[i % len(fixture)])
+        record["_id"] = f"{record['_id']}-{i}"
+        records.append(record)
+    return records
+
+
+def measure(api_type, num_rows, record_format):
+    """Returns the bytes held by the parsed rows, the bytes of their `*_obj` strings and the
+    parse time."""
+    records = scaled_records(api_type, num_rows)
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter()
+    parsed = parse_api_data(records, api_type, "placeholder_project_name", NoDlpDeidentifier(),
+                            record_format=record_format)
+    elapsed = time.perf_counter() - start
+    del records
+    gc.collect()
+    held = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    obj_column = "message_obj" if api_type == "messages" else "conversation_obj"
+    obj_bytes = sum(sys.getsizeof(row[obj_column]) for row in parsed)
+    return held, obj_bytes, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=100000)
+    args = parser.parse_args()
+
+    for api_type in ("messages", "conversations"):
+        print(f"{api_type}: {args.rows} rows")
+        for record_format in RECORD_FORMATS:
+            held, obj_bytes, elapsed = measure(api_type, args.rows, record_format)
+            print(f"  {record_format:5}  {held / 2 ** 20:7.1f} MiB held, "
+                  f"{(held - obj_bytes) / args.rows:6.0f} bytes/row without *_obj, "
+                  f"parse {elapsed:5.2f} s")
+
+
+if __name__ == "__main__":
+    main()
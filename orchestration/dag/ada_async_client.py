@@ -0,0 +1,189 @@
+import asyncio
+from concurrent.futures import Future, TimeoutError
+import logging as log
+import threading
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+from ada_client import (ADA_REQUESTS_PER_SECOND, DEFAULT_MAX_BUFFERED_PAGES, DEFAULT_TIMEOUT,
+                        QUEUE_POLL_INTERVAL, split_time_window, window_uri)
+from json_codec import loads
+from rate_limiter import retry_after_delay
+
+
+MAX_THROTTLED_ATTEMPTS = 8
+_STREAM_DONE = object()
+
+
+class AsyncRequestScheduler:
+    """
+    AsyncRequestScheduler(rate=ADA_REQUESTS_PER_SECOND)
+
+    Hands out one API key's request slots to every stream running in an event loop. Slots are
+    `1 / rate` seconds apart and granted first-come, first-served, so streams with a request
+    waiting split the budget evenly, and a stream gets the whole budget once the others finish.
+
+    Parameters
+    ----------
+    rate : float
+        The number of requests per second allowed for the key.
+    """
+
+    def __init__(self, rate=ADA_REQUESTS_PER_SECOND):
+        self.interval = 1 / rate
+        self.throttle_events = 0
+        self._next_slot = 0
+        self._lock = None
+
+    async def acquire(self):
+        """Waits for the next request slot and returns its time on the event loop's clock."""
+        # Created lazily so that the lock belongs to the running event loop.
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            now = asyncio.get_event_loop().time()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + self.interval
+        await asyncio.sleep(slot - now)
+        return slot
+
+    def throttle(self, delay):
+        """Pushes every later slot back after a 429, by at least one interval."""
+        self.throttle_events += 1
+        now = asyncio.get_event_loop().time()
+        self._next_slot = max(self._next_slot, now + max(delay or 0, self.interval))
+        log.warning("Throttled by the API (%d events), pausing %.1f seconds.",
+                    self.throttle_events, self._next_slot - now)
+
+
+async def _fetch_stream(session, scheduler, endpoint_url, uri, timeout, page_queue):
+    # Puts each page of the stream on its queue, then _STREAM_DONE, or the error that ended it.
+    try:
+        num_throttled = 0
+        while uri:
+            await scheduler.acquire()
+            log.info("Fetching data. URI: %s.", uri)
+            async with session.get(endpoint_url + uri,
+                                   timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+                if response.status == 429 and num_throttled < MAX_THROTTLED_ATTEMPTS:
+                    num_throttled += 1
+                    scheduler.throttle(retry_after_delay(response.headers))
+                    continue
+                if response.status != 200:
+                    log.error(await response.text())
+                    raise ValueError(f'Error response received: {response.status}.')
+                payload = loads(await response.read())
+            num_throttled = 0
+            await page_queue.put(payload["data"])
+            uri = payload["next_page_uri"]
+        await page_queue.put(_STREAM_DONE)
+    except asyncio.CancelledError:
+        # An Exception before Python 3.8, and cancelling means the pages are no longer wanted.
+        raise
+    except Exception as err:
+        await page_queue.put(err)
+
+
+async def _fetch_all(endpoint_url, api_key, uris, rate, timeout, max_buffered_pages,
+                     queues_future):
+    scheduler = AsyncRequestScheduler(rate)
+    # The queues are created here so that they belong to the running event loop.
+    page_queues = [asyncio.Queue(maxsize=max_buffered_pages) for _ in uris]
+    queues_future.set_result(page_queues)
+    headers = {"Authorization": f"Bearer {api_key}", "Accept-Encoding": "gzip"}
+    async with aiohttp.ClientSession(headers=headers) as session:
+        await asyncio.gather(*(
+            _fetch_stream(session, scheduler, endpoint_url, uri, timeout, page_queue)
+            for uri, page_queue in zip(uris, page_queues)))
+    log.info("%d throttle events.", scheduler.throttle_events)
+
+
+def iter_pages_async(endpoint_url, api_key, api_types, start_time, end_time, num_windows=1,
+                     rate=ADA_REQUESTS_PER_SECOND, timeout=DEFAULT_TIMEOUT,
+                     max_buffered_pages=DEFAULT_MAX_BUFFERED_PAGES):
+    """
+    iter_pages_async(endpoint_url, api_key, api_types, start_time, end_time, num_windows=1,
+                     rate=ADA_REQUESTS_PER_SECOND, timeout=DEFAULT_TIMEOUT,
+                     max_buffered_pages=DEFAULT_MAX_BUFFERED_PAGES)
+
+    Fetches several endpoints concurrently in an event loop on a background thread, under a
+    single scheduler that divides one API key's request budget between them. Pages are yielded
+    by endpoint, then by sub-window, as they are consumed. A stream ahead of the one being
+    consumed stops requesting pages once it holds `max_buffered_pages`, which leaves its slots
+    to the others, so memory is bounded by the number of streams, not the size of the day.
+
+    Parameters
+    ----------
+    endpoint_url : str
+        The base url of the API.
+    api_key : str
+        The Data API key whose budget is shared.
+    api_types : list of str
+        The endpoints to fetch, e.g. `["messages", "conversations"]`.
+    start_time : datetime
+        The start of the range queried.
+    end_time : datetime
+        The end of the range queried.
+    num_windows : int
+        Each endpoint's range is split into this many sub-windows, which are paged through
+        concurrently.
+    rate : float
+        The number of requests per second allowed for the key.
+    timeout : float
+        The timeout of a single request, in seconds.
+    max_buffered_pages : int
+        The number of fetched pages each stream may hold before they are consumed.
+
+    Yields
+    ------
+    tuple of str and list of dicts
+        The api type and the `data` of each page. Repeated records are left to
+        `dedup_index.dedup_pages`.
+    """
+
+    if aiohttp is None:
+        raise ImportError("The async fetch engine requires the aiohttp package.")
+    windows = split_time_window(start_time, end_time, num_windows)
+    streams = [(api_type, window_uri(api_type, *window))
+               for api_type in api_types
+               for window in windows]
+    # asyncio.run() needs Python >= 3.7, so the loop is managed by hand. It keeps running after
+    # the streams finish, until the pages they buffered are consumed.
+    loop = asyncio.new_event_loop()
+    queues_future = Future()
+    task = loop.create_task(_fetch_all(endpoint_url, api_key, [uri for _, uri in streams], rate,
+                                       timeout, max_buffered_pages, queues_future))
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    try:
+        page_queues = queues_future.result()
+        for (api_type, _), page_queue in zip(streams, page_queues):
+            while True:
+                item = _next_item(loop, task, page_queue)
+                if item is _STREAM_DONE:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield api_type, item
+    finally:
+        loop.call_soon_threadsafe(task.cancel)
+        asyncio.run_coroutine_threadsafe(asyncio.wait([task]), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
+
+
+def _next_item(loop, task, page_queue):
+    # Polls, so that an error outside the streams, e.g. opening the session, is not waited on
+    # forever.
+    item_future = asyncio.run_coroutine_threadsafe(page_queue.get(), loop)
+    while True:
+        try:
+            return item_future.result(timeout=QUEUE_POLL_INTERVAL)
+        except TimeoutError:
+            if task.done() and not task.cancelled() and task.exception() is not None:
+                item_future.cancel()
+                raise task.exception()
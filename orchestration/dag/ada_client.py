@@ -0,0 +1,359 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+import logging as log
+import queue
+import threading
+
+import requests as r
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+from json_codec import loads
+from rate_limiter import get_shared_controller
+
+
+# The Ada Data API accepts 1 request per API key per second.
+ADA_REQUESTS_PER_SECOND = 1
+DEFAULT_POOL_SIZE = 4
+DEFAULT_TIMEOUT = 60
+# Pages per sub-window fetched ahead of the consumer, see `fetch_windows`.
+DEFAULT_MAX_BUFFERED_PAGES = 4
+QUEUE_POLL_INTERVAL = 0.1
+_WINDOW_DONE = object()
+
+
+def convert_to_iso_string(datetime_obj):
+    """
+    convert_to_iso_string(datetime_obj)
+
+    Converts a DateTime object into iso format.
+
+    Parameters
+    ----------
+    datetime_obj : datetime
+
+    Returns
+    -------
+    str
+        A string in iso format: "%Y-%m-%dT%H:%M:%S.%f"
+
+    Notes
+    -----
+    In Python>==3.7, the datetime library has the function datetime.isoformat(), which converts a
+    datetime into a string in ISO compliant format. Since our cloud composer instance uses Python
+    3.6, I wrote this custom function that parses a DateTime into iso format.
+    """
+
+    # TODO: When Airflow uses Python >==3.7, replace with datetime.isoformat()
+    iso_format = "%Y-%m-%dT%H:%M:%S.%f"
+    return datetime_obj.strftime(iso_format)
+
+
+def flatten_2d_array(arr):
+    """
+    flatten_2d_array(arr)
+
+    Flattens a 2d array of object into a 1d array.
+
+    Parameters
+    ----------
+    arr : list of list of objects
+        A 2-dimensional array containing any objects.
+
+    Returns
+    -------
+    list of objects
+        The flattened list of objects.
+    """
+
+    return [datapoint for row in arr for datapoint in row]
+
+
+def window_uri(api_type, start_time, end_time):
+    """Returns the uri of the first page of `api_type` records created in a time window."""
+    # TODO: Once Airflow is updated to Python >==3.7, replace with start_time.isoformat()
+    str_start_time = convert_to_iso_string(start_time).replace(":", "%3A")
+    str_end_time = convert_to_iso_string(end_time).replace(":", "%3A")
+    return f"/data_api/v1/{api_type}?created_since={str_start_time}&created_to={str_end_time}"
+
+
+def split_time_window(start_time, end_time, num_windows):
+    """
+    split_time_window(start_time, end_time, num_windows)
+
+    Splits an inclusive time window into consecutive, non-overlapping inclusive sub-windows.
+
+    Parameters
+    ----------
+    start_time : datetime
+    end_time : datetime
+    num_windows : int
+
+    Returns
+    -------
+    list of tuples of datetime
+        The `(start_time, end_time)` of each sub-window, in order. Each one ends a microsecond
+        before the next one starts, and the last one ends at `end_time`.
+    """
+
+    step = (end_time - start_time) / num_windows
+    starts = [start_time + step * i for i in range(num_windows)]
+    ends = [next_start - timedelta(microseconds=1) for next_start in starts[1:]] + [end_time]
+    return list(zip(starts, ends))
+
+
+def fetch_windows(clients, api_type, start_time, end_time, num_windows, checkpoints=None,
+                  max_buffered_pages=DEFAULT_MAX_BUFFERED_PAGES):
+    """
+    fetch_windows(clients, api_type, start_time, end_time, num_windows, checkpoints=None,
+                  max_buffered_pages=DEFAULT_MAX_BUFFERED_PAGES)
+
+    Splits a time window into sub-windows and fetches them concurrently, spreading them over a
+    pool of clients. Each client uses its own API key's rate budget. Pages are yielded in the
+    order they are fetched, whichever sub-window they belong to, since the load does not depend
+    on it. The sub-windows share a queue of `num_windows * max_buffered_pages` pages and stop
+    fetching while it is full, so at most `num_windows * (max_buffered_pages + 1)` pages are in
+    memory, whatever the size of the day.
+
+    Parameters
+    ----------
+    clients : list of AdaClient
+        One client per API key.
+    api_type : str
+        Either `conversations` or `messages`.
+    start_time : datetime
+    end_time : datetime
+    num_windows : int
+        The number of sub-windows.
+    checkpoints : list of fetch_checkpoint.PageCheckpoint, optional
+        One checkpoint per sub-window, in order, that its pages are saved to and resumed from.
+    max_buffered_pages : int
+        The number of fetched pages per sub-window the shared queue holds before they are
+        consumed.
+
+    Yields
+    ------
+    list of dicts
+        The `data` of each page. Repeated records are left to `dedup_index.dedup_pages`.
+
+    Raises
+    ------
+    ValueError
+        If a page of any sub-window gets a response other than 200.
+    """
+
+    windows = split_time_window(start_time, end_time, num_windows)
+    checkpoints = checkpoints or [None] * num_windows
+    page_queue = queue.Queue(maxsize=num_windows * max_buffered_pages)
+    stopped = threading.Event()
+
+    def put(item):
+        # Gives up once the consumer has stopped, so a blocked sub-window cannot hang.
+        while not stopped.is_set():
+            try:
+                page_queue.put(item, timeout=QUEUE_POLL_INTERVAL)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def fetch(i):
+        try:
+            client = clients[i % len(clients)]
+            for page in client.iter_pages(window_uri(api_type, *windows[i]), checkpoints[i]):
+                if not put(page):
+                    return
+            put(_WINDOW_DONE)
+        except Exception as err:
+            put(err)
+
+    executor = ThreadPoolExecutor(max_workers=num_windows)
+    for i in range(num_windows):
+        executor.submit(fetch, i)
+    num_records = 0
+    num_done = 0
+    try:
+        while num_done < num_windows:
+            item = page_queue.get()
+            if item is _WINDOW_DONE:
+                num_done += 1
+                continue
+            if isinstance(item, Exception):
+                raise item
+            num_records += len(item)
+            yield item
+    finally:
+        stopped.set()
+        executor.shutdown()
+    log.info("Fetched %d %s records in %d windows with %d API keys.", num_records, api_type,
+             num_windows, len(clients))
+
+
+class AdaClient:
+    """
+    AdaClient(endpoint_url, api_key, rate_controller=None, pool_size=DEFAULT_POOL_SIZE,
+              timeout=DEFAULT_TIMEOUT)
+
+    A client for the Ada Data API that owns one long-lived `requests.Session`. Connections are
+    kept alive in a sized pool, so pages after the first skip the TCP and TLS handshakes, and
+    the bearer token and gzip `Accept-Encoding` are set once on the session.
+
+    Parameters
+    ----------
+    endpoint_url : str
+        The base url of the API, e.g. `https://loblaws-og.ada.support/api`.
+    api_key : str
+        The Data API key.
+    rate_controller : rate_limiter.AdaptiveRateController, optional
+        Paces the requests and retries throttled ones. Defaults to the controller shared by every
+        client in this process that uses the same API key.
+    pool_size : int
+        The maximum number of connections kept open, i.e. of requests in flight at once.
+    timeout : float
+        The timeout of a single request, in seconds.
+    """
+
+    def __init__(self, endpoint_url, api_key, rate_controller=None, pool_size=DEFAULT_POOL_SIZE,
+                 timeout=DEFAULT_TIMEOUT):
+        self.endpoint_url = endpoint_url
+        self.timeout = timeout
+        self.rate_controller = rate_controller or get_shared_controller(api_key,
+                                                                        ADA_REQUESTS_PER_SECOND)
+        # 429s are left to the rate controller, which slows down instead of just waiting.
+        retry_strategy = Retry(
+            total=5,
+            status_forcelist=[500, 502, 503, 504],
+            backoff_factor=2,
+        )
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size,
+                              max_retries=retry_strategy)
+        self.session = r.Session()
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update({
+            "Authorization": f"Bearer {api_key}",
+            "Accept-Encoding": "gzip",
+            "Connection": "keep-alive",
+        })
+
+    def get(self, uri):
+        """
+        get(uri)
+
+        Queries the chat source API.
+
+        Parameters
+        ----------
+        uri : str
+            The path and query string of the request, relative to the endpoint url.
+
+        Returns
+        -------
+        requests.Response
+            The response from the api request.
+        """
+
+        url = self.endpoint_url + uri
+        return self.rate_controller.call(lambda: self.session.get(url, timeout=self.timeout))
+
+    def iter_pages(self, uri, checkpoint=None):
+        """
+        iter_pages(uri, checkpoint=None)
+
+        Follows `next_page_uri` from a first page until the last one.
+
+        Parameters
+        ----------
+        uri : str
+            The path and query string of the first page.
+        checkpoint : fetch_checkpoint.PageCheckpoint, optional
+            Pages saved by an earlier attempt are yielded from it first, and fetching resumes
+            after them. Every fetched page is saved to it before being yielded.
+
+        Yields
+        ------
+        list of dicts
+            The `data` of each page, in order.
+
+        Raises
+        ------
+        ValueError
+            If a page gets a response other than 200.
+        """
+
+        if checkpoint is not None:
+            yield from checkpoint.stored_pages()
+            uri = checkpoint.resume_uri(uri)
+        while uri:
+            log.info("Fetching data. URI: %s.", uri)
+            response = self.get(uri)
+            if response.status_code != 200:
+                log.error(response.text)
+                raise ValueError(f'Error response received: {response.status_code}.')
+            payload = loads(response.content)
+            if checkpoint is not None:
+                checkpoint.save_page(payload["data"], payload["next_page_uri"])
+            yield payload["data"]
+            uri = payload["next_page_uri"]
+
+    def fetch_window(self, api_type, start_time, end_time, checkpoint=None):
+        """
+        fetch_window(api_type, start_time, end_time, checkpoint=None)
+
+        Gets all `api_type` records created between two given times.
+
+        Parameters
+        ----------
+        api_type : str
+            Either `conversations` or `messages`.
+        start_time : datetime
+            The start of the range queried.
+        end_time : datetime
+            The end of the range queried.
+        checkpoint : fetch_checkpoint.PageCheckpoint, optional
+            Saves the pages as they are fetched, and resumes from the pages already saved.
+
+        Returns
+        -------
+        list of dicts
+            A list containing all of the data in the datetime range queried.
+        """
+
+        log.info("Time slice: %s to %s", start_time, end_time)
+        valid_response_data = list(self.iter_pages(window_uri(api_type, start_time, end_time),
+                                                   checkpoint))
+        log.info("Done fetching this interval's API data. %s pages requested.",
+                 len(valid_response_data))
+        log.info("Request rate %.2f req/s after %d throttle events.",
+                 self.rate_controller.rate, self.rate_controller.throttle_events)
+        return flatten_2d_array(valid_response_data)
+
+    def close(self):
+        self.session.close()
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_ada_client(endpoint_url, api_key):
+    """
+    get_ada_client(endpoint_url, api_key)
+
+    Returns the AdaClient shared by every fetch in this process for an endpoint and API key,
+    creating it on first use.
+
+    Parameters
+    ----------
+    endpoint_url : str
+    api_key : str
+
+    Returns
+    -------
+    AdaClient
+    """
+
+    with _clients_lock:
+        if (endpoint_url, api_key) not in _clients:
+            _clients[(endpoint_url, api_key)] = AdaClient(endpoint_url, api_key)
+        return _clients[(endpoint_url, api_key)]
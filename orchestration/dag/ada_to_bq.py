@@ -1,28 +1,22 @@
 from datetime import datetime
 from datetime import timedelta
+from itertools import groupby
 import json
 import logging as log
+from operator import itemgetter
 import sys
-import time
-import os
 
 from airflow import models
 from airflow.operators.python_operator import PythonOperator
 from airflow.utils import dates
-from google.cloud import bigquery
-from google.api_core.exceptions import BadRequest
 
-import requests as r
-from requests.adapters import HTTPAdapter
-from requests.packages.urllib3.util.retry import Retry
+from dag_config import CONFIG_VARIABLE, get_dag_config
 
-from parse_ada_data import parse_api_data
+# The scheduler parses this file over and over, so at parse time only the cached config is
+# read. The clients, parsers and secrets are imported and read inside the task callables.
+conf = get_dag_config(models.Variable.get)
 
-from commons.vault import Vault
-
-
-conf = json.loads(models.Variable.get("ada_data_etl_config"))
-conf.update({"ada_api_key": (models.Variable.get("ada_api_key", None))})
+API_TYPES = ("messages", "conversations")
 
 default_dag_args = {
     "depends_on_past": False,
@@ -34,6 +28,20 @@ default_dag_args = {
 }
 
 
+def load_run_config():
+    """
+    load_run_config()
+
+    Refreshes `conf` from the Variables when a task starts, including the API keys, which are
+    only read at run time.
+    """
+
+    conf.update(json.loads(models.Variable.get(CONFIG_VARIABLE)))
+    conf.update({"ada_api_key": (models.Variable.get("ada_api_key", None))})
+    # Optional pool of extra keys for time-sliced fetching, each with its own rate budget.
+    conf.update({"ada_api_keys": json.loads(models.Variable.get("ada_api_keys", "[]"))})
+
+
 def parse_iso_string(date_time_str):
     """
     parse_iso_string(date_time_str)
@@ -68,202 +76,81 @@ def parse_iso_string(date_time_str):
     raise ValueError(f'Issue with datetime {stripped_dt_string}: No valid date format found')
 
 
-def convert_to_iso_string(datetime_obj):
+def get_bq_client_from_vault():
     """
-    convert_to_iso_string(datetime_obj)
+    get_bq_client_from_vault()
 
-    Converts a DateTime object into iso format.
-
-    Parameters
-    ----------
-    datetime_obj : datetime
+    Returns a bigquery client with credentials pulled from the Loblaws Vault. The credentials
+    are built in memory and, with the client, reused by the tasks of this worker process until
+    shortly before the key expires.
 
     Returns
-    -------
-    str
-        A string in iso format: "%Y-%m-%dT%H:%M:%S.%f"
-
-    Notes
-    -----
-    In Python>==3.7, the datetime library has the function datetime.isoformat(), which converts a
-    datetime into a string in ISO compliant format. Since our cloud composer instance uses Python
-    3.6, I wrote this custom function that parses a DateTime into iso format.
-    """
-
-    # TODO: When Airflow uses Python >==3.7, replace with datetime.isoformat()
-    iso_format = "%Y-%m-%dT%H:%M:%S.%f"
-    return datetime_obj.strftime(iso_format)
-
-
-def query_ada_source(url):
-    """
-    query_ada_source(url)
-
-    Queries the chat source API.
-
-    Parameters
     ----------
-    url : str
-        A string containing the url that the function will be sending the request to.
-
-    Returns
-    -------
-    requests.Response
-        The response from the api request.
+    client : google.cloud.bigquery.Client()
+        The BigQuery client that allows the function to update the tables.
     """
+    from bq_credentials import get_bq_client_from_vault as get_cached_bq_client
 
-    headers = {'Authorization': f"Bearer {conf.get('ada_api_key')}"}
-    retry_strategy = Retry(
-        total=5,
-        status_forcelist=[429, 500, 502, 503, 504],
-        method_whitelist=["GET"],
-        backoff_factor=2,
-    )
-    adapter = HTTPAdapter(max_retries=retry_strategy)
-    http = r.Session()
-    http.mount("https://", adapter)
-
-    return http.get(url, headers=headers, timeout=60)
+    return get_cached_bq_client(conf)
 
 
-def flatten_2d_array(arr):
+def get_day_window(execution_date):
     """
-    flatten_2d_array(arr)
+    get_day_window(execution_date)
 
-    Flattens a 2d array of object into a 1d array.
+    Returns the window of data a DAG run loads: the day before the run date, from midnight to
+    midnight.
 
     Parameters
     ----------
-    arr : list of list of objects
-        A 2-dimensional array containing any objects.
+    execution_date : str
+        A string containing the execution date in iso format.
 
     Returns
     -------
-    list of objects
-        The flattened list of objects.
+    tuple of datetime
+        The start of the day and the last microsecond of the day.
     """
 
-    return [datapoint for row in arr for datapoint in row]
+    # TODO: When Airflow uses Python >==3.7, replace parse_iso_string with
+    # datetime.fromisoformat(date_time_str).
+    end_time = parse_iso_string(execution_date).replace(hour=0,
+                                                        minute=0,
+                                                        second=0,
+                                                        microsecond=0
+                                                        )
+    start_time = end_time - timedelta(days=1)
+    end_time = end_time - timedelta(microseconds=1)
+    return start_time, end_time
 
 
-def fetch_api_data(endpoint_url, start_time, end_time, api_type):
+def parse_and_load(pages, api_type, bq_client, start_time):
     """
-    fetch_api_data(endpoint_url, start_time, end_time, api_type)
+    parse_and_load(pages, api_type, bq_client, start_time)
 
-    Gets data from either of the API endpoints between two given times.
+    De-identifies and parses fetched records as they arrive in chunks of `load_chunk_size` rows,
+    so memory use is bounded by the chunk size, and loads them into their day partition in the
+    configured `load_format`. With `archive_dir` set, the raw pages are archived on the way, so
+    the day can be replayed later with `replay_archive.py`.
 
     Parameters
     ----------
-    endpoint_url : str
-        The base url that the function will be sending the request to.
-    start_time : datetime
-        The datetime that is the start of the range the api queries.
-    end_time : datetime
-        The datetime that is the end of the range the api queries.
+    pages : iterable of lists of dicts
+        The records fetched from the API, page by page. It can be a generator.
     api_type : str
-        The type of data the function will be fetching. Currently can be either `conversations` or
-        `messages`.
-
-    Returns
-    -------
-    list of dicts
-        A list containing all of the data in the datetime range queried.
-    """
-
-    valid_response_data = []
-    # TODO: Once Airflow is updated to Python >==3.7, replace with start_time.isoformat()
-    str_start_time = convert_to_iso_string(start_time).replace(":", "%3A")
-    str_end_time = convert_to_iso_string(end_time).replace(":", "%3A")
-    uri = f"/data_api/v1/{api_type}?created_since={str_start_time}&created_to={str_end_time}"
-    num_of_pages = 0
-    log.info(
-        "Time slice: %s to %s",
-        str_start_time,
-        str_end_time)
-    while True:
-        num_of_pages += 1
-        log.info("Fetching data. URI: %s.", uri)
-        response = query_ada_source(endpoint_url + uri)
-        if response.status_code == 200:
-            payload = response.json()
-            valid_response_data.append(payload["data"])
-        else:
-            log.error(response.text)
-            raise ValueError(f'Error response received: {response.status_code}.')
-
-        if payload["next_page_uri"]:
-            uri = payload["next_page_uri"]
-            time.sleep(1)
-        else:
-            log.info("Done fetching this interval's API data. %s pages requested.", num_of_pages)
-            flattened_conversations = flatten_2d_array(valid_response_data)
-            time.sleep(1)
-            return flattened_conversations
-
-
-def get_bq_client_from_vault():
-    """
-    get_bq_client_from_vault()
-
-    Returns a bigquery client with credentials pulled from the Loblaws Vault.
-
-    Returns
-    ----------
-    client : google.cloud.bigquery.Client()
-        The BigQuery client that allows the function to update the tables.
-    """
-    vault_client = Vault(
-        temp_path='/tmp',
-        role=conf['vault_gcp_role'],
-        address=os.environ.get("VAULT_ADDR"),
-        secret_path='datascience',
-        service_account=conf["composer_service_account"],
-        jwt_time_to_live=60
-    )
-    log.info('Getting secret from vault ...')
-    creds = vault_client.get_secret_from_vault(conf['ada_to_bq_sa_vault_key'])
-    with open('key-file.json', 'w') as key_file:
-        key_file.write(json.dumps(creds))
-    log.info('Generating BQ client with special SA ...')
-    client = bigquery.Client.from_service_account_json(json_credentials_path='key-file.json',
-                                                       project=conf['bq_project'])
-    log.info('BQ client with special SA generated.')
-    os.remove('key-file.json')
-    return client
-
-
-def load_record_to_bq(record, table_type, client, start_time):
-    """
-    load_record_to_bq(record, table_type, client, start_time)
-
-    Sends records to BigQuery. Data is loaded into a single day partition of the BQ table.
-
-    Parameters
-    ----------
-    record : list of dicts
-        The list of JSON records to send to BigQuery.
-    table_type : str
-        The name of the table being sent to. Currently can be `messages` or `conversations`.
-    client : google.cloud.bigquery.Client()
+        Either `messages` or `conversations`.
+    bq_client : google.cloud.bigquery.Client()
         The BigQuery client that allows the function to update the tables.
     start_time : datetime
         The start date of the data. Used to refer to a specific partition.
     """
 
-    bq_project = conf.get("bq_project")
-    dataset = conf.get("dataset")
-    partition_date_str = start_time.strftime("%Y%m%d")
-    table_id = f"{bq_project}.{dataset}.{table_type}${partition_date_str}"
-    # Ensures idempotence by deleting old partitions before write
-    job_config = bigquery.job.LoadJobConfig(**{"write_disposition": "WRITE_TRUNCATE"})
-    log.info("Sending data to bigquery table %s.", table_id)
-    try:
-        client.load_table_from_json(record, table_id, job_config=job_config).result()
-    except BadRequest as err:
-        log.debug("BadRequest error: %s", str(err))
-        log.debug(repr(record))
-        raise err
-    log.info("Data load to BigQuery complete.")
+    from etl_pipeline import parse_and_load_pages
+    from page_archive import PageArchive
+
+    if conf.get("archive_dir"):
+        pages = PageArchive(conf.get("archive_dir")).archive_pages(pages, api_type, start_time)
+    parse_and_load_pages(pages, api_type, bq_client, start_time, conf)
 
 
 def run_ada_to_bq_etl(**kwargs):
@@ -286,29 +173,97 @@ def run_ada_to_bq_etl(**kwargs):
             either be "messages" or "conversations".
     """
 
+    from ada_client import fetch_windows, get_ada_client, split_time_window, window_uri
+    from fetch_checkpoint import (DEFAULT_CHECKPOINT_MAX_AGE_DAYS, purge_stale_checkpoints,
+                                  window_checkpoints)
+
+    load_run_config()
+
     python_version = '.'.join(map(str, sys.version_info))
     log.info("Python version %s is in use. datetime.fromisoformat requires >==3.7", python_version)
     # Variable setup
     endpoint_url = conf.get("endpoint_url")
-    # TODO: When Airflow uses Python >==3.7, replace parse_iso_string with
-    # datetime.fromisoformat(date_time_str).
-    # Data is queried from only the day before the run date of the DAG, from midnight to midnight.
-    end_time = parse_iso_string(kwargs
-                                .get("templates_dict")
-                                .get("execution_date")).replace(hour=0,
-                                                                minute=0,
-                                                                second=0,
-                                                                microsecond=0
-                                                                )
-    start_time = end_time - timedelta(days=1)
-    end_time = end_time - timedelta(microseconds=1)
+    start_time, end_time = get_day_window(kwargs.get("templates_dict").get("execution_date"))
     api_type = kwargs.get("templates_dict").get("api_type")
     bq_client = get_bq_client_from_vault()
     # Run functions
     log.info("Starting requests for data from endpoint '%s'.", endpoint_url)
-    valid_request_data = fetch_api_data(endpoint_url, start_time, end_time, api_type)
-    parsed_data_dicts = parse_api_data(valid_request_data, api_type, conf.get("bq_project"))
-    load_record_to_bq(parsed_data_dicts, api_type, bq_client, start_time)
+    num_windows = conf.get("fetch_num_windows", 1)
+    # Pages are checkpointed per window, so a rerun of a failed task resumes where it stopped.
+    if conf.get("checkpoint_dir"):
+        purge_stale_checkpoints(conf.get("checkpoint_dir"),
+                                conf.get("checkpoint_max_age_days",
+                                         DEFAULT_CHECKPOINT_MAX_AGE_DAYS))
+    checkpoints = window_checkpoints(conf.get("checkpoint_dir"), api_type,
+                                     split_time_window(start_time, end_time, num_windows))
+    if num_windows > 1:
+        clients = [get_ada_client(endpoint_url, api_key)
+                   for api_key in conf.get("ada_api_keys") or [conf.get("ada_api_key")]]
+        pages = fetch_windows(clients, api_type, start_time, end_time, num_windows,
+                              checkpoints)
+    else:
+        ada_client = get_ada_client(endpoint_url, conf.get("ada_api_key"))
+        pages = ada_client.iter_pages(window_uri(api_type, start_time, end_time), checkpoints[0])
+    parse_and_load(pages, api_type, bq_client, start_time)
+    # The load succeeded, so the saved pages are no longer needed.
+    for checkpoint in checkpoints:
+        if checkpoint is not None:
+            checkpoint.clear()
+
+
+def run_ada_async_etl(**kwargs):
+    """
+    run_ada_async_etl(**kwargs)
+
+    Fetches `messages` and `conversations` together in one event loop that shares the API key's
+    request budget between them, and parses and loads each endpoint's pages as they stream in,
+    `messages` first. Used instead of the two `run_ada_to_bq_etl` tasks when `fetch_engine` is
+    `async`.
+
+    Parameters
+    ----------
+    **kwargs : dicts
+        Takes the `execution_date` through `templates_dict`.
+    """
+
+    from ada_async_client import iter_pages_async
+
+    load_run_config()
+
+    endpoint_url = conf.get("endpoint_url")
+    start_time, end_time = get_day_window(kwargs.get("templates_dict").get("execution_date"))
+    bq_client = get_bq_client_from_vault()
+    log.info("Starting async requests for data from endpoint '%s'.", endpoint_url)
+    pages = iter_pages_async(endpoint_url, conf.get("ada_api_key"), API_TYPES, start_time,
+                             end_time, num_windows=conf.get("fetch_num_windows", 1))
+    for api_type, api_pages in groupby(pages, key=itemgetter(0)):
+        parse_and_load((page for _, page in api_pages), api_type, bq_client, start_time)
+
+
+def run_ada_incremental_etl(**kwargs):
+    """
+    run_ada_incremental_etl(**kwargs)
+
+    Syncs the records of one endpoint created since its high-water mark, merging them into the
+    partitioned table by id instead of replacing the day. Run by the incremental DAG, which is
+    only created when `incremental_schedule_interval` is set.
+
+    Parameters
+    ----------
+    **kwargs : dicts
+        Takes the `api_type` through `templates_dict`.
+    """
+
+    from ada_client import get_ada_client
+    from incremental_sync import SyncState, run_incremental_sync
+
+    load_run_config()
+
+    api_type = kwargs.get("templates_dict").get("api_type")
+    ada_client = get_ada_client(conf.get("endpoint_url"), conf.get("ada_api_key"))
+    run_incremental_sync(api_type, ada_client, get_bq_client_from_vault(), conf,
+                         SyncState(conf.get("sync_state_dir")),
+                         overlap=timedelta(minutes=conf.get("incremental_overlap_minutes", 60)))
 
 
 with models.DAG(
@@ -319,19 +274,45 @@ with models.DAG(
         catchup=True,
         max_active_runs=1) as dag:
 
-    run_ada_messages_etl = PythonOperator(
-        task_id='run_ada_messages_etl',
-        python_callable=run_ada_to_bq_etl,
-        provide_context=True,
-        templates_dict={'execution_date': '{{ ts }}',
-                        "api_type": "messages",
-                        },
-    )
-    run_ada_conversations_etl = PythonOperator(
-        task_id='run_ada_conversations_etl',
-        python_callable=run_ada_to_bq_etl,
-        provide_context=True,
-        templates_dict={'execution_date': '{{ ts }}',
-                        "api_type": "conversations",
-                        },
-    )
+    if conf.get("fetch_engine") == "async":
+        run_ada_async_etl_task = PythonOperator(
+            task_id='run_ada_async_etl',
+            python_callable=run_ada_async_etl,
+            provide_context=True,
+            templates_dict={'execution_date': '{{ ts }}'},
+        )
+    else:
+        run_ada_messages_etl = PythonOperator(
+            task_id='run_ada_messages_etl',
+            python_callable=run_ada_to_bq_etl,
+            provide_context=True,
+            templates_dict={'execution_date': '{{ ts }}',
+                            "api_type": "messages",
+                            },
+        )
+        run_ada_conversations_etl = PythonOperator(
+            task_id='run_ada_conversations_etl',
+            python_callable=run_ada_to_bq_etl,
+            provide_context=True,
+            templates_dict={'execution_date': '{{ ts }}',
+                            "api_type": "conversations",
+                            },
+        )
+
+
+if conf.get("incremental_schedule_interval"):
+    with models.DAG(
+            "ada_chatbot_data_incremental_sync",
+            schedule_interval=conf.get("incremental_schedule_interval"),
+            default_args=default_dag_args,
+            start_date=dates.days_ago(1),
+            catchup=False,
+            max_active_runs=1) as incremental_dag:
+
+        for incremental_api_type in API_TYPES:
+            PythonOperator(
+                task_id=f'run_ada_{incremental_api_type}_incremental_sync',
+                python_callable=run_ada_incremental_etl,
+                provide_context=True,
+                templates_dict={"api_type": incremental_api_type},
+            )
@@ -0,0 +1,209 @@
+"""Backfills a date range of Ada data into BigQuery, several days at a time.
+
+Replaces a 60-day `catchup` of the DAG, which runs one day after the other and authenticates and
+builds new clients for each. Here days are fetched concurrently within the API keys' request
+budgets, one BigQuery client is shared, and each day is written to its `$YYYYMMDD` partition
+with a single load job, e.g.
+
+    ADA_API_KEYS=key1,key2 python orchestration/dag/backfill.py \
+        --start 2021-06-01 --end 2021-07-30 --config rendered_config.json
+
+`--config` takes a rendered `ada_data_etl_config.json`. The flags override its values. BigQuery
+and DLP are reached with application default credentials, or with `--vault` BigQuery is reached
+with the DAG's service account key from Vault.
+"""
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+import json
+import logging as log
+import os
+import threading
+import time
+
+from ada_client import get_ada_client, window_uri
+from etl_pipeline import parse_and_load_pages
+from fetch_checkpoint import (DEFAULT_CHECKPOINT_MAX_AGE_DAYS, PageCheckpoint,
+                              purge_stale_checkpoints)
+from page_archive import PageArchive, parse_day
+
+DEFAULT_CONCURRENT_DAYS = 4
+# Load formats that write a whole partition with one job.
+SINGLE_JOB_LOAD_FORMATS = ("ndjson", "parquet", "avro")
+
+
+class BackfillProgress:
+    """
+    BackfillProgress(num_tasks, clock=time.monotonic)
+
+    Counts finished (day, endpoint) tasks and logs the progress and the estimated time left,
+    from the average time per task so far.
+
+    Parameters
+    ----------
+    num_tasks : int
+        The number of tasks in the backfill.
+    clock : function
+        Returns the current time in seconds.
+    """
+
+    def __init__(self, num_tasks, clock=time.monotonic):
+        self.num_tasks = num_tasks
+        self.num_done = 0
+        self.num_rows = 0
+        self._clock = clock
+        self._start = clock()
+        self._lock = threading.Lock()
+
+    @property
+    def elapsed(self):
+        return self._clock() - self._start
+
+    @property
+    def eta(self):
+        """The estimated seconds left, or None before the first task finishes."""
+        if not self.num_done:
+            return None
+        return self.elapsed / self.num_done * (self.num_tasks - self.num_done)
+
+    def task_done(self, num_rows):
+        with self._lock:
+            self.num_done += 1
+            self.num_rows += num_rows
+            log.info("Backfill %d/%d partitions, %d rows, %.1f min elapsed, ETA %.1f min.",
+                     self.num_done, self.num_tasks, self.num_rows, self.elapsed / 60,
+                     self.eta / 60)
+
+
+def backfill(start_day, end_day, api_types, ada_clients, bq_client, conf,
+             concurrent_days=DEFAULT_CONCURRENT_DAYS):
+    """
+    backfill(start_day, end_day, api_types, ada_clients, bq_client, conf,
+             concurrent_days=DEFAULT_CONCURRENT_DAYS)
+
+    Fetches, parses and loads every day of a date range, running up to `concurrent_days` days
+    at once. Days are spread over the API clients in turn, and clients that share a key share
+    its rate controller, so the key budgets hold however many days run at once. Days found in
+    the `archive_dir` archive are replayed from it without the API. Pages are checkpointed
+    under `checkpoint_dir`, so running the same backfill again after a failure resumes it.
+
+    Parameters
+    ----------
+    start_day : datetime
+        The first day loaded.
+    end_day : datetime
+        The last day loaded, inclusive.
+    api_types : list of str
+        The endpoints to load, e.g. `["messages", "conversations"]`.
+    ada_clients : list of ada_client.AdaClient
+        One client per API key.
+    bq_client : google.cloud.bigquery.Client()
+        The one client every load job is run with.
+    conf : dict
+        The DAG config, see `etl_pipeline.parse_and_load_pages`.
+    concurrent_days : int
+        The number of days in flight at once.
+
+    Returns
+    -------
+    dict
+        The number of rows loaded, keyed by `(day, api_type)`.
+
+    Raises
+    ------
+    RuntimeError
+        If any day failed, after every other day has been attempted.
+    """
+
+    if conf.get("load_format", "json") not in SINGLE_JOB_LOAD_FORMATS:
+        log.warning("Load format %s runs a load job per chunk, use ndjson for one per day.",
+                    conf.get("load_format", "json"))
+    archive = PageArchive(conf["archive_dir"]) if conf.get("archive_dir") else None
+    if conf.get("checkpoint_dir"):
+        purge_stale_checkpoints(conf["checkpoint_dir"],
+                                conf.get("checkpoint_max_age_days",
+                                         DEFAULT_CHECKPOINT_MAX_AGE_DAYS))
+    days = [start_day + timedelta(days=i) for i in range((end_day - start_day).days + 1)]
+    tasks = [(day, api_type) for day in days for api_type in api_types]
+    progress = BackfillProgress(len(tasks))
+
+    def run_task(i):
+        day, api_type = tasks[i]
+        start_time, end_time = day, day + timedelta(days=1) - timedelta(microseconds=1)
+        checkpoint = None
+        if archive is not None and archive.has_day(api_type, day):
+            pages = archive.iter_pages(api_type, day)
+        else:
+            if conf.get("checkpoint_dir"):
+                checkpoint = PageCheckpoint(conf["checkpoint_dir"], api_type, start_time,
+                                            end_time)
+            # Both endpoints of a day go to the same key, the next day to the next key.
+            ada_client = ada_clients[(i // len(api_types)) % len(ada_clients)]
+            pages = ada_client.iter_pages(window_uri(api_type, start_time, end_time), checkpoint)
+            if archive is not None:
+                pages = archive.archive_pages(pages, api_type, day)
+        num_rows = parse_and_load_pages(pages, api_type, bq_client, start_time, conf)
+        if checkpoint is not None:
+            checkpoint.clear()
+        progress.task_done(num_rows)
+        return num_rows
+
+    log.info("Backfilling %d days of %s, %d days at a time with %d API keys.", len(days),
+             ", ".join(api_types), concurrent_days, len(ada_clients))
+    with ThreadPoolExecutor(max_workers=concurrent_days) as executor:
+        futures = [executor.submit(run_task, i) for i in range(len(tasks))]
+    num_rows, failed = {}, []
+    for task, future in zip(tasks, futures):
+        if future.exception() is not None:
+            log.error("Backfill of %s %s failed: %r", task[1], task[0].date(), future.exception())
+            failed.append(task)
+        else:
+            num_rows[task] = future.result()
+    if failed:
+        raise RuntimeError(f"{len(failed)} of {len(tasks)} partitions failed: "
+                           + ", ".join(f"{api_type} {day.date()}" for day, api_type in failed))
+    log.info("Backfill complete: %d rows in %.1f min.", progress.num_rows, progress.elapsed / 60)
+    return num_rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--start", required=True, help="first day, YYYY-MM-DD")
+    parser.add_argument("--end", required=True, help="last day, inclusive, YYYY-MM-DD")
+    parser.add_argument("--api-types", default="messages,conversations")
+    parser.add_argument("--config", help="a rendered ada_data_etl_config.json")
+    parser.add_argument("--concurrent-days", type=int, default=DEFAULT_CONCURRENT_DAYS)
+    parser.add_argument("--endpoint-url")
+    parser.add_argument("--bq-project")
+    parser.add_argument("--dataset")
+    parser.add_argument("--load-format")
+    parser.add_argument("--parse-workers", type=int)
+    parser.add_argument("--vault", action="store_true",
+                        help="use the service account key held in Vault for BigQuery")
+    args = parser.parse_args()
+    log.basicConfig(level=log.INFO)
+
+    conf = {}
+    if args.config:
+        with open(args.config) as config_file:
+            conf = json.load(config_file)
+    for key in ("endpoint_url", "bq_project", "dataset", "load_format", "parse_workers"):
+        if getattr(args, key) is not None:
+            conf[key] = getattr(args, key)
+    conf.setdefault("load_format", "ndjson")
+    api_keys = [key for key in os.environ.get("ADA_API_KEYS", "").split(",") if key]
+    api_keys = api_keys or [os.environ["ADA_API_KEY"]]
+
+    if args.vault:
+        from bq_credentials import get_bq_client_from_vault
+        bq_client = get_bq_client_from_vault(conf)
+    else:
+        from google.cloud import bigquery
+        bq_client = bigquery.Client(project=conf.get("bq_project"))
+    ada_clients = [get_ada_client(conf["endpoint_url"], api_key) for api_key in api_keys]
+    backfill(parse_day(args.start), parse_day(args.end), args.api_types.split(","), ada_clients,
+             bq_client, conf, args.concurrent_days)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+import logging as log
+import os
+import threading
+import time
+
+# How long a service account key issued by Vault is used before it is fetched again, and how
+# long before that it is already replaced, so no job starts with a key about to be revoked.
+DEFAULT_SECRET_TTL = 60 * 60
+DEFAULT_REFRESH_MARGIN = 5 * 60
+
+
+def _credentials_from_info(info):
+    from google.oauth2 import service_account
+    return service_account.Credentials.from_service_account_info(info)
+
+
+def _bq_client(credentials, project):
+    from google.cloud import bigquery
+    return bigquery.Client(credentials=credentials, project=project)
+
+
+class CachedCredentials:
+    """
+    CachedCredentials(fetch_secret, ttl=DEFAULT_SECRET_TTL, refresh_margin=DEFAULT_REFRESH_MARGIN,
+                      credentials_factory=None, client_factory=None, clock=time.monotonic)
+
+    Builds service account credentials in memory from a secret fetched on demand, and keeps
+    them, and the BigQuery clients made with them, until `refresh_margin` seconds before `ttl`
+    runs out. The key is never written to disk. Safe to share between threads.
+
+    Parameters
+    ----------
+    fetch_secret : function
+        Returns the service account key as a dict, i.e. the content of a key file.
+    ttl : float
+        The seconds a fetched key stays valid.
+    refresh_margin : float
+        How many seconds before the end of `ttl` the key is fetched again.
+    credentials_factory : function, optional
+        Turns the key into credentials. Defaults to
+        `google.oauth2.service_account.Credentials.from_service_account_info`.
+    client_factory : function, optional
+        Takes the credentials and a project and returns a client. Defaults to
+        `google.cloud.bigquery.Client`.
+    clock : function
+        Returns the current time in seconds.
+    """
+
+    def __init__(self, fetch_secret, ttl=DEFAULT_SECRET_TTL,
+                 refresh_margin=DEFAULT_REFRESH_MARGIN, credentials_factory=None,
+                 client_factory=None, clock=time.monotonic):
+        self._fetch_secret = fetch_secret
+        self.ttl = ttl
+        self.refresh_margin = refresh_margin
+        self._credentials_factory = credentials_factory or _credentials_from_info
+        self._client_factory = client_factory or _bq_client
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._credentials = None
+        self._expires_at = 0
+        self._clients = {}
+        self.num_fetches = 0
+
+    def _refresh_if_expiring(self):
+        if self._credentials is None or self._clock() >= self._expires_at - self.refresh_margin:
+            fetched_at = self._clock()
+            self._credentials = self._credentials_factory(self._fetch_secret())
+            self._expires_at = fetched_at + self.ttl
+            self._clients = {}
+            self.num_fetches += 1
+
+    def get_credentials(self):
+        """Returns the cached credentials, fetching the key first if they are about to expire."""
+        with self._lock:
+            self._refresh_if_expiring()
+            return self._credentials
+
+    def get_bq_client(self, project):
+        """Returns the BigQuery client of `project` made with the current credentials."""
+        with self._lock:
+            self._refresh_if_expiring()
+            if project not in self._clients:
+                self._clients[project] = self._client_factory(self._credentials, project)
+            return self._clients[project]
+
+
+# One cache per Vault role and key in each worker process, shared by every task run in it.
+_vault_credentials = {}
+_vault_credentials_lock = threading.Lock()
+
+
+def get_vault_credentials(conf):
+    """
+    get_vault_credentials(conf)
+
+    Returns the process-wide `CachedCredentials` of the service account key named by
+    `ada_to_bq_sa_vault_key` in the DAG config, which is fetched from Vault with the
+    `vault_gcp_role` role. `vault_secret_ttl_minutes` sets how long the key is reused.
+
+    Parameters
+    ----------
+    conf : dict
+        The DAG config, see `orchestration/config/ada_data_etl_config.json`.
+
+    Returns
+    -------
+    CachedCredentials
+    """
+
+    cache_key = (conf["vault_gcp_role"], conf["ada_to_bq_sa_vault_key"])
+
+    def fetch_secret():
+        from commons.vault import Vault
+
+        vault_client = Vault(
+            temp_path='/tmp',
+            role=conf['vault_gcp_role'],
+            address=os.environ.get("VAULT_ADDR"),
+            secret_path='datascience',
+            service_account=conf["composer_service_account"],
+            jwt_time_to_live=60
+        )
+        log.info('Getting secret from vault ...')
+        return vault_client.get_secret_from_vault(conf['ada_to_bq_sa_vault_key'])
+
+    with _vault_credentials_lock:
+        if cache_key not in _vault_credentials:
+            _vault_credentials[cache_key] = CachedCredentials(
+                fetch_secret, ttl=conf.get("vault_secret_ttl_minutes", 60) * 60)
+        return _vault_credentials[cache_key]
+
+
+def get_bq_client_from_vault(conf):
+    """
+    get_bq_client_from_vault(conf)
+
+    Returns a BigQuery client for `bq_project` with the service account key held in Vault,
+    reusing the key and the client of earlier calls in this process while the key is valid.
+
+    Parameters
+    ----------
+    conf : dict
+        The DAG config, see `orchestration/config/ada_data_etl_config.json`.
+
+    Returns
+    -------
+    google.cloud.bigquery.Client()
+    """
+
+    return get_vault_credentials(conf).get_bq_client(conf["bq_project"])
@@ -0,0 +1,336 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from datetime import timedelta
+import gzip
+import logging as log
+import os
+import tempfile
+import uuid
+
+from google.cloud import bigquery
+from google.api_core.exceptions import BadRequest
+
+from columnar_writer import ColumnarLoadSink
+from json_codec import dumps
+from load_jobs import load_spool_file, remove_spool_file
+from schema_parsers import SCHEMA_DIR, SlottedRecord, read_schema_fields
+
+DEFAULT_LOAD_WORKERS = 1
+DEFAULT_UPLOAD_CHUNK_ROWS = 200000
+# Staging tables left behind by a failed run are dropped by BigQuery after this long.
+STAGING_TABLE_EXPIRATION = timedelta(days=1)
+
+
+def partition_table_id(bq_project, dataset, table_type, start_time):
+    """Returns the id of the day partition of `table_type` that holds data from `start_time`."""
+    partition_date_str = start_time.strftime("%Y%m%d")
+    return f"{bq_project}.{dataset}.{table_type}${partition_date_str}"
+
+
+def load_schema(table_type, schema_dir=SCHEMA_DIR):
+    """
+    load_schema(table_type, schema_dir=SCHEMA_DIR)
+
+    Reads the BigQuery schema of a table from `<schema_dir>/<table_type>_schema.json`.
+
+    Parameters
+    ----------
+    table_type : str
+        Either `messages` or `conversations`.
+    schema_dir : str
+        The folder holding the schema files.
+
+    Returns
+    -------
+    list of google.cloud.bigquery.SchemaField
+    """
+
+    return [bigquery.SchemaField.from_api_repr(field)
+            for field in read_schema_fields(table_type, schema_dir)]
+
+
+def _create_staging_table(client, table_id, schema):
+    """Creates an expiring table next to the partition `table_id` and returns its id."""
+    table_name, _, partition = table_id.partition("$")
+    staging_table_id = f"{table_name}_load_{partition}_{uuid.uuid4().hex[:8]}"
+    staging_table = bigquery.Table(staging_table_id, schema=schema)
+    staging_table.expires = datetime.utcnow() + STAGING_TABLE_EXPIRATION
+    client.create_table(staging_table)
+    return staging_table_id
+
+
+def _replace_partition(client, staging_table_id, table_id):
+    """Copies a staging table over the partition `table_id` with one `WRITE_TRUNCATE` job."""
+    job_config = bigquery.job.CopyJobConfig(write_disposition="WRITE_TRUNCATE")
+    client.copy_table(staging_table_id, table_id, job_config=job_config).result()
+
+
+class ChunkedLoadSink:
+    """
+    ChunkedLoadSink(client, table_id, schema)
+
+    Loads parsed records one chunk at a time, so only one chunk has to be held in memory. The
+    chunks are appended to a staging table, which `close` copies over the day partition with
+    `WRITE_TRUNCATE`. The partition is replaced in one step, or left as it was if any load
+    failed, which keeps a rerun of the same day idempotent.
+
+    Parameters
+    ----------
+    client : google.cloud.bigquery.Client()
+        The BigQuery client that allows the sink to update the tables.
+    table_id : str
+        The partition loaded into, e.g. `project.dataset.messages$20210726`.
+    schema : list of google.cloud.bigquery.SchemaField
+        The schema of the table, see `load_schema`.
+    """
+
+    def __init__(self, client, table_id, schema):
+        self.client = client
+        self.table_id = table_id
+        self.schema = schema
+        self.num_chunks = 0
+        self.num_rows = 0
+        self.staging_table_id = _create_staging_table(client, table_id, schema)
+
+    def write(self, records):
+        """
+        write(records)
+
+        Loads one chunk of records into the staging table.
+
+        Parameters
+        ----------
+        records : list of dicts
+            The JSON records to send to BigQuery. Slotted records are sent as their dicts.
+        """
+
+        job_config = bigquery.job.LoadJobConfig(schema=self.schema,
+                                                write_disposition="WRITE_APPEND")
+        records = [record._asdict() if isinstance(record, SlottedRecord) else record
+                   for record in records]
+        log.info("Sending %d rows to bigquery table %s.", len(records), self.staging_table_id)
+        try:
+            self.client.load_table_from_json(records, self.staging_table_id,
+                                             job_config=job_config).result()
+        except BadRequest as err:
+            log.debug("BadRequest error: %s", str(err))
+            log.debug(repr(records))
+            raise err
+        self.num_chunks += 1
+        self.num_rows += len(records)
+
+    def close(self):
+        """Copies the staging table over the partition, then drops it. A day without records
+        still replaces the partition."""
+        try:
+            _replace_partition(self.client, self.staging_table_id, self.table_id)
+        finally:
+            self.client.delete_table(self.staging_table_id, not_found_ok=True)
+        log.info("Data load to BigQuery complete. %d rows in %d chunks.", self.num_rows,
+                 self.num_chunks)
+
+    def abort(self):
+        """Drops the staging table, leaving the partition as it was."""
+        log.warning("Load to %s aborted after %d rows in %d chunks.", self.table_id,
+                    self.num_rows, self.num_chunks)
+        self.client.delete_table(self.staging_table_id, not_found_ok=True)
+
+
+class NdjsonLoadSink:
+    """
+    NdjsonLoadSink(client, table_id, schema, spool_dir=None)
+
+    Streams parsed records into a gzip-compressed newline-delimited JSON spool file and loads it
+    into a day partition with a single `load_table_from_file` job and an explicit schema. Only
+    the records of the current `write` call are held in memory, and no schema is inferred.
+
+    Parameters
+    ----------
+    client : google.cloud.bigquery.Client()
+        The BigQuery client that allows the sink to update the tables.
+    table_id : str
+        The partition loaded into, e.g. `project.dataset.messages$20210726`.
+    schema : list of google.cloud.bigquery.SchemaField
+        The schema of the table, see `load_schema`.
+    spool_dir : str, optional
+        Where the spool file is written. Defaults to the temp dir.
+    """
+
+    def __init__(self, client, table_id, schema, spool_dir=None):
+        self.client = client
+        self.table_id = table_id
+        self.schema = schema
+        self.num_rows = 0
+        spool_fd, self.spool_path = tempfile.mkstemp(suffix=".json.gz", dir=spool_dir)
+        os.close(spool_fd)
+        self._spool = gzip.open(self.spool_path, "wt", encoding="utf-8")
+
+    def write(self, records):
+        """Appends records to the spool file."""
+        for record in records:
+            self._spool.write(dumps(record))
+            self._spool.write("\n")
+        self.num_rows += len(records)
+
+    def close(self):
+        """Loads the spool file into the partition, replacing it, and deletes the file."""
+        self._spool.close()
+        # Ensures idempotence by deleting old partitions before write
+        job_config = bigquery.job.LoadJobConfig(
+            source_format=bigquery.SourceFormat.NEWLINE_DELIMITED_JSON,
+            schema=self.schema,
+            write_disposition="WRITE_TRUNCATE",
+        )
+        log.info("Sending %d rows (%d compressed bytes) to bigquery table %s.", self.num_rows,
+                 os.path.getsize(self.spool_path), self.table_id)
+        load_spool_file(self.client, self.spool_path, self.table_id, job_config)
+        log.info("Data load to BigQuery complete.")
+
+    def abort(self):
+        """Deletes the spool file without loading it, leaving the partition as it was."""
+        self._spool.close()
+        remove_spool_file(self.spool_path)
+
+
+class ParallelLoadSink:
+    """
+    ParallelLoadSink(client, table_id, schema, chunk_rows=DEFAULT_UPLOAD_CHUNK_ROWS,
+                     max_workers=DEFAULT_LOAD_WORKERS, spool_dir=None)
+
+    Spools parsed records into gzip-compressed NDJSON files of `chunk_rows` rows and starts the
+    load job of each file as soon as it is full, up to `max_workers` at a time, so uploads
+    overlap with the fetch and parse of the next records. The jobs append to a staging table,
+    which `close` copies over the day partition with `WRITE_TRUNCATE`. The partition is replaced
+    in one step, or left as it was if any load failed, which keeps a rerun idempotent.
+
+    Parameters
+    ----------
+    client : google.cloud.bigquery.Client()
+        The BigQuery client that allows the sink to update the tables.
+    table_id : str
+        The partition loaded into, e.g. `project.dataset.messages$20210726`.
+    schema : list of google.cloud.bigquery.SchemaField
+        The schema of the table, see `load_schema`.
+    chunk_rows : int
+        The number of rows uploaded by each load job.
+    max_workers : int
+        The number of load jobs running at once.
+    spool_dir : str, optional
+        Where the spool files are written. Defaults to the temp dir.
+    """
+
+    def __init__(self, client, table_id, schema, chunk_rows=DEFAULT_UPLOAD_CHUNK_ROWS,
+                 max_workers=DEFAULT_LOAD_WORKERS, spool_dir=None):
+        self.client = client
+        self.table_id = table_id
+        self.schema = schema
+        self.chunk_rows = chunk_rows
+        self.spool_dir = spool_dir
+        self.num_rows = 0
+        self.num_chunks = 0
+        self.staging_table_id = _create_staging_table(client, table_id, schema)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._jobs = []
+        self._spool = None
+        self._spool_path = None
+        self._spool_rows = 0
+
+    def _load_chunk(self, spool_path, num_rows):
+        job_config = bigquery.job.LoadJobConfig(
+            source_format=bigquery.SourceFormat.NEWLINE_DELIMITED_JSON,
+            schema=self.schema,
+            write_disposition="WRITE_APPEND",
+        )
+        log.info("Sending %d rows (%d compressed bytes) to bigquery table %s.", num_rows,
+                 os.path.getsize(spool_path), self.staging_table_id)
+        load_spool_file(self.client, spool_path, self.staging_table_id, job_config)
+
+    def _submit_chunk(self):
+        self._spool.close()
+        self._jobs.append(self._executor.submit(self._load_chunk, self._spool_path,
+                                                self._spool_rows))
+        self.num_chunks += 1
+        self._spool = None
+        self._spool_rows = 0
+
+    def write(self, records):
+        """Appends records to the spool file, starting its load once it holds `chunk_rows`."""
+        for record in records:
+            if self._spool is None:
+                spool_fd, self._spool_path = tempfile.mkstemp(suffix=".json.gz",
+                                                              dir=self.spool_dir)
+                os.close(spool_fd)
+                self._spool = gzip.open(self._spool_path, "wt", encoding="utf-8")
+            self._spool.write(dumps(record))
+            self._spool.write("\n")
+            self._spool_rows += 1
+            if self._spool_rows >= self.chunk_rows:
+                self._submit_chunk()
+        self.num_rows += len(records)
+
+    def close(self):
+        """Waits for the loads and copies the staging table over the partition, then drops it."""
+        try:
+            if self._spool is not None:
+                self._submit_chunk()
+            for job in self._jobs:
+                job.result()
+            _replace_partition(self.client, self.staging_table_id, self.table_id)
+        finally:
+            self._executor.shutdown()
+            self.client.delete_table(self.staging_table_id, not_found_ok=True)
+        log.info("Data load to BigQuery complete. %d rows in %d chunks.", self.num_rows,
+                 self.num_chunks)
+
+    def abort(self):
+        """Drops the pending loads, the spool file and the staging table, leaving the partition
+        as it was."""
+        if self._spool is not None:
+            self._spool.close()
+            remove_spool_file(self._spool_path)
+            self._spool = None
+        for job in self._jobs:
+            job.cancel()
+        # The loads already running delete their own files, and must end before the table does.
+        self._executor.shutdown()
+        self.client.delete_table(self.staging_table_id, not_found_ok=True)
+
+
+def make_load_sink(load_format, client, table_type, table_id, schema_dir=SCHEMA_DIR,
+                   load_workers=DEFAULT_LOAD_WORKERS, upload_chunk_rows=DEFAULT_UPLOAD_CHUNK_ROWS):
+    """
+    make_load_sink(load_format, client, table_type, table_id, schema_dir=SCHEMA_DIR,
+                   load_workers=DEFAULT_LOAD_WORKERS, upload_chunk_rows=DEFAULT_UPLOAD_CHUNK_ROWS)
+
+    Returns the sink that loads parsed records in the given format.
+
+    Parameters
+    ----------
+    load_format : str
+        `ndjson` for a compressed file load with an explicit schema, `parquet` or `avro` for a
+        columnar file load, or `json` for chunked in-memory loads into a staging table.
+    client : google.cloud.bigquery.Client()
+    table_type : str
+        Either `messages` or `conversations`.
+    table_id : str
+        The partition loaded into.
+    schema_dir : str
+        The folder holding the schema files.
+    load_workers : int
+        With `ndjson` and more than 1 worker, the partition is uploaded in chunks of
+        `upload_chunk_rows` rows by that many concurrent load jobs, see `ParallelLoadSink`.
+    upload_chunk_rows : int
+        The number of rows per load job of a parallel load.
+    """
+
+    if load_format == "ndjson" and load_workers > 1:
+        return ParallelLoadSink(client, table_id, load_schema(table_type, schema_dir),
+                                upload_chunk_rows, load_workers)
+    if load_format == "ndjson":
+        return NdjsonLoadSink(client, table_id, load_schema(table_type, schema_dir))
+    if load_format in ("parquet", "avro"):
+        return ColumnarLoadSink(client, table_id, read_schema_fields(table_type, schema_dir),
+                                load_format)
+    if load_format == "json":
+        return ChunkedLoadSink(client, table_id, load_schema(table_type, schema_dir))
+    raise ValueError(f"'{load_format}' is not a recognized load format.")
@@ -0,0 +1,256 @@
+from datetime import datetime
+from datetime import timedelta
+from datetime import timezone
+import logging as log
+import os
+import re
+import tempfile
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+try:
+    from fastavro import parse_schema
+    from fastavro.write import Writer as AvroWriter
+except ImportError:
+    AvroWriter = None
+from google.cloud import bigquery
+
+from load_jobs import load_spool_file, remove_spool_file
+
+
+# The timestamps BigQuery reads from JSON: a `T` or a space between date and time, up to six
+# fractional digits and an optional `Z` or UTC offset.
+TIMESTAMP_PATTERN = re.compile(
+    r"(\d{4})-(\d{1,2})-(\d{1,2})[T ](\d{1,2}):(\d{2}):(\d{2})(?:\.(\d{1,6}))?"
+    r"\s*(Z|[+-]\d{2}(?::?\d{2})?)?\Z")
+
+
+def to_bool(value):
+    """Reads BOOL columns, some of which the API sends as "True"/"False" strings."""
+    if isinstance(value, bool) or value is None:
+        return value
+    if isinstance(value, str) and value.lower() in ("true", "false"):
+        return value.lower() == "true"
+    return None
+
+
+def to_int(value):
+    if isinstance(value, bool):
+        return int(value)
+    if isinstance(value, int):
+        return value
+    if isinstance(value, str) and value.lstrip("-").isdigit():
+        return int(value)
+    return None
+
+
+def to_timestamp(value):
+    """
+    to_timestamp(value)
+
+    Reads TIMESTAMP columns, sent either as epoch seconds or as strings in any of the formats a
+    JSON load accepts. Strings without an offset are UTC.
+
+    Raises
+    ------
+    ValueError
+        If the value is not a timestamp, which a JSON load would reject too, rather than
+        writing NULL in its place.
+    """
+
+    if value is None:
+        return None
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return datetime.fromtimestamp(value, timezone.utc)
+    match = TIMESTAMP_PATTERN.match(value) if isinstance(value, str) else None
+    if match is None:
+        raise ValueError(f"{value!r} is not a valid TIMESTAMP value.")
+    year, month, day, hour, minute, second, fraction, offset = match.groups()
+    parsed = datetime(int(year), int(month), int(day), int(hour), int(minute), int(second),
+                      int((fraction or "0").ljust(6, "0")), timezone.utc)
+    if offset and offset != "Z":
+        sign = -1 if offset[0] == "-" else 1
+        digits = offset[1:].replace(":", "")
+        parsed -= sign * timedelta(hours=int(digits[:2]), minutes=int(digits[2:] or 0))
+    return parsed
+
+
+def to_str(value):
+    return value if value is None or isinstance(value, str) else str(value)
+
+
+CONVERTERS = {
+    "STRING": to_str,
+    "BOOL": to_bool,
+    "BOOLEAN": to_bool,
+    "INTEGER": to_int,
+    "INT64": to_int,
+    "TIMESTAMP": to_timestamp,
+}
+
+
+def coerce_record(record, fields):
+    """
+    coerce_record(record, fields)
+
+    Converts a parsed record to the types of its BigQuery schema, recursing into RECORD fields.
+    Values that cannot be converted become None, except timestamps, which raise, see
+    `to_timestamp`.
+
+    Parameters
+    ----------
+    record : dict
+        A parsed record, as produced by `parse_ada_data`.
+    fields : list of dicts
+        The fields of the record in BigQuery's JSON schema format.
+
+    Returns
+    -------
+    dict
+    """
+
+    if record is None:
+        return None
+    coerced = {}
+    for field in fields:
+        value = record.get(field["name"])
+        if field["type"] == "RECORD":
+            coerced[field["name"]] = coerce_record(value, field["fields"])
+        else:
+            coerced[field["name"]] = CONVERTERS[field["type"]](value)
+    return coerced
+
+
+def to_arrow_schema(fields):
+    """Builds a pyarrow schema from fields in BigQuery's JSON schema format."""
+    arrow_types = {
+        "STRING": pa.string(),
+        "BOOL": pa.bool_(),
+        "BOOLEAN": pa.bool_(),
+        "INTEGER": pa.int64(),
+        "INT64": pa.int64(),
+        "TIMESTAMP": pa.timestamp("us", tz="UTC"),
+    }
+
+    def to_arrow_type(field):
+        if field["type"] == "RECORD":
+            return pa.struct([pa.field(sub_field["name"], to_arrow_type(sub_field))
+                              for sub_field in field["fields"]])
+        return arrow_types[field["type"]]
+
+    return pa.schema([pa.field(field["name"], to_arrow_type(field)) for field in fields])
+
+
+def to_avro_schema(fields, name):
+    """Builds an Avro record schema from fields in BigQuery's JSON schema format."""
+    avro_types = {
+        "STRING": "string",
+        "BOOL": "boolean",
+        "BOOLEAN": "boolean",
+        "INTEGER": "long",
+        "INT64": "long",
+        "TIMESTAMP": {"type": "long", "logicalType": "timestamp-micros"},
+    }
+
+    def to_avro_type(field):
+        if field["type"] == "RECORD":
+            # Avro needs a unique name for every nested record.
+            return to_avro_schema(field["fields"], f"{name}_{field['name']}")
+        return avro_types[field["type"]]
+
+    return {
+        "type": "record",
+        "name": name,
+        "fields": [{"name": field["name"], "type": ["null", to_avro_type(field)],
+                    "default": None}
+                   for field in fields],
+    }
+
+
+class ColumnarLoadSink:
+    """
+    ColumnarLoadSink(client, table_id, fields, load_format, spool_dir=None)
+
+    Writes parsed records to a Parquet or Avro spool file, one row group or block per `write`
+    call, with nested RECORD fields such as `text_data` or `metavariables` as native struct
+    columns. The file is loaded into a day partition with a single job on `close`.
+
+    Parameters
+    ----------
+    client : google.cloud.bigquery.Client()
+        The BigQuery client that allows the sink to update the tables.
+    table_id : str
+        The partition loaded into, e.g. `project.dataset.messages$20210726`.
+    fields : list of dicts
+        The schema of the table in BigQuery's JSON schema format.
+    load_format : str
+        Either `parquet`, which needs pyarrow, or `avro`, which needs fastavro.
+    spool_dir : str, optional
+        Where the spool file is written. Defaults to the temp dir.
+    """
+
+    def __init__(self, client, table_id, fields, load_format, spool_dir=None):
+        self.client = client
+        self.table_id = table_id
+        self.fields = fields
+        self.load_format = load_format
+        self.num_rows = 0
+        spool_fd, self.spool_path = tempfile.mkstemp(suffix=f".{load_format}", dir=spool_dir)
+        os.close(spool_fd)
+        if load_format == "parquet":
+            if pa is None:
+                raise ImportError("The parquet load format requires the pyarrow package.")
+            self._arrow_schema = to_arrow_schema(fields)
+            self._writer = pq.ParquetWriter(self.spool_path, self._arrow_schema,
+                                            compression="snappy")
+        elif load_format == "avro":
+            if AvroWriter is None:
+                raise ImportError("The avro load format requires the fastavro package.")
+            self._spool = open(self.spool_path, "wb")
+            self._writer = AvroWriter(self._spool, parse_schema(to_avro_schema(fields, "row")),
+                                      codec="deflate")
+        else:
+            raise ValueError(f"'{load_format}' is not a recognized columnar format.")
+
+    def write(self, records):
+        """Appends records to the spool file as one row group."""
+        coerced = [coerce_record(record, self.fields) for record in records]
+        if self.load_format == "parquet":
+            if coerced:
+                self._writer.write_table(pa.Table.from_pylist(coerced, self._arrow_schema))
+        else:
+            for record in coerced:
+                self._writer.write(record)
+            self._writer.flush()
+        self.num_rows += len(records)
+
+    def close(self):
+        """Loads the spool file into the partition, replacing it, and deletes the file."""
+        if self.load_format == "parquet":
+            self._writer.close()
+            source_format = bigquery.SourceFormat.PARQUET
+        else:
+            self._writer.flush()
+            self._spool.close()
+            source_format = bigquery.SourceFormat.AVRO
+        # Ensures idempotence by deleting old partitions before write
+        job_config = bigquery.job.LoadJobConfig(
+            source_format=source_format,
+            use_avro_logical_types=True,
+            write_disposition="WRITE_TRUNCATE",
+        )
+        log.info("Sending %d rows (%d %s bytes) to bigquery table %s.", self.num_rows,
+                 os.path.getsize(self.spool_path), self.load_format, self.table_id)
+        load_spool_file(self.client, self.spool_path, self.table_id, job_config)
+        log.info("Data load to BigQuery complete.")
+
+    def abort(self):
+        """Deletes the spool file without loading it, leaving the partition as it was."""
+        if self.load_format == "parquet":
+            self._writer.close()
+        else:
+            self._spool.close()
+        remove_spool_file(self.spool_path)
@@ -0,0 +1,59 @@
+"""Reads the DAG config without hitting the Airflow metadata DB on every DAG file parse.
+
+This module is imported while the scheduler parses `ada_to_bq.py`, so it only uses the standard
+library.
+"""
+import json
+import logging as log
+import os
+import tempfile
+import time
+
+
+CONFIG_VARIABLE = "ada_data_etl_config"
+CONFIG_CACHE_PATH = os.path.join(tempfile.gettempdir(), "ada_data_etl_config.cache.json")
+# Config changes reach the DAG structure within this many seconds.
+CONFIG_CACHE_TTL = 300
+
+
+def get_dag_config(variable_get, cache_path=CONFIG_CACHE_PATH, ttl=CONFIG_CACHE_TTL,
+                   clock=time.time):
+    """
+    get_dag_config(variable_get, cache_path=CONFIG_CACHE_PATH, ttl=CONFIG_CACHE_TTL,
+                   clock=time.time)
+
+    Returns the `ada_data_etl_config` Variable, from a local copy while it is younger than
+    `ttl`. Only the non-secret config is cached. The API keys are read by the tasks at run time.
+
+    Parameters
+    ----------
+    variable_get : function
+        Reads an Airflow Variable, i.e. `airflow.models.Variable.get`.
+    cache_path : str
+        Where the local copy is kept.
+    ttl : float
+        The age in seconds after which the Variable is read again.
+    clock : function
+        Returns the current time in seconds.
+
+    Returns
+    -------
+    dict
+    """
+
+    try:
+        if clock() - os.path.getmtime(cache_path) < ttl:
+            with open(cache_path) as cache_file:
+                return json.load(cache_file)
+    except (OSError, ValueError):
+        pass
+    config_str = variable_get(CONFIG_VARIABLE)
+    conf = json.loads(config_str)
+    try:
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(cache_path))
+        with os.fdopen(fd, "w") as tmp_file:
+            tmp_file.write(config_str)
+        os.replace(tmp_path, cache_path)
+    except OSError as err:
+        log.warning("Could not cache the DAG config: %s", err)
+    return conf
@@ -0,0 +1,96 @@
+import hashlib
+import logging as log
+import re
+
+OBJECT_ID_PATTERN = re.compile(r"[0-9a-f]{24}\Z")
+
+
+def record_key(record_id):
+    """
+    record_key(record_id)
+
+    Returns the integer a record id is indexed by. A Mongo ObjectId, which is how Ada ids look,
+    is read as the 96-bit number it encodes, so distinct ids never share a key. Any other id is
+    hashed to 128 bits, where a collision within a load is not a practical concern.
+
+    Parameters
+    ----------
+    record_id : str
+
+    Returns
+    -------
+    int
+    """
+
+    if OBJECT_ID_PATTERN.match(record_id):
+        return int(record_id, 16)
+    return int.from_bytes(hashlib.blake2b(record_id.encode("utf-8"), digest_size=16).digest(),
+                          "big")
+
+
+class DedupIndex:
+    """
+    DedupIndex()
+
+    The ids of the records seen so far, as a set of integers rather than of id strings, which
+    takes about 80 bytes per id instead of 115. Records without an `_id` are always kept.
+    """
+
+    def __init__(self):
+        self._keys = set()
+        self.num_seen = 0
+        self.num_dropped = 0
+
+    def __len__(self):
+        return len(self._keys)
+
+    def filter_page(self, page):
+        """Returns the records of `page` whose `_id` was not seen before, in order."""
+        kept = []
+        for record in page:
+            record_id = record.get("_id")
+            if record_id is not None:
+                key = record_key(record_id)
+                if key in self._keys:
+                    continue
+                self._keys.add(key)
+            kept.append(record)
+        self.num_seen += len(page)
+        self.num_dropped += len(page) - len(kept)
+        return kept
+
+
+def dedup_pages(pages, api_type, index=None):
+    """
+    dedup_pages(pages, api_type, index=None)
+
+    Drops records whose `_id` already came up in an earlier page or in the same one, which
+    happens when pages shift while the API is paginated or when windows overlap or are retried.
+    Runs as the pages stream in, ahead of the parse and DLP, and logs the number dropped.
+
+    Parameters
+    ----------
+    pages : iterable of lists of dicts
+        The raw API records, page by page. It can be a generator.
+    api_type : str
+        Either `messages` or `conversations`, for the log.
+    index : DedupIndex, optional
+        The ids seen so far. Pass the same index to deduplicate across several calls.
+
+    Yields
+    ------
+    list of dicts
+        The pages without the repeated records.
+    """
+
+    index = DedupIndex() if index is None else index
+    num_dropped = index.num_dropped
+    for page in pages:
+        page = index.filter_page(page)
+        if page:
+            yield page
+    if index.num_dropped > num_dropped:
+        log.warning("Dropped %d duplicate %s records out of %d.", index.num_dropped - num_dropped,
+                    api_type, index.num_seen)
+    else:
+        log.info("No duplicate %s records among %d.", api_type, index.num_seen)
@@ -0,0 +1,479 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import json
+import logging as log
+import os
+import random
+import sqlite3
+import tempfile
+import threading
+import time
+
+from google.api_core.exceptions import ResourceExhausted
+from google.cloud import dlp_v2
+
+from pii_prefilter import PiiPrefilter
+from rate_limiter import TokenBucket, get_shared_bucket
+
+
+# deidentify_content rejects requests over 0.5 MB, so batches are packed below that with some
+# headroom left for the protobuf framing of each table cell.
+MAX_BATCH_BYTES = 400000
+MAX_BATCH_ROWS = 10000
+
+INFO_TYPES = (
+    "CREDIT_CARD_NUMBER",
+    "EMAIL_ADDRESS",
+    "FIRST_NAME",
+    "LAST_NAME",
+    "PERSON_NAME",
+    "PHONE_NUMBER",
+    "STREET_ADDRESS",
+)
+
+INSPECT_CONFIG = {
+    "info_types": [{"name": info_type} for info_type in INFO_TYPES],
+    "min_likelihood": "UNLIKELY",
+}
+
+DEIDENTIFY_CONFIG = {
+    "info_type_transformations": {
+        "transformations": [
+            {
+                "primitive_transformation": {
+                    "replace_with_info_type_config": {},
+                },
+            },
+        ],
+    },
+}
+
+# Changing the info types or the transformation changes every cache key, so stale results are
+# never served after a config change.
+CONFIG_FINGERPRINT = hashlib.sha256(
+    json.dumps([INSPECT_CONFIG, DEIDENTIFY_CONFIG], sort_keys=True).encode("utf-8")).hexdigest()
+
+DEFAULT_CACHE_MAX_ENTRIES = 100000
+# The on-disk store is trimmed to this many rows, and to rows younger than this, when opened.
+DEFAULT_DISK_CACHE_MAX_ENTRIES = 1000000
+DEFAULT_DISK_CACHE_MAX_AGE_DAYS = 30
+# How long a write waits for another task's transaction on the same file before failing.
+SQLITE_TIMEOUT = 30
+
+# The default DLP quota is 600 content requests per minute per project.
+DEFAULT_REQUESTS_PER_MINUTE = 600
+MAX_RETRIES = 5
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 32.0
+
+_dlp_client = None
+
+
+def get_dlp_client():
+    """Returns the DLP client shared by every de-identification call in this process."""
+    global _dlp_client
+    if _dlp_client is None:
+        _dlp_client = dlp_v2.DlpServiceClient()
+    return _dlp_client
+
+
+def pack_batches(strings, max_bytes=MAX_BATCH_BYTES, max_rows=MAX_BATCH_ROWS):
+    """
+    pack_batches(strings, max_bytes=MAX_BATCH_BYTES, max_rows=MAX_BATCH_ROWS)
+
+    Splits a list of strings into consecutive batches that fit in a single DLP request.
+
+    Parameters
+    ----------
+    strings : list of str
+        The strings to de-identify, in order.
+    max_bytes : int
+        The maximum number of UTF-8 bytes of text in one batch.
+    max_rows : int
+        The maximum number of strings in one batch.
+
+    Returns
+    -------
+    list of list of str
+        The batches, in the same order as `strings`. A string larger than `max_bytes` is placed
+        in a batch of its own.
+    """
+
+    batches = []
+    batch = []
+    batch_bytes = 0
+    for string in strings:
+        string_bytes = len(string.encode("utf-8"))
+        if batch and (batch_bytes + string_bytes > max_bytes or len(batch) >= max_rows):
+            batches.append(batch)
+            batch = []
+            batch_bytes = 0
+        batch.append(string)
+        batch_bytes += string_bytes
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def default_cache_path():
+    """Returns the location of the on-disk de-identification cache in the worker's temp dir."""
+    return os.path.join(tempfile.gettempdir(), "ada_dlp_cache.sqlite")
+
+
+class DeidentifyCache:
+    """
+    DeidentifyCache(max_entries=DEFAULT_CACHE_MAX_ENTRIES, path=None,
+                    disk_max_entries=DEFAULT_DISK_CACHE_MAX_ENTRIES,
+                    disk_max_age_days=DEFAULT_DISK_CACHE_MAX_AGE_DAYS, clock=time.time)
+
+    Memoizes de-identified strings, keyed by a hash of the input string and the DLP config.
+
+    Lookups go to a bounded in-memory LRU first and then to an optional sqlite store, which
+    outlives the process so that repeated texts are only sent to DLP once across DAG runs. The
+    store is bounded too: when a cache opens it, rows older than `disk_max_age_days` are deleted,
+    then the oldest rows beyond `disk_max_entries`. Tasks running at the same time on a worker
+    share the file, so it is opened in WAL mode, where readers do not block the writer, and a
+    writer waits up to `SQLITE_TIMEOUT` seconds for another's transaction.
+
+    Parameters
+    ----------
+    max_entries : int
+        The maximum number of entries held in memory.
+    path : str, optional
+        The sqlite file used as the persistent store. Only the in-memory LRU is used when no path
+        is given.
+    disk_max_entries : int
+        The maximum number of rows kept in the sqlite store.
+    disk_max_age_days : float
+        The number of days a row is kept in the sqlite store after DLP returned it.
+    clock : function
+        Returns the current time in seconds since the epoch.
+    """
+
+    def __init__(self, max_entries=DEFAULT_CACHE_MAX_ENTRIES, path=None,
+                 disk_max_entries=DEFAULT_DISK_CACHE_MAX_ENTRIES,
+                 disk_max_age_days=DEFAULT_DISK_CACHE_MAX_AGE_DAYS, clock=time.time):
+        self.max_entries = max_entries
+        self.path = path
+        self.disk_max_entries = disk_max_entries
+        self.disk_max_age_days = disk_max_age_days
+        self.clock = clock
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._db = None
+        if path:
+            self._db = sqlite3.connect(path, timeout=SQLITE_TIMEOUT)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS dlp_cache "
+                             "(key TEXT PRIMARY KEY, value TEXT, created_at REAL)")
+            columns = [row[1] for row in self._db.execute("PRAGMA table_info(dlp_cache)")]
+            if "created_at" not in columns:
+                # A store written before rows were dated. Its rows have no age and are evicted.
+                self._db.execute("ALTER TABLE dlp_cache ADD COLUMN created_at REAL")
+            self._db.execute(
+                "CREATE INDEX IF NOT EXISTS dlp_cache_created_at ON dlp_cache (created_at)")
+            self._db.commit()
+            self.evict()
+
+    def evict(self):
+        """
+        evict()
+
+        Deletes the rows of the sqlite store that are older than `disk_max_age_days`, then the
+        oldest rows beyond `disk_max_entries`.
+
+        Returns
+        -------
+        int
+            The number of rows deleted.
+        """
+
+        if self._db is None:
+            return 0
+        cutoff = self.clock() - self.disk_max_age_days * 86400
+        num_deleted = self._db.execute(
+            "DELETE FROM dlp_cache WHERE created_at IS NULL OR created_at < ?",
+            (cutoff,)).rowcount
+        num_deleted += self._db.execute(
+            "DELETE FROM dlp_cache WHERE key IN "
+            "(SELECT key FROM dlp_cache ORDER BY created_at DESC LIMIT -1 OFFSET ?)",
+            (self.disk_max_entries,)).rowcount
+        self._db.commit()
+        if num_deleted:
+            log.info("DLP cache: evicted %d rows from %s.", num_deleted, self.path)
+        return num_deleted
+
+    @staticmethod
+    def make_key(string):
+        """Returns the cache key of a string under the current DLP config."""
+        return hashlib.sha256(f"{CONFIG_FINGERPRINT}:{string}".encode("utf-8")).hexdigest()
+
+    def get_many(self, strings):
+        """
+        get_many(strings)
+
+        Looks up a list of distinct strings.
+
+        Parameters
+        ----------
+        strings : list of str
+
+        Returns
+        -------
+        dict
+            The cached de-identified value of every string that was found, keyed by string.
+        """
+
+        found = {}
+        disk_keys = {}
+        for string in strings:
+            key = self.make_key(string)
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                found[string] = self._entries[key]
+                self.memory_hits += 1
+            else:
+                disk_keys[key] = string
+        if self._db is not None and disk_keys:
+            keys = list(disk_keys)
+            # Stay below sqlite's limit on the number of bound parameters.
+            for i in range(0, len(keys), 500):
+                chunk = keys[i:i + 500]
+                rows = self._db.execute(
+                    f"SELECT key, value FROM dlp_cache WHERE key IN ({','.join('?' * len(chunk))})",
+                    chunk).fetchall()
+                for key, value in rows:
+                    found[disk_keys[key]] = value
+                    self._remember(key, value)
+                    self.disk_hits += 1
+        self.misses += len(strings) - len(found)
+        return found
+
+    def put_many(self, results):
+        """Stores a dict of de-identified values keyed by their input string."""
+        entries = [(self.make_key(string), value) for string, value in results.items()]
+        for key, value in entries:
+            self._remember(key, value)
+        if self._db is not None and entries:
+            created_at = self.clock()
+            self._db.executemany(
+                "INSERT OR REPLACE INTO dlp_cache (key, value, created_at) VALUES (?, ?, ?)",
+                [(key, value, created_at) for key, value in entries])
+            self._db.commit()
+
+    def log_stats(self):
+        """Logs how many lookups were answered without calling DLP."""
+        log.info("DLP cache: %d memory hits, %d disk hits, %d misses. %d API lookups saved.",
+                 self.memory_hits, self.disk_hits, self.misses, self.memory_hits + self.disk_hits)
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def _remember(self, key, value):
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+
+class BatchDeidentifier:
+    """
+    BatchDeidentifier(project, client=None, cache=None, prefilter=None,
+                      max_batch_bytes=MAX_BATCH_BYTES,
+                      max_batch_rows=MAX_BATCH_ROWS, max_workers=1,
+                      requests_per_minute=DEFAULT_REQUESTS_PER_MINUTE, rate_limiter=None)
+
+    Collects strings that need de-identification while records are being parsed and sends them
+    to the Data Loss Prevention API as table-shaped batches once parsing is done.
+
+    With more than one worker, batches are sent concurrently from a thread pool. Every request
+    first takes a token from a limiter shared by the workers, so the project's DLP quota is not
+    exceeded, and RESOURCE_EXHAUSTED errors are retried with exponential backoff. Results are
+    always returned in input order.
+
+    Parameters
+    ----------
+    project : str
+        The GCP project the DLP requests are billed to.
+    client : google.cloud.dlp_v2.DlpServiceClient, optional
+        The client used for every request. Defaults to the process-wide client.
+    cache : DeidentifyCache, optional
+        Consulted before any string is sent to DLP, and filled with the results.
+    prefilter : pii_prefilter.PiiPrefilter, optional
+        Strings it rules out as PII-free are returned unchanged without calling DLP.
+    max_batch_bytes : int
+        The maximum number of bytes of text sent in one request.
+    max_batch_rows : int
+        The maximum number of table rows sent in one request.
+    max_workers : int
+        The number of requests in flight at once.
+    requests_per_minute : int, optional
+        The DLP request quota to stay under. No limit is applied when it is None.
+    rate_limiter : rate_limiter.TokenBucket, optional
+        A limiter shared with other de-identifiers that spend the same quota. Defaults to one
+        of this de-identifier's own at `requests_per_minute`.
+    """
+
+    def __init__(self, project, client=None, cache=None, prefilter=None,
+                 max_batch_bytes=MAX_BATCH_BYTES, max_batch_rows=MAX_BATCH_ROWS, max_workers=1,
+                 requests_per_minute=DEFAULT_REQUESTS_PER_MINUTE, rate_limiter=None):
+        self.project = project
+        self.client = client
+        self.cache = cache
+        self.prefilter = prefilter
+        self.max_batch_bytes = max_batch_bytes
+        self.max_batch_rows = max_batch_rows
+        self.max_workers = max_workers
+        if rate_limiter is None and requests_per_minute:
+            rate_limiter = TokenBucket(requests_per_minute / 60)
+        self.rate_limiter = rate_limiter
+        self.num_requests = 0
+        self.num_retries = 0
+        self.num_prefiltered = 0
+        self._pending = []
+        self._stats_lock = threading.Lock()
+
+    def enqueue(self, record, key):
+        """Marks `record[key]` to be replaced by its de-identified value on the next flush."""
+        if record[key]:
+            self._pending.append((record, key))
+
+    def allow(self, texts):
+        """Tells the prefilter that `texts` are known to be free of PII."""
+        if self.prefilter:
+            self.prefilter.allow(texts)
+
+    def flush(self):
+        """De-identifies every enqueued value and writes the results back into their records."""
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, []
+        results = self.deidentify_many([record[key] for record, key in pending])
+        for (record, key), result in zip(pending, results):
+            record[key] = result
+        log.info("De-identified %d strings in %d DLP requests. "
+                 "%d strings skipped by the prefilter.",
+                 len(pending), self.num_requests, self.num_prefiltered)
+
+    def deidentify_many(self, strings):
+        """
+        deidentify_many(strings)
+
+        De-identifies a list of strings, sending each distinct non-empty string that is not
+        already cached or ruled out by the prefilter to DLP once.
+
+        Parameters
+        ----------
+        strings : list of str
+
+        Returns
+        -------
+        list of str
+            The de-identified strings, in the same order as `strings`. Empty values are returned
+            unchanged.
+        """
+
+        unique_strings = list(dict.fromkeys(string for string in strings if string))
+        results = {}
+        if self.prefilter:
+            results = {string: string for string in unique_strings
+                       if not self.prefilter.might_contain_pii(string)}
+            self.num_prefiltered += len(results)
+            unique_strings = [string for string in unique_strings if string not in results]
+        if self.cache:
+            results.update(self.cache.get_many(unique_strings))
+        new_results = {}
+        uncached_strings = [string for string in unique_strings if string not in results]
+        batches = pack_batches(uncached_strings, self.max_batch_bytes, self.max_batch_rows)
+        if self.max_workers > 1 and len(batches) > 1:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                batch_results = list(executor.map(self._deidentify_batch, batches))
+        else:
+            batch_results = [self._deidentify_batch(batch) for batch in batches]
+        for batch, deidentified_batch in zip(batches, batch_results):
+            new_results.update(zip(batch, deidentified_batch))
+        if self.cache:
+            self.cache.put_many(new_results)
+        results.update(new_results)
+        return [results[string] if string else string for string in strings]
+
+    def close(self):
+        """Logs the cache statistics and releases the cache."""
+        if self.cache:
+            self.cache.log_stats()
+            self.cache.close()
+
+    def _deidentify_batch(self, batch):
+        if len(batch) == 1:
+            return [self._call_dlp({"value": batch[0]}).item.value]
+        table = {
+            "headers": [{"name": "text"}],
+            "rows": [{"values": [{"string_value": string}]} for string in batch],
+        }
+        response = self._call_dlp({"table": table})
+        return [row.values[0].string_value for row in response.item.table.rows]
+
+    def _call_dlp(self, item):
+        client = self.client or get_dlp_client()
+        request = {
+            "parent": f"projects/{self.project}",
+            "deidentify_config": DEIDENTIFY_CONFIG,
+            "inspect_config": INSPECT_CONFIG,
+            "item": item,
+        }
+        for attempt in range(MAX_RETRIES + 1):
+            if self.rate_limiter:
+                self.rate_limiter.acquire()
+            with self._stats_lock:
+                self.num_requests += 1
+            try:
+                return client.deidentify_content(request=request)
+            except ResourceExhausted as err:
+                if attempt == MAX_RETRIES:
+                    raise err
+                delay = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt)
+                delay *= random.uniform(0.5, 1)
+                log.warning("DLP quota exhausted, retrying in %.1f seconds: %s", delay, err)
+                with self._stats_lock:
+                    self.num_retries += 1
+                time.sleep(delay)
+
+
+def deidentifier_from_config(conf):
+    """
+    deidentifier_from_config(conf)
+
+    Builds the de-identifier used by the ETL from the `ada_data_etl_config` variable.
+
+    Parameters
+    ----------
+    conf : dict
+        The DAG config. `bq_project` is billed for DLP, and the optional `dlp_*` keys set the
+        cache, prefilter, worker and quota options.
+
+    Returns
+    -------
+    BatchDeidentifier
+    """
+
+    cache = DeidentifyCache(
+        max_entries=conf.get("dlp_cache_max_entries", DEFAULT_CACHE_MAX_ENTRIES),
+        path=default_cache_path() if conf.get("dlp_cache_persist") else None,
+        disk_max_entries=conf.get("dlp_cache_disk_max_entries", DEFAULT_DISK_CACHE_MAX_ENTRIES),
+        disk_max_age_days=conf.get("dlp_cache_max_age_days", DEFAULT_DISK_CACHE_MAX_AGE_DAYS))
+    prefilter_mode = conf.get("dlp_prefilter_mode")
+    requests_per_minute = conf.get("dlp_requests_per_minute", DEFAULT_REQUESTS_PER_MINUTE)
+    return BatchDeidentifier(
+        conf.get("bq_project"),
+        cache=cache,
+        prefilter=PiiPrefilter(prefilter_mode) if prefilter_mode else None,
+        max_workers=conf.get("dlp_max_workers", 1),
+        requests_per_minute=requests_per_minute,
+        # The quota is per project, so every de-identifier in the process shares one limiter.
+        rate_limiter=(get_shared_bucket(f"dlp:{conf.get('bq_project')}", requests_per_minute / 60)
+                      if requests_per_minute else None))
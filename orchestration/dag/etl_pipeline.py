@@ -0,0 +1,85 @@
+from functools import partial
+import logging as log
+
+from bq_loader import (DEFAULT_LOAD_WORKERS, DEFAULT_UPLOAD_CHUNK_ROWS, make_load_sink,
+                       partition_table_id)
+from dedup_index import dedup_pages
+from deidentify_ada_data import deidentifier_from_config
+from json_codec import DEFAULT_OBJ_FORMAT
+from parallel_parse import DEFAULT_PARSE_WORKERS, parse_api_data_parallel
+from parse_ada_data import DEFAULT_CHUNK_SIZE, DEFAULT_RECORD_FORMAT, parse_api_data
+from parse_ada_data_arrow import parse_api_data_arrow
+
+PARSE_ENGINES = {"python": parse_api_data, "arrow": parse_api_data_arrow}
+
+
+def parse_and_load_pages(pages, api_type, bq_client, start_time, conf, table_id=None):
+    """
+    parse_and_load_pages(pages, api_type, bq_client, start_time, conf, table_id=None)
+
+    Drops repeated records, then de-identifies and parses records as they arrive in chunks of
+    `load_chunk_size` rows, so memory use is bounded by the chunk size, and loads them into
+    their day partition in the configured `load_format`. With `parse_workers` above 1, chunks
+    are parsed in that many worker processes while DLP runs in this one. With `load_workers`
+    above 1, an `ndjson` load is uploaded by that many concurrent jobs. With `record_format`
+    `slots`, the python parse engine emits compact slotted records instead of dicts.
+
+    Parameters
+    ----------
+    pages : iterable of lists of dicts
+        The raw API records, page by page. It can be a generator.
+    api_type : str
+        Either `messages` or `conversations`.
+    bq_client : google.cloud.bigquery.Client()
+        The BigQuery client that allows the function to update the tables.
+    start_time : datetime
+        The start date of the data. Used to refer to a specific partition.
+    conf : dict
+        The DAG config, see `orchestration/config/ada_data_etl_config.json`.
+    table_id : str, optional
+        The table replaced by the load. Defaults to the day partition of `start_time`.
+
+    Returns
+    -------
+    int
+        The number of rows loaded.
+    """
+
+    parser = PARSE_ENGINES[conf.get("parse_engine", "python")]
+    record_format = conf.get("record_format", DEFAULT_RECORD_FORMAT)
+    if record_format != DEFAULT_RECORD_FORMAT:
+        if parser is not parse_api_data:
+            raise ValueError(f"Record format '{record_format}' needs the python parse engine.")
+        # A partial of a module function, so it can still be sent to the parse workers.
+        parser = partial(parse_api_data, record_format=record_format)
+    deidentifier = deidentifier_from_config(conf)
+    table_id = table_id or partition_table_id(conf.get("bq_project"), conf.get("dataset"),
+                                              api_type, start_time)
+    try:
+        sink = make_load_sink(conf.get("load_format", "json"), bq_client, api_type, table_id,
+                              load_workers=conf.get("load_workers", DEFAULT_LOAD_WORKERS),
+                              upload_chunk_rows=conf.get("upload_chunk_rows",
+                                                         DEFAULT_UPLOAD_CHUNK_ROWS))
+        parsed_chunks = parse_api_data_parallel(
+            dedup_pages(pages, api_type), api_type, conf.get("bq_project"), deidentifier,
+            conf.get("load_chunk_size", DEFAULT_CHUNK_SIZE),
+            parser,
+            conf.get("obj_format", DEFAULT_OBJ_FORMAT),
+            conf.get("parse_workers", DEFAULT_PARSE_WORKERS))
+        num_rows = 0
+        try:
+            for parsed_chunk in parsed_chunks:
+                sink.write(parsed_chunk)
+                num_rows += len(parsed_chunk)
+            sink.close()
+        except Exception:
+            # A failed fetch, parse or load leaves no spool file, upload or staging table behind.
+            sink.abort()
+            raise
+        finally:
+            # Stops the parse workers.
+            parsed_chunks.close()
+    finally:
+        deidentifier.close()
+    log.info("Loaded %d %s rows into %s.", num_rows, api_type, table_id)
+    return num_rows
@@ -0,0 +1,155 @@
+import gzip
+import logging as log
+import os
+import shutil
+import tempfile
+import time
+
+from json_codec import dumps, loads
+
+
+STATE_FILE = "state.json"
+# Checkpoints of windows that failed and were never rerun are deleted after this long.
+DEFAULT_CHECKPOINT_MAX_AGE_DAYS = 3
+
+
+def atomic_write(path, data):
+    """Writes bytes to `path` through a temp file and a rename, so readers never see a partial
+    file even if the process dies mid-write."""
+    directory = os.path.dirname(path)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as tmp_file:
+            tmp_file.write(data)
+            tmp_file.flush()
+            os.fsync(tmp_file.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+class PageCheckpoint:
+    """
+    PageCheckpoint(checkpoint_dir, api_type, start_time, end_time)
+
+    Persists the pages of one time window of one endpoint as they are fetched, together with the
+    `next_page_uri` to continue from, so a failed task that is run again resumes after the last
+    completed page instead of paging through the whole window from `created_since`.
+
+    Each page is written to `<checkpoint_dir>/<api_type>/<window>/<n>.json.gz` before the state
+    file records it, both with atomic renames, so a crash at any point leaves a consistent
+    checkpoint. `clear` deletes the window once its data is loaded.
+
+    The pages hold the raw, not yet de-identified, records. A window that is never loaded is
+    only deleted by `purge_stale_checkpoints`, see "Fetch Checkpoints" in the README.
+
+    Parameters
+    ----------
+    checkpoint_dir : str
+        The root of the spool, a local disk or a mounted bucket that outlives the task.
+    api_type : str
+        Either `conversations` or `messages`.
+    start_time : datetime
+        The start of the window.
+    end_time : datetime
+        The end of the window.
+    """
+
+    def __init__(self, checkpoint_dir, api_type, start_time, end_time):
+        time_format = "%Y%m%dT%H%M%S%f"
+        self.path = os.path.join(checkpoint_dir, api_type,
+                                 f"{start_time.strftime(time_format)}_"
+                                 f"{end_time.strftime(time_format)}")
+        os.makedirs(self.path, exist_ok=True)
+        self.num_pages, self.next_page_uri, self.is_complete = 0, None, False
+        state_path = os.path.join(self.path, STATE_FILE)
+        if os.path.exists(state_path):
+            with open(state_path, "rb") as state_file:
+                state = loads(state_file.read())
+            self.num_pages = state["num_pages"]
+            self.next_page_uri = state["next_page_uri"]
+            self.is_complete = self.next_page_uri is None
+
+    def _page_path(self, page_num):
+        return os.path.join(self.path, f"{page_num:06d}.json.gz")
+
+    def stored_pages(self):
+        """Yields the pages saved by earlier attempts, in order."""
+        if self.num_pages:
+            log.info("Resuming from checkpoint %s after %d pages.", self.path, self.num_pages)
+        for page_num in range(self.num_pages):
+            with gzip.open(self._page_path(page_num), "rb") as page_file:
+                yield loads(page_file.read())
+
+    def resume_uri(self, first_page_uri):
+        """Returns the uri to fetch next: the first page, the saved one, or None when done."""
+        if not self.num_pages:
+            return first_page_uri
+        return self.next_page_uri
+
+    def save_page(self, page, next_page_uri):
+        """Persists a fetched page and the uri of the page after it."""
+        atomic_write(self._page_path(self.num_pages),
+                     gzip.compress(dumps(page).encode("utf-8"), compresslevel=1))
+        self.num_pages += 1
+        self.next_page_uri = next_page_uri
+        self.is_complete = next_page_uri is None
+        atomic_write(os.path.join(self.path, STATE_FILE),
+                     dumps({"num_pages": self.num_pages,
+                            "next_page_uri": next_page_uri}).encode("utf-8"))
+
+    def clear(self):
+        """Deletes the checkpoint, once the window's data is safely loaded."""
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
+def window_checkpoints(checkpoint_dir, api_type, windows):
+    """Returns a PageCheckpoint per `(start_time, end_time)` window, or Nones when
+    `checkpoint_dir` is not set."""
+    if not checkpoint_dir:
+        return [None] * len(windows)
+    return [PageCheckpoint(checkpoint_dir, api_type, *window) for window in windows]
+
+
+def purge_stale_checkpoints(checkpoint_dir, max_age_days=DEFAULT_CHECKPOINT_MAX_AGE_DAYS,
+                            clock=time.time):
+    """
+    purge_stale_checkpoints(checkpoint_dir, max_age_days=DEFAULT_CHECKPOINT_MAX_AGE_DAYS,
+                            clock=time.time)
+
+    Deletes the window checkpoints under `checkpoint_dir` that were last written more than
+    `max_age_days` ago, left by tasks that failed and were not run again. Run when a task
+    starts, so raw pages do not outlive the retries they are kept for.
+
+    Parameters
+    ----------
+    checkpoint_dir : str
+        The root of the spool.
+    max_age_days : float
+        The number of days a checkpoint is kept after its last page was saved.
+    clock : function
+        Returns the current time in seconds since the epoch.
+
+    Returns
+    -------
+    int
+        The number of checkpoints deleted.
+    """
+
+    cutoff = clock() - max_age_days * 86400
+    num_deleted = 0
+    for api_type in os.listdir(checkpoint_dir) if os.path.isdir(checkpoint_dir) else []:
+        api_type_dir = os.path.join(checkpoint_dir, api_type)
+        for window in os.listdir(api_type_dir):
+            window_dir = os.path.join(api_type_dir, window)
+            files = [os.path.join(window_dir, name) for name in os.listdir(window_dir)]
+            last_written = max([os.path.getmtime(path) for path in files]
+                               + [os.path.getmtime(window_dir)])
+            if last_written < cutoff:
+                shutil.rmtree(window_dir, ignore_errors=True)
+                num_deleted += 1
+    if num_deleted:
+        log.warning("Deleted %d checkpoints older than %s days from %s.", num_deleted,
+                    max_age_days, checkpoint_dir)
+    return num_deleted
@@ -0,0 +1,174 @@
+from datetime import datetime
+from datetime import timedelta
+import logging as log
+import os
+
+from google.cloud import bigquery
+
+from ada_client import window_uri
+from etl_pipeline import parse_and_load_pages
+from fetch_checkpoint import atomic_write
+from json_codec import dumps, loads
+from schema_parsers import read_schema_fields
+
+
+# Records are fetched again from this long before the high-water mark, so rows that became
+# visible in the API late are still picked up. The MERGE makes the overlap idempotent.
+DEFAULT_OVERLAP = timedelta(hours=1)
+
+MERGE_KEYS = {"messages": "message_id", "conversations": "conversation_id"}
+# When a row was staged twice, the latest version of it is merged.
+VERSION_COLUMNS = {"messages": "date_created", "conversations": "date_updated"}
+
+
+class SyncState:
+    """
+    SyncState(state_dir)
+
+    Stores the high-water mark of each endpoint, the time up to which its records are synced, as
+    `<state_dir>/<api_type>_high_water_mark.json`. Marks are written atomically, so a failed run
+    leaves the previous mark in place.
+
+    Parameters
+    ----------
+    state_dir : str
+        A local disk or a mounted bucket shared by the workers.
+    """
+
+    def __init__(self, state_dir):
+        self.state_dir = state_dir
+        os.makedirs(state_dir, exist_ok=True)
+
+    def _path(self, api_type):
+        return os.path.join(self.state_dir, f"{api_type}_high_water_mark.json")
+
+    def get(self, api_type):
+        """Returns the high-water mark of `api_type`, or None before its first sync."""
+        if not os.path.exists(self._path(api_type)):
+            return None
+        with open(self._path(api_type), "rb") as state_file:
+            return datetime.strptime(loads(state_file.read())["high_water_mark"],
+                                     "%Y-%m-%dT%H:%M:%S.%f")
+
+    def set(self, api_type, high_water_mark):
+        atomic_write(self._path(api_type), dumps({
+            "high_water_mark": high_water_mark.strftime("%Y-%m-%dT%H:%M:%S.%f"),
+        }).encode("utf-8"))
+
+
+def merge_query(table_id, staging_table_id, api_type, fields, partition_field=None):
+    """
+    merge_query(table_id, staging_table_id, api_type, fields, partition_field=None)
+
+    Builds the MERGE of a staging table into a day-partitioned table. Rows are matched on the
+    endpoint's id, updated when they exist and inserted into the partition of their
+    `date_created` when they do not. The target is only scanned from the `@since_date`
+    partition on, so the bytes billed scale with the new rows rather than the table.
+
+    Parameters
+    ----------
+    table_id : str
+        The partitioned table, e.g. `project.dataset.messages`.
+    staging_table_id : str
+        The table holding the new rows, with the same schema.
+    api_type : str
+        Either `messages` or `conversations`.
+    fields : list of dicts
+        The schema of the table in BigQuery's JSON schema format.
+    partition_field : str, optional
+        The column the table is partitioned on. Defaults to ingestion-time partitioning, which
+        the `$YYYYMMDD` loads of the daily DAG use.
+
+    Returns
+    -------
+    str
+        A standard SQL statement with a `@since_date` DATE parameter.
+    """
+
+    key = MERGE_KEYS[api_type]
+    columns = [field["name"] for field in fields]
+    if partition_field:
+        partition_filter = f"DATE(T.{partition_field}) >= @since_date"
+        insert_columns, insert_values = columns, [f"S.{column}" for column in columns]
+    else:
+        partition_filter = "DATE(T._PARTITIONTIME) >= @since_date"
+        insert_columns = ["_PARTITIONTIME"] + columns
+        insert_values = (["TIMESTAMP_TRUNC(S.date_created, DAY)"]
+                         + [f"S.{column}" for column in columns])
+    updates = ",\n    ".join(f"{column} = S.{column}" for column in columns if column != key)
+    return f"""MERGE `{table_id}` T
+USING (
+  SELECT * EXCEPT (row_num) FROM (
+    SELECT *, ROW_NUMBER() OVER (PARTITION BY {key}
+                                 ORDER BY {VERSION_COLUMNS[api_type]} DESC) AS row_num
+    FROM `{staging_table_id}`)
+  WHERE row_num = 1
+) S
+ON T.{key} = S.{key} AND {partition_filter}
+WHEN MATCHED THEN
+  UPDATE SET
+    {updates}
+WHEN NOT MATCHED THEN
+  INSERT ({", ".join(insert_columns)})
+  VALUES ({", ".join(insert_values)})"""
+
+
+def run_incremental_sync(api_type, ada_client, bq_client, conf, state, now=None,
+                         overlap=DEFAULT_OVERLAP):
+    """
+    run_incremental_sync(api_type, ada_client, bq_client, conf, state, now=None,
+                         overlap=DEFAULT_OVERLAP)
+
+    Fetches the records of an endpoint created since its high-water mark, loads them into
+    `<api_type>_staging` and merges them into the partitioned table, then moves the mark to the
+    end of the fetched window. The first sync of an endpoint starts at midnight of the current
+    day, earlier days being loaded by the daily DAG.
+
+    Parameters
+    ----------
+    api_type : str
+        Either `messages` or `conversations`.
+    ada_client : ada_client.AdaClient
+    bq_client : google.cloud.bigquery.Client()
+    conf : dict
+        The DAG config, see `etl_pipeline.parse_and_load_pages`.
+    state : SyncState
+        Where the high-water marks are kept.
+    now : datetime, optional
+        The end of the fetched window. Defaults to the current UTC time.
+    overlap : timedelta
+        How far before the mark the window starts.
+
+    Returns
+    -------
+    int
+        The number of rows staged.
+    """
+
+    end_time = now or datetime.utcnow()
+    high_water_mark = state.get(api_type)
+    if high_water_mark is None:
+        start_time = end_time.replace(hour=0, minute=0, second=0, microsecond=0)
+    else:
+        start_time = high_water_mark - overlap
+    log.info("Syncing %s created from %s to %s.", api_type, start_time, end_time)
+    dataset_id = f"{conf.get('bq_project')}.{conf.get('dataset')}"
+    staging_table_id = f"{dataset_id}.{api_type}_staging"
+    # The staging table needs the exact schema of the target, so it is never loaded as json.
+    load_format = conf.get("load_format")
+    if load_format not in ("ndjson", "parquet", "avro"):
+        load_format = "ndjson"
+    pages = ada_client.iter_pages(window_uri(api_type, start_time, end_time))
+    num_rows = parse_and_load_pages(pages, api_type, bq_client, start_time,
+                                    dict(conf, load_format=load_format), table_id=staging_table_id)
+    if num_rows:
+        job_config = bigquery.QueryJobConfig(query_parameters=[
+            bigquery.ScalarQueryParameter("since_date", "DATE", start_time.date())])
+        query = merge_query(f"{dataset_id}.{api_type}", staging_table_id, api_type,
+                            read_schema_fields(api_type), conf.get("partition_field"))
+        job = bq_client.query(query, job_config=job_config)
+        job.result()
+        log.info("Merged %d %s rows, %s rows affected, %s bytes billed.", num_rows, api_type,
+                 job.num_dml_affected_rows, job.total_bytes_billed)
+    state.set(api_type, end_time)
+    return num_rows
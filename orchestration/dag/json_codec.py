@@ -0,0 +1,57 @@
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# How the raw API object of a record is stored in the `message_obj`/`conversation_obj` columns.
+# `repr` keeps the historical Python repr of the dict, `json` stores it as real JSON.
+OBJ_FORMATS = ("repr", "json")
+DEFAULT_OBJ_FORMAT = "repr"
+
+
+def loads(data):
+    """Decodes a JSON document from bytes or str, with orjson when it is installed."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def _encode_record(obj):
+    # Slotted records, see `schema_parsers.compile_record_type`, are encoded as their dict.
+    if hasattr(obj, "_asdict"):
+        return obj._asdict()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def dumps(obj):
+    """Encodes an object as compact, non-ASCII-escaped JSON text."""
+    if orjson is not None:
+        return orjson.dumps(obj, default=_encode_record).decode("utf-8")
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"), default=_encode_record)
+
+
+def obj_encoder(obj_format=DEFAULT_OBJ_FORMAT):
+    """
+    obj_encoder(obj_format=DEFAULT_OBJ_FORMAT)
+
+    Returns the function that turns a raw API record into the value of its `*_obj` column.
+
+    Parameters
+    ----------
+    obj_format : str
+        One of `OBJ_FORMATS`.
+
+    Returns
+    -------
+    function
+        Takes a dict and returns a str.
+    """
+
+    if obj_format == "repr":
+        return str
+    if obj_format == "json":
+        return dumps
+    raise ValueError(f"'{obj_format}' is not a recognized obj format.")
@@ -0,0 +1,38 @@
+import logging as log
+import os
+
+from google.api_core.exceptions import BadRequest
+
+
+def load_spool_file(client, spool_path, table_id, job_config):
+    """
+    load_spool_file(client, spool_path, table_id, job_config)
+
+    Loads a spool file into a table with one load job and waits for it. The error of a rejected
+    load is logged before it is raised, and the file is deleted either way.
+
+    Parameters
+    ----------
+    client : google.cloud.bigquery.Client()
+        The BigQuery client that runs the job.
+    spool_path : str
+        The file loaded, in the source format of `job_config`.
+    table_id : str
+        The table or partition loaded into.
+    job_config : google.cloud.bigquery.job.LoadJobConfig
+    """
+
+    try:
+        with open(spool_path, "rb") as spool_file:
+            client.load_table_from_file(spool_file, table_id, job_config=job_config).result()
+    except BadRequest as err:
+        log.debug("BadRequest error: %s", str(err))
+        raise err
+    finally:
+        remove_spool_file(spool_path)
+
+
+def remove_spool_file(spool_path):
+    """Deletes a spool file, if it was not deleted already."""
+    if spool_path is not None and os.path.exists(spool_path):
+        os.remove(spool_path)
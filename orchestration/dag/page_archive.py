@@ -0,0 +1,112 @@
+from datetime import datetime
+from datetime import timedelta
+import gzip
+import hashlib
+import logging as log
+import os
+
+from fetch_checkpoint import atomic_write
+from json_codec import dumps, loads
+
+
+DAY_FORMAT = "%Y%m%d"
+
+
+class PageArchive:
+    """
+    PageArchive(archive_dir)
+
+    A store of raw API pages that lets history be parsed and loaded again without the API.
+
+    Every page is written once as `objects/<sha256[:2]>/<sha256>.json.gz`, named by the hash of
+    its JSON, so a page fetched again by a rerun or a backfill takes no extra space. A manifest
+    per endpoint and day, `manifests/<api_type>/<YYYYMMDD>.json`, lists the day's pages in order
+    and is only written once the whole day was fetched, so a listed day is always complete.
+
+    The pages hold the raw, not yet de-identified, records, so the archive must be kept with the
+    same access controls as the Ada API key, and expired by a lifecycle rule on its bucket, see
+    "Raw Page Archive" in the README. It is off unless `archive_dir` is set.
+
+    Parameters
+    ----------
+    archive_dir : str
+        The root of the archive, a local disk or a mounted bucket.
+    """
+
+    def __init__(self, archive_dir):
+        self.archive_dir = archive_dir
+
+    def _object_path(self, digest):
+        return os.path.join(self.archive_dir, "objects", digest[:2], f"{digest}.json.gz")
+
+    def _manifest_path(self, api_type, day):
+        return os.path.join(self.archive_dir, "manifests", api_type,
+                            f"{day.strftime(DAY_FORMAT)}.json")
+
+    def put_page(self, page):
+        """Stores a page, unless it is already archived, and returns its hash."""
+        data = dumps(page).encode("utf-8")
+        digest = hashlib.sha256(data).hexdigest()
+        path = self._object_path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            atomic_write(path, gzip.compress(data))
+        return digest
+
+    def archive_pages(self, pages, api_type, day):
+        """
+        archive_pages(pages, api_type, day)
+
+        Passes pages through unchanged while archiving them. The day's manifest is written
+        once the last page has gone through.
+
+        Parameters
+        ----------
+        pages : iterable of lists of dicts
+            The pages of one day, in order. It can be a generator.
+        api_type : str
+            Either `messages` or `conversations`.
+        day : datetime
+            The start of the day the pages hold.
+
+        Yields
+        ------
+        list of dicts
+            The same pages.
+        """
+
+        digests = []
+        for page in pages:
+            digests.append(self.put_page(page))
+            yield page
+        path = self._manifest_path(api_type, day)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        atomic_write(path, dumps({"pages": digests}).encode("utf-8"))
+        log.info("Archived %d %s pages for %s.", len(digests), api_type, day.date())
+
+    def has_day(self, api_type, day):
+        return os.path.exists(self._manifest_path(api_type, day))
+
+    def iter_pages(self, api_type, day):
+        """Yields the archived pages of a day, in their original order."""
+        with open(self._manifest_path(api_type, day), "rb") as manifest_file:
+            digests = loads(manifest_file.read())["pages"]
+        for digest in digests:
+            with gzip.open(self._object_path(digest), "rb") as page_file:
+                yield loads(page_file.read())
+
+    def days(self, api_type, start_day, end_day):
+        """Returns the archived days from `start_day` to `end_day` inclusive, in order."""
+        num_days = (end_day - start_day).days + 1
+        candidates = (start_day + timedelta(days=i) for i in range(num_days))
+        return [day for day in candidates if self.has_day(api_type, day)]
+
+
+def parse_day(day_str):
+    """Parses a `YYYY-MM-DD` or `YYYYMMDD` date into the datetime of its midnight."""
+    for fmt in ("%Y-%m-%d", DAY_FORMAT):
+        try:
+            return datetime.strptime(day_str, fmt)
+        except ValueError:
+            pass
+    raise ValueError(f"Issue with date {day_str}: expected YYYY-MM-DD")
@@ -0,0 +1,140 @@
+from collections import deque
+import itertools
+import logging as log
+import multiprocessing
+
+from deidentify_ada_data import BatchDeidentifier
+from json_codec import DEFAULT_OBJ_FORMAT
+from parse_ada_data import DEFAULT_CHUNK_SIZE, parse_api_data
+
+DEFAULT_PARSE_WORKERS = 1
+# Workers are not forked from the task process, which runs DLP, upload and fetch threads whose
+# locks a forked child could inherit held. A multiprocessing.Pool is used rather than a
+# ProcessPoolExecutor, which only takes a start method from Python 3.7.
+MP_START_METHOD = ("forkserver" if "forkserver" in multiprocessing.get_all_start_methods()
+                   else "spawn")
+
+
+class DeferredDeidentifier:
+    """
+    DeferredDeidentifier()
+
+    Stands in for a BatchDeidentifier in a worker process. It records the values that need DLP
+    and the labels known to be free of PII instead of calling the API, so that every DLP request
+    is made by the parent process, under its cache, prefilter and quota.
+    """
+
+    def __init__(self):
+        self.pending = []
+        self.allowed = []
+
+    def enqueue(self, record, key):
+        if record[key]:
+            self.pending.append((record, key))
+
+    def allow(self, texts):
+        self.allowed.extend(texts)
+
+    def flush(self):
+        pass
+
+
+def _parse_chunk(chunk, data_type, project, parser, obj_format):
+    deferred = DeferredDeidentifier()
+    parsed_chunk = parser(chunk, data_type, project, deferred, obj_format)
+    # The records and the pending (record, key) pairs are pickled together, so the pairs still
+    # point into the returned records once they reach the parent.
+    return parsed_chunk, deferred.pending, deferred.allowed
+
+
+def _chunks(pages, chunk_size):
+    # Regroups pages of any size into lists of `chunk_size` records, the last one shorter.
+    chunk = []
+    for page in pages:
+        chunk.extend(page)
+        while len(chunk) >= chunk_size:
+            yield chunk[:chunk_size]
+            chunk = chunk[chunk_size:]
+    if chunk:
+        yield chunk
+
+
+def parse_api_data_parallel(pages, data_type, project, deidentifier=None,
+                            chunk_size=DEFAULT_CHUNK_SIZE, parser=parse_api_data,
+                            obj_format=DEFAULT_OBJ_FORMAT, max_workers=DEFAULT_PARSE_WORKERS):
+    """
+    parse_api_data_parallel(pages, data_type, project, deidentifier=None,
+                            chunk_size=DEFAULT_CHUNK_SIZE, parser=parse_api_data,
+                            obj_format=DEFAULT_OBJ_FORMAT, max_workers=DEFAULT_PARSE_WORKERS)
+
+    Parses pages of API data as they arrive, regrouped into chunks of `chunk_size` records so that
+    memory use does not grow with the number of pages, in a pool of worker processes. Workers
+    return the values that need de-identification along with their records, and the parent sends
+    them to DLP one chunk at a time before yielding the chunk, so chunks come out de-identified
+    and in input order.
+
+    A day that fits in a single chunk, or `max_workers` of 1, is parsed serially in this process
+    without starting a pool.
+
+    Parameters
+    ----------
+    pages : iterable of lists of dicts
+        The records fetched from the API, page by page. It can be a generator.
+    data_type : str
+        Either `messages` or `conversations`.
+    project : str
+        The GCP project the DLP requests are billed to.
+    deidentifier : deidentify_ada_data.BatchDeidentifier, optional
+        Defaults to an uncached de-identifier for `project`.
+    chunk_size : int
+        The number of records parsed by a worker at a time, and yielded at a time.
+    parser : function
+        Parses a chunk, with the same arguments as `parse_ada_data.parse_api_data`.
+    obj_format : str
+        How the raw records are stored in the `*_obj` columns, see `json_codec`.
+    max_workers : int
+        The number of worker processes.
+
+    Yields
+    ------
+    list of dicts
+        Parsed records, at most `chunk_size` at a time.
+    """
+
+    deidentifier = deidentifier or BatchDeidentifier(project)
+    chunks = _chunks(pages, chunk_size)
+    first_chunks = list(itertools.islice(chunks, 2))
+    if max_workers <= 1 or len(first_chunks) < 2:
+        log.info("Parsing %s serially.", data_type)
+        for chunk in itertools.chain(first_chunks, chunks):
+            yield parser(chunk, data_type, project, deidentifier, obj_format)
+        return
+
+    log.info("Parsing %s in %d worker processes.", data_type, max_workers)
+    pool = _start_pool(max_workers)
+    try:
+        # Only a few chunks per worker are in flight, so memory stays bounded on large days.
+        in_flight = deque()
+        for chunk in itertools.chain(first_chunks, chunks):
+            in_flight.append(pool.apply_async(_parse_chunk, (chunk, data_type, project, parser,
+                                                             obj_format)))
+            if len(in_flight) >= 2 * max_workers:
+                yield _deidentify_chunk(in_flight.popleft().get(), deidentifier)
+        while in_flight:
+            yield _deidentify_chunk(in_flight.popleft().get(), deidentifier)
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def _start_pool(max_workers):
+    return multiprocessing.get_context(MP_START_METHOD).Pool(max_workers)
+
+
+def _deidentify_chunk(result, deidentifier):
+    parsed_chunk, pending, allowed = result
+    deidentifier.allow(allowed)
+    for record, key in pending:
+        deidentifier.enqueue(record, key)
+    deidentifier.flush()
+    return parsed_chunk
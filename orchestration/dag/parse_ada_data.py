@@ -1,7 +1,16 @@
+from collections import namedtuple
 import logging as log
 import re
 
-from google.cloud import dlp_v2
+from deidentify_ada_data import BatchDeidentifier
+from json_codec import DEFAULT_OBJ_FORMAT, obj_encoder
+from schema_parsers import (compile_message_data_parsers, compile_record_parser,
+                            compile_record_type, read_schema_fields, record_field)
+
+DEFAULT_CHUNK_SIZE = 10000
+# `dict` parses rows into dicts, `slots` into the compact record types compiled from the schemas.
+RECORD_FORMATS = ("dict", "slots")
+DEFAULT_RECORD_FORMAT = "dict"
 
 
 #########################################
@@ -9,12 +18,15 @@ from google.cloud import dlp_v2
 #               PARSING                 #
 #                                       #
 #########################################
-def parse_api_data(valid_response_data, data_type, project):
+def parse_api_data(valid_response_data, data_type, project, deidentifier=None,
+                   obj_format=DEFAULT_OBJ_FORMAT, record_format=DEFAULT_RECORD_FORMAT):
     log.info("Begin parsing %s data.", data_type)
     if data_type == "conversations":
-        parsed_data = parse_conversation_list(valid_response_data, project)
+        parsed_data = parse_conversation_list(valid_response_data, project, deidentifier,
+                                              obj_format, record_format)
     elif data_type == "messages":
-        parsed_data = parse_message_list(valid_response_data, project)
+        parsed_data = parse_message_list(valid_response_data, project, deidentifier, obj_format,
+                                         record_format)
     else:
         raise Exception(f"Error in parsing: '{data_type}' is not a recognized data type.")
     log.info("Done parsing %s.", data_type)
@@ -32,46 +44,40 @@ def check_int(val):
 #            CONVERSATIONS              #
 #                                       #
 #########################################
-def parse_conversation_list(valid_response_data, project):
-    return [parse_conversation(conversation_data, project)
-            for conversation_data
-            in valid_response_data]
-
-
-def parse_conversation(conversation_response, project):
-    """Parse a single instance of conversation data into a BigQuery readable dict."""
-    return {"conversation_id": conversation_response["_id"],
-            "date_updated": conversation_response["date_updated"].split("+")[0],
-            "date_created": conversation_response["date_created"].split("+")[0],
-            "chatter_id": conversation_response["chatter_id"],
-            "platform": conversation_response["platform"],
-            "is_engaged": conversation_response["is_engaged"],
-            "is_escalated": conversation_response["is_escalated"],
-            "csat": str(conversation_response["csat"]),
-            "variables": parse_conversation_variables(
-                conversation_response["variables"]),
-            "metavariables": parse_conversation_metavars(
-                conversation_response["metavariables"], project),
-            "conversation_obj": str(conversation_response),
-            }
-
-
-def parse_conversation_metavars(conv_metavariables, project):
-    return {
-        "browser": conv_metavariables.get("browser"),
-        "browser_version": conv_metavariables.get("browser_version"),
-        "chattertoken": conv_metavariables.get("chattertoken"),
-        "created": check_int(conv_metavariables.get("created")),
-        "device": conv_metavariables.get("device"),
-        "embed": check_int(conv_metavariables.get("embed")),
-        "followupresponseid": conv_metavariables.get("followupresponseid"),
-        "initialurl": conv_metavariables.get("initialurl"),
-        "introshown": conv_metavariables.get("introshown"),
-        "language": conv_metavariables.get("language"),
-        "last_answer_id": conv_metavariables.get("last_answer_id"),
-        "last_question_asked": deidentify(conv_metavariables.get("last_question_asked"), project),
-        "user_agent": conv_metavariables.get("user_agent"),
-    }
+def parse_conversation_list(valid_response_data, project, deidentifier=None,
+                            obj_format=DEFAULT_OBJ_FORMAT, record_format=DEFAULT_RECORD_FORMAT):
+    deidentifier = deidentifier or BatchDeidentifier(project)
+    encode_obj = obj_encoder(obj_format)
+    parsers = RECORD_PARSERS[record_format]
+    parsed_conversations = [parse_conversation(conversation_data, project, deidentifier,
+                                               encode_obj, parsers)
+                            for conversation_data
+                            in valid_response_data]
+    deidentifier.flush()
+    return parsed_conversations
+
+
+def parse_conversation(conversation_response, project, deidentifier=None, encode_obj=str,
+                       parsers=None):
+    """Parse a single instance of conversation data into a BigQuery readable dict, or into the
+    record type of `parsers`, see `RECORD_PARSERS`.
+    """
+    parsers = parsers or RECORD_PARSERS[DEFAULT_RECORD_FORMAT]
+    conversation = {"conversation_id": conversation_response["_id"],
+                    "date_updated": conversation_response["date_updated"].split("+")[0],
+                    "date_created": conversation_response["date_created"].split("+")[0],
+                    "chatter_id": conversation_response["chatter_id"],
+                    "platform": conversation_response["platform"],
+                    "is_engaged": conversation_response["is_engaged"],
+                    "is_escalated": conversation_response["is_escalated"],
+                    "csat": str(conversation_response["csat"]),
+                    "variables": parsers.variables(conversation_response["variables"]),
+                    "metavariables": parse_conversation_metavars(
+                        conversation_response["metavariables"], project, deidentifier,
+                        parsers.metavariables),
+                    "conversation_obj": encode_obj(conversation_response),
+                    }
+    return conversation if parsers.conversation is dict else parsers.conversation(**conversation)
 
 
 def check_order_num(order_num_string: str) -> int:
@@ -84,12 +90,32 @@ def check_order_num(order_num_string: str) -> int:
     return int(regex_str_found)
 
 
-def parse_conversation_variables(conv_variables):
-    return {
-        "domain_name": conv_variables.get("domain_name"),
-        "lob": conv_variables.get("lob"),
-        "order_number": check_order_num(conv_variables.get("order number")),
-    }
+CONVERSATION_FIELDS = read_schema_fields("conversations")
+
+# Fields of the conversation sub-records that are not copied as is from the API data.
+CONVERSATION_EXTRACTORS = {
+    "variables": {
+        "order_number": lambda conv_variables: check_order_num(conv_variables.get("order number")),
+    },
+    "metavariables": {
+        "created": lambda conv_metavariables: check_int(conv_metavariables.get("created")),
+        "embed": lambda conv_metavariables: check_int(conv_metavariables.get("embed")),
+    },
+}
+parse_conversation_variables = compile_record_parser(
+    record_field(CONVERSATION_FIELDS, "variables"), CONVERSATION_EXTRACTORS["variables"])
+parse_metavars_record = compile_record_parser(
+    record_field(CONVERSATION_FIELDS, "metavariables"), CONVERSATION_EXTRACTORS["metavariables"])
+
+
+def parse_conversation_metavars(conv_metavariables, project, deidentifier=None,
+                                parse_record=parse_metavars_record):
+    metavars = parse_record(conv_metavariables)
+    if deidentifier:
+        deidentifier.enqueue(metavars, "last_question_asked")
+    else:
+        metavars["last_question_asked"] = deidentify(metavars["last_question_asked"], project)
+    return metavars
 
 
 #########################################
@@ -97,115 +123,127 @@ def parse_conversation_variables(conv_variables):
 #              MESSAGES                 #
 #                                       #
 #########################################
-def parse_message_list(valid_response_data, project):
-    return [parse_message(message_data, project)
-            for message_data
-            in valid_response_data]
-
-
-def parse_message(message_response, project):
+def parse_message_list(valid_response_data, project, deidentifier=None,
+                       obj_format=DEFAULT_OBJ_FORMAT, record_format=DEFAULT_RECORD_FORMAT):
+    deidentifier = deidentifier or BatchDeidentifier(project)
+    encode_obj = obj_encoder(obj_format)
+    parsers = RECORD_PARSERS[record_format]
+    parsed_messages = [parse_message(message_data, project, deidentifier, encode_obj, parsers)
+                       for message_data
+                       in valid_response_data]
+    deidentifier.flush()
+    return parsed_messages
+
+
+MESSAGE_FIELDS = read_schema_fields("messages")
+
+# Fields of the `<_type>_data` sub-records that are not copied as is from the API data.
+MESSAGE_DATA_EXTRACTORS = {
+    "text_data": {
+        "body": lambda m_data: m_data.get("body").encode("ascii", "ignore").decode(),
+    },
+    # TODO: Parse quick_replies into separate button records
+    "quick_replies_data": {"quick_replies": lambda m_data: str(m_data.get("quick_replies"))},
+    # TODO: parse subfields of JSON into record
+    "list_selection_data": {"data": lambda m_data: str(m_data.get("data"))},
+    "surfaceable_list_selection_data": {
+        "selectables": lambda m_data: str(m_data.get("selectables")),
+    },
+}
+
+# Maps each message `_type` to its sub-record field and the parser compiled from the schema.
+MESSAGE_DATA_PARSERS = compile_message_data_parsers(MESSAGE_FIELDS, MESSAGE_DATA_EXTRACTORS)
+EMPTY_MESSAGE_DATA = {field: None for field, _ in MESSAGE_DATA_PARSERS.values()}
+
+# The parsers of each record format. With `slots`, rows and their sub-records, such as
+# `text_data` or `metavariables`, are slotted records with one slot per schema field.
+RecordParsers = namedtuple("RecordParsers", ["conversation", "variables", "metavariables",
+                                             "message", "message_data"])
+ConversationRecord = compile_record_type("ConversationRecord", CONVERSATION_FIELDS)
+MessageRecord = compile_record_type("MessageRecord", MESSAGE_FIELDS)
+RECORD_PARSERS = {
+    "dict": RecordParsers(dict, parse_conversation_variables, parse_metavars_record, dict,
+                          MESSAGE_DATA_PARSERS),
+    "slots": RecordParsers(
+        ConversationRecord,
+        compile_record_parser(record_field(CONVERSATION_FIELDS, "variables"),
+                              CONVERSATION_EXTRACTORS["variables"],
+                              ConversationRecord._field_types["variables"]),
+        compile_record_parser(record_field(CONVERSATION_FIELDS, "metavariables"),
+                              CONVERSATION_EXTRACTORS["metavariables"],
+                              ConversationRecord._field_types["metavariables"]),
+        MessageRecord,
+        compile_message_data_parsers(MESSAGE_FIELDS, MESSAGE_DATA_EXTRACTORS, MessageRecord)),
+}
+
+
+def parse_message(message_response, project, deidentifier=None, encode_obj=str, parsers=None):
+    parsers = parsers or RECORD_PARSERS[DEFAULT_RECORD_FORMAT]
     m_data = message_response["message_data"]
     sender = message_response["sender"]
-    return {"message_id": message_response["_id"],
-            "date_created": message_response["date_created"].split("+")[0],
-            "conversation_id": message_response["conversation_id"],
-            "message_type": message_response["message_data"].get("_type"),
-            "text_data": parse_text_data(m_data, project, sender),
-            "quick_replies_data": parse_quick_replies_data(m_data),
-            "trigger_data": parse_trigger_data(m_data),
-            "presence_data": parse_presence_data(m_data),
-            "list_selection_data": parse_list_selection_data(m_data),
-            "surfaceable_list_selection_data": parse_surfaceable_list_selection_data(m_data),
-            "sender": sender,
-            "recipient": message_response["recipient"],
-            "review": message_response["review"],
-            "answer_title": message_response["answer_title"],
-            "message_obj": str(message_response),
-            }
-
-
-def parse_text_data(message_data, project, sender):
-    '''Format here'''
-    if message_data.get("_type") != "text":
+    message_type = m_data.get("_type")
+    if deidentifier and message_type == "quick_replies" and not m_data.get("has_variables"):
+        # Customers often echo a button label back as text, which can skip DLP. Labels with
+        # variables can hold customer data and are never allowlisted.
+        deidentifier.allow(reply.get("label") for reply in m_data.get("quick_replies") or [])
+    parsed_message = {"message_id": message_response["_id"],
+                      "date_created": message_response["date_created"].split("+")[0],
+                      "conversation_id": message_response["conversation_id"],
+                      "message_type": message_type,
+                      **EMPTY_MESSAGE_DATA,
+                      "sender": sender,
+                      "recipient": message_response["recipient"],
+                      "review": message_response["review"],
+                      "answer_title": message_response["answer_title"],
+                      "message_obj": encode_obj(message_response),
+                      }
+    # Only the sub-parser of the message's own type runs.
+    if message_type == "text":
+        parsed_message["text_data"] = parse_text_data(m_data, project, sender, deidentifier,
+                                                      parsers.message_data)
+    elif message_type in parsers.message_data:
+        field, parser = parsers.message_data[message_type]
+        parsed_message[field] = parser(m_data)
+    return parsed_message if parsers.message is dict else parsers.message(**parsed_message)
+
+
+def parse_message_data(message_data, message_type, parsers=MESSAGE_DATA_PARSERS):
+    """Runs the sub-parser of `message_type`, or returns None for a message of another type."""
+    if message_data.get("_type") != message_type:
         return None
-    body = message_data.get("body").encode("ascii", "ignore").decode()
-    deidentified_body = body if sender in ("bot", "ada") else deidentify(body, project)
-    return {
-        "body": deidentified_body,
-        "has_variables": message_data.get("has_variables"),
-        "reviewable_message": message_data.get("reviewable_message"),
-        "has_forced_quick_replies": message_data.get("has_forced_quick_replies"),
-    }
+    return parsers[message_type][1](message_data)
+
+
+def parse_text_data(message_data, project, sender, deidentifier=None,
+                    parsers=MESSAGE_DATA_PARSERS):
+    text_data = parse_message_data(message_data, "text", parsers)
+    if text_data is None or sender in ("bot", "ada"):
+        return text_data
+    if deidentifier:
+        deidentifier.enqueue(text_data, "body")
+    else:
+        text_data["body"] = deidentify(text_data["body"], project)
+    return text_data
 
 
 def parse_quick_replies_data(message_data):
-    '''Format here'''
-    if message_data.get("_type") != "quick_replies":
-        return None
-    reply_list = message_data.get("quick_replies")
-    return {
-        "is_forced": message_data.get("is_forced"),
-        "has_variables": message_data.get("has_variables"),
-        # TODO: Parse quick_replies into separate button records
-        "quick_replies": str(reply_list),
-        "reviewable_message": message_data.get("reviewable_message"),
-    }
+    return parse_message_data(message_data, "quick_replies")
 
 
 def parse_trigger_data(message_data):
-    '''Format here'''
-    if message_data.get("_type") != "trigger":
-        return None
-    return {
-        "body": message_data.get("body"),
-        "button_type": message_data.get("button_type"),
-        "external_chat_id": message_data.get("external_chat_id"),
-        "reviewable_message": message_data.get("reviewable_message"),
-    }
+    return parse_message_data(message_data, "trigger")
 
 
 def parse_presence_data(message_data):
-    '''Format here'''
-    if message_data.get("_type") != "presence":
-        return None
-    return {
-        "body": message_data.get("body"),
-        "event": message_data.get("event"),
-        "has_variables": message_data.get("has_variables"),
-        "reviewable_message": message_data.get("reviewable_message"),
-    }
+    return parse_message_data(message_data, "presence")
 
 
 def parse_list_selection_data(message_data):
-    '''Format here'''
-    if message_data.get("_type") != "list_selection":
-        return None
-    return {
-        "body": message_data.get("body"),
-        "by": message_data.get("by"),
-        "created": message_data.get("created"),
-        "data": str(message_data.get("data")),  # TODO: parse subfields of JSON into record
-        "external_chat_id": message_data.get("external_chat_id"),
-        "platform": message_data.get("platform"),
-        "reviewable_message": message_data.get("reviewable_message"),
-        "temp_message_uuid": message_data.get("temp_message_uuid"),
-        "to": message_data.get("to"),
-    }
+    return parse_message_data(message_data, "list_selection")
 
 
 def parse_surfaceable_list_selection_data(message_data):
-    '''Format here'''
-    if message_data.get("_type") != "surfaceable_list_selection":
-        return None
-    return {
-        "has_variables": message_data.get("has_variables"),
-        "is_expired": message_data.get("is_expired"),
-        "locked": message_data.get("locked"),
-        "multiple": message_data.get("multiple"),
-        "prompt": message_data.get("prompt"),
-        "reviewable_message": message_data.get("reviewable_message"),
-        "selectables": str(message_data.get("selectables")),
-    }
+    return parse_message_data(message_data, "surfaceable_list_selection")
 
 
 #########################################
@@ -220,47 +258,4 @@ def deidentify(input_str, project):
 
     if not input_str:
         return input_str
-
-    info_types = [
-        "CREDIT_CARD_NUMBER",
-        "EMAIL_ADDRESS",
-        "FIRST_NAME",
-        "LAST_NAME",
-        "PERSON_NAME",
-        "PHONE_NUMBER",
-        "STREET_ADDRESS",
-    ]
-    # Instantiate a client
-    dlp = dlp_v2.DlpServiceClient()
-
-    # Convert the project id into a full resource id.
-    parent = f"projects/{project}"
-
-    # Construct inspect configuration dictionary
-    inspect_config = {
-        "info_types": [{"name": info_type} for info_type in info_types],
-        "min_likelihood": "UNLIKELY",
-    }
-
-    # Construct deidentify configuration dictionary
-    deidentify_config = {
-        "info_type_transformations": {
-            "transformations": [
-                {
-                    "primitive_transformation": {
-                        "replace_with_info_type_config": {},
-                    },
-                },
-            ],
-        },
-    }
-
-    # Construct item
-    item = {"value": input_str}
-
-    # Call the API
-    response = dlp.deidentify_content(
-        parent, deidentify_config=deidentify_config, item=item, inspect_config=inspect_config)
-
-    # Return the results.
-    return response.item.value
+    return BatchDeidentifier(project).deidentify_many([input_str])[0]
@@ -0,0 +1,162 @@
+import logging as log
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+except ImportError:
+    pa = None
+
+from deidentify_ada_data import BatchDeidentifier
+from json_codec import DEFAULT_OBJ_FORMAT, obj_encoder
+from parse_ada_data import (CONVERSATION_FIELDS, EMPTY_MESSAGE_DATA, MESSAGE_DATA_PARSERS,
+                            MESSAGE_FIELDS)
+from schema_parsers import compile_record_parser, record_field
+
+
+# RE2 has no lookarounds, so the digits around the order number are matched explicitly.
+ORDER_NUM_PATTERN = r"(?:^|\D)(?P<order_num>\d{15})(?:\D|$)"
+
+# Sub-parsers of the message types that need no vectorized work. `text` is handled separately.
+MESSAGE_TYPE_PARSERS = {message_type: parser
+                        for message_type, parser in MESSAGE_DATA_PARSERS.items()
+                        if message_type != "text"}
+
+# Sub-record parsers compiled from the schemas without extractors. The fields the extractors of
+# `parse_ada_data` compute per record, `order_number`, `created`, `embed` and the text `body`,
+# are computed as columns instead and set on the parsed sub-records.
+parse_variables_record = compile_record_parser(record_field(CONVERSATION_FIELDS, "variables"))
+parse_metavars_record = compile_record_parser(record_field(CONVERSATION_FIELDS, "metavariables"))
+parse_text_record = compile_record_parser(record_field(MESSAGE_FIELDS, "text_data"))
+
+
+#########################################
+#                                       #
+#               PARSING                 #
+#                                       #
+#########################################
+def parse_api_data_arrow(valid_response_data, data_type, project, deidentifier=None,
+                         obj_format=DEFAULT_OBJ_FORMAT):
+    """Columnar equivalent of `parse_ada_data.parse_api_data`. Timestamp trimming, ASCII
+    folding, `_type` routing, `check_int` and order number extraction run as pyarrow compute
+    kernels over a whole batch of records instead of once per record.
+    """
+    if pa is None:
+        raise ImportError("The arrow parse engine requires the pyarrow package.")
+    log.info("Begin parsing %s data with pyarrow.", data_type)
+    deidentifier = deidentifier or BatchDeidentifier(project)
+    encode_obj = obj_encoder(obj_format)
+    if data_type == "conversations":
+        parsed_data = parse_conversation_batch(valid_response_data, deidentifier, encode_obj)
+    elif data_type == "messages":
+        parsed_data = parse_message_batch(valid_response_data, deidentifier, encode_obj)
+    else:
+        raise Exception(f"Error in parsing: '{data_type}' is not a recognized data type.")
+    deidentifier.flush()
+    log.info("Done parsing %s.", data_type)
+    return parsed_data
+
+
+def column(records, key):
+    return pa.array([record.get(key) for record in records], pa.string())
+
+
+def trim_timestamps(timestamps):
+    """Vectorized `date_time_str.split("+")[0]`."""
+    return pc.list_element(pc.split_pattern(timestamps, "+", max_splits=1), 0).to_pylist()
+
+
+def check_int_column(values):
+    """Vectorized `parse_ada_data.check_int`."""
+    strings = pa.array([str(val) for val in values], pa.string())
+    digits = pc.utf8_is_digit(strings)
+    return pc.if_else(digits, pc.cast(pc.if_else(digits, strings, "0"), pa.int64()),
+                      -1).to_pylist()
+
+
+def check_order_num_column(values):
+    """Vectorized `parse_ada_data.check_order_num`."""
+    strings = pa.array([val if isinstance(val, str) else None for val in values], pa.string())
+    order_nums = pc.struct_field(pc.extract_regex(strings, ORDER_NUM_PATTERN), [0])
+    return pc.fill_null(pc.cast(order_nums, pa.int64()), -1).to_pylist()
+
+
+#########################################
+#                                       #
+#            CONVERSATIONS              #
+#                                       #
+#########################################
+def parse_conversation_batch(conversations, deidentifier, encode_obj=str):
+    date_updated = trim_timestamps(column(conversations, "date_updated"))
+    date_created = trim_timestamps(column(conversations, "date_created"))
+    variables = [conversation["variables"] for conversation in conversations]
+    order_numbers = check_order_num_column([conv_vars.get("order number")
+                                            for conv_vars in variables])
+    metavariables = [conversation["metavariables"] for conversation in conversations]
+    created = check_int_column([metavars.get("created") for metavars in metavariables])
+    embed = check_int_column([metavars.get("embed") for metavars in metavariables])
+
+    parsed_conversations = []
+    for i, conversation_response in enumerate(conversations):
+        metavars = parse_metavars_record(metavariables[i])
+        metavars["created"] = created[i]
+        metavars["embed"] = embed[i]
+        deidentifier.enqueue(metavars, "last_question_asked")
+        conv_variables = parse_variables_record(variables[i])
+        conv_variables["order_number"] = order_numbers[i]
+        parsed_conversations.append({
+            "conversation_id": conversation_response["_id"],
+            "date_updated": date_updated[i],
+            "date_created": date_created[i],
+            "chatter_id": conversation_response["chatter_id"],
+            "platform": conversation_response["platform"],
+            "is_engaged": conversation_response["is_engaged"],
+            "is_escalated": conversation_response["is_escalated"],
+            "csat": str(conversation_response["csat"]),
+            "variables": conv_variables,
+            "metavariables": metavars,
+            "conversation_obj": encode_obj(conversation_response),
+        })
+    return parsed_conversations
+
+
+#########################################
+#                                       #
+#              MESSAGES                 #
+#                                       #
+#########################################
+def parse_message_batch(messages, deidentifier, encode_obj=str):
+    message_data = [message["message_data"] for message in messages]
+    date_created = trim_timestamps(column(messages, "date_created"))
+    message_types = pa.array([m_data.get("_type") for m_data in message_data], pa.string())
+
+    parsed_messages = [{
+        "message_id": message_response["_id"],
+        "date_created": date_created[i],
+        "conversation_id": message_response["conversation_id"],
+        "message_type": message_data[i].get("_type"),
+        **EMPTY_MESSAGE_DATA,
+        "sender": message_response["sender"],
+        "recipient": message_response["recipient"],
+        "review": message_response["review"],
+        "answer_title": message_response["answer_title"],
+        "message_obj": encode_obj(message_response),
+    } for i, message_response in enumerate(messages)]
+
+    # Each sub-parser only runs on the rows of its own message type.
+    for message_type, (key, parser) in MESSAGE_TYPE_PARSERS.items():
+        for i in pc.indices_nonzero(pc.equal(message_types, message_type)).to_pylist():
+            parsed_messages[i][key] = parser(message_data[i])
+            if message_type == "quick_replies" and not message_data[i].get("has_variables"):
+                deidentifier.allow(reply.get("label")
+                                   for reply in message_data[i].get("quick_replies") or [])
+
+    text_rows = pc.indices_nonzero(pc.equal(message_types, "text")).to_pylist()
+    bodies = pa.array([message_data[i].get("body") for i in text_rows], pa.string())
+    ascii_bodies = pc.replace_substring_regex(bodies, r"[^\x00-\x7F]", "").to_pylist()
+    for i, body in zip(text_rows, ascii_bodies):
+        text_data = parse_text_record(message_data[i])
+        text_data["body"] = body
+        if messages[i]["sender"] not in ("bot", "ada"):
+            deidentifier.enqueue(text_data, "body")
+        parsed_messages[i]["text_data"] = text_data
+    return parsed_messages
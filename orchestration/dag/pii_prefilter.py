@@ -0,0 +1,171 @@
+import re
+
+
+CONSERVATIVE = "conservative"
+AGGRESSIVE = "aggressive"
+
+# Replies that customers commonly type or echo back from buttons. None of them can hold PII.
+DEFAULT_ALLOWLIST = frozenset((
+    "agent", "bye", "cancel", "continue", "done", "go back", "good", "great", "hello", "help",
+    "hey", "hi", "live agent", "menu", "n", "never mind", "nevermind", "no", "no thanks", "nope",
+    "ok", "okay", "perfect", "please", "representative", "sounds good", "start over", "sure",
+    "talk to an agent", "thank you", "thanks", "thx", "y", "yeah", "yep", "yes",
+))
+
+# Words that are common in customer messages and cannot be a name on their own. Only the
+# aggressive mode relies on this list.
+COMMON_WORDS = frozenset((
+    "a", "about", "account", "again", "agent", "all", "am", "an", "and", "any", "are", "at",
+    "bag", "bags", "be", "but", "by", "can", "cancel", "card", "change", "charge", "charged",
+    "credit", "customer", "day", "delivery", "did", "do", "does", "driver", "for", "from", "get",
+    "go", "had", "has", "have", "hello", "help", "hi", "how", "human", "i", "if", "in", "is",
+    "it", "item", "items", "late", "me", "missing", "my", "need", "no", "not", "now", "of", "ok",
+    "okay", "on", "online", "or", "order", "orders", "payment", "person", "pick", "pickup",
+    "please", "points", "refund", "service", "slot", "speak", "status", "still", "store", "talk",
+    "thank", "thanks", "that", "the", "there", "this", "time", "timeslot", "to", "today",
+    "tomorrow", "up", "want", "was", "what", "when", "where", "why", "with", "wrong", "yes", "you",
+    "your",
+))
+
+# Capitalized words that show up in customer messages but are brands, not people.
+KNOWN_PROPER_NOUNS = frozenset((
+    "ada", "canada", "costco", "express", "i", "instacart", "loblaw", "loblaws", "marketplace",
+    "nofrills", "optimum", "pc", "president's", "presidents", "qc", "superstore", "visa",
+))
+
+# The words a quick reply label may be made of to be allowlisted, see `PiiPrefilter.allow`.
+SAFE_LABEL_WORDS = COMMON_WORDS | KNOWN_PROPER_NOUNS | frozenset(
+    word for reply in DEFAULT_ALLOWLIST for word in reply.split())
+
+STRUCTURED_PATTERNS = {
+    "EMAIL_ADDRESS": re.compile(r"[^\s@]+@[^\s@]+\.[^\s@]+"),
+    "PHONE_NUMBER": re.compile(r"(?:\d[\s().+-]*){7,}"),
+    "CREDIT_CARD_NUMBER": re.compile(r"(?:\d[ -]*){13,19}"),
+    "STREET_ADDRESS": re.compile(r"\b\d{1,6}[a-z]?\s+(?:[a-z]+\.?\s+){0,3}"
+                                 r"(?:st|street|ave|avenue|rd|road|dr|drive|blvd|boulevard|cres|"
+                                 r"crescent|crt|court|way|lane|ln|pl|place|pkwy|hwy|cir|trail)\b",
+                                 re.IGNORECASE),
+}
+
+NAME_CUE_PATTERN = re.compile(
+    r"\b(?:my name|name is|names|name's|i am|i'm|im|this is|call me|it's|its|mr|mrs|ms|dr|"
+    r"first name|last name|spouse|husband|wife)\b",
+    re.IGNORECASE)
+
+LETTER_PATTERN = re.compile(r"[^\W\d_]")
+DIGIT_PATTERN = re.compile(r"\d")
+WORD_PATTERN = re.compile(r"[^\W\d_][\w'.-]*")
+SENTENCE_START_PATTERN = re.compile(r"(?:^|[.!?]\s+)([^\W\d_][\w'-]*)")
+
+# A phone number needs at least 7 digits, and every other structured info type needs either
+# more digits than that or letters.
+MIN_STRUCTURED_DIGITS = 7
+
+
+def normalize(text):
+    """Folds case, whitespace and trailing punctuation so that allowlist lookups are exact."""
+    return " ".join(text.casefold().split()).strip(" .!?,")
+
+
+def is_safe_label(text):
+    """Returns True for a text with no digits whose words are all common words."""
+    if DIGIT_PATTERN.search(text):
+        return False
+    words = WORD_PATTERN.findall(text)
+    return bool(words) and all(word.casefold() in SAFE_LABEL_WORDS for word in words)
+
+
+class PiiPrefilter:
+    """
+    PiiPrefilter(mode=CONSERVATIVE, allowlist=DEFAULT_ALLOWLIST)
+
+    A local classifier that decides whether a string could contain any of the info types the
+    DLP step looks for. Strings that cannot are passed through without calling the API.
+
+    In `conservative` mode a string is only skipped if it is allowlisted, has fewer than two
+    characters, or has no letters and too few digits to hold a phone or card number. In
+    `aggressive` mode a string is also skipped when no structured pattern matches and it has no
+    sign of a person's name, at the cost of missing lowercase names in free text.
+
+    Parameters
+    ----------
+    mode : str
+        Either `conservative` or `aggressive`.
+    allowlist : iterable of str
+        Replies that are known not to contain PII, such as quick reply button labels.
+    """
+
+    def __init__(self, mode=CONSERVATIVE, allowlist=DEFAULT_ALLOWLIST):
+        if mode not in (CONSERVATIVE, AGGRESSIVE):
+            raise ValueError(f"'{mode}' is not a recognized prefilter mode.")
+        self.mode = mode
+        self.allowlist = {normalize(text) for text in allowlist}
+
+    def allow(self, texts):
+        """
+        allow(texts)
+
+        Adds texts, e.g. the labels of the quick replies a bot offered, to the allowlist. Labels
+        can be filled in with customer data, so only those made of common words alone, which
+        cannot hold a name, an address or a number, are added. The others still go to DLP.
+        """
+
+        self.allowlist.update(normalize(text) for text in texts if text and is_safe_label(text))
+
+    def might_contain_pii(self, text):
+        """Returns False only when `text` can be stored without sending it to DLP."""
+        if len(text.strip()) < 2 or normalize(text) in self.allowlist:
+            return False
+        if not LETTER_PATTERN.search(text):
+            return len(DIGIT_PATTERN.findall(text)) >= MIN_STRUCTURED_DIGITS
+        if self.mode == CONSERVATIVE:
+            return True
+        return self._has_structured_match(text) or self._has_name_signal(text)
+
+    @staticmethod
+    def _has_structured_match(text):
+        return any(pattern.search(text) for pattern in STRUCTURED_PATTERNS.values())
+
+    @staticmethod
+    def _has_name_signal(text):
+        if NAME_CUE_PATTERN.search(text):
+            return True
+        words = WORD_PATTERN.findall(text)
+        # A short reply such as "bob smith" is most likely a name unless every word is common.
+        if len(words) <= 3:
+            return any(word.casefold() not in COMMON_WORDS | KNOWN_PROPER_NOUNS
+                       for word in words)
+        sentence_starts = set(SENTENCE_START_PATTERN.findall(text))
+        return any(word[0].isupper() and word not in sentence_starts
+                   and word.casefold() not in KNOWN_PROPER_NOUNS
+                   for word in words)
+
+
+def measure_false_negatives(prefilter, samples):
+    """
+    measure_false_negatives(prefilter, samples)
+
+    Scores a prefilter against a labelled sample.
+
+    Parameters
+    ----------
+    prefilter : PiiPrefilter
+    samples : list of dicts
+        Each sample has a `text` and a boolean `has_pii` label.
+
+    Returns
+    -------
+    dict
+        `false_negatives` lists the texts with PII that the prefilter would skip,
+        `false_negative_rate` is their share of all texts with PII, and `skip_rate` is the share
+        of all texts that would not be sent to DLP.
+    """
+
+    skipped = [sample for sample in samples if not prefilter.might_contain_pii(sample["text"])]
+    num_with_pii = sum(1 for sample in samples if sample["has_pii"])
+    false_negatives = [sample["text"] for sample in skipped if sample["has_pii"]]
+    return {
+        "false_negatives": false_negatives,
+        "false_negative_rate": len(false_negatives) / num_with_pii if num_with_pii else 0.0,
+        "skip_rate": len(skipped) / len(samples) if samples else 0.0,
+    }
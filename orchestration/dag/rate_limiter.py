@@ -0,0 +1,275 @@
+from datetime import datetime
+from datetime import timezone
+from email.utils import parsedate_to_datetime
+import logging as log
+import threading
+import time
+
+
+class TokenBucket:
+    """
+    TokenBucket(rate, capacity=1, clock=time.monotonic, sleep=time.sleep)
+
+    A thread-safe token bucket on a monotonic clock. Every caller of `acquire` reserves the next
+    token and sleeps only for as long as the budget requires, so calls are spaced `1 / rate`
+    seconds apart no matter how long the work between them takes.
+
+    Parameters
+    ----------
+    rate : float
+        The number of tokens added to the bucket per second.
+    capacity : int
+        The maximum number of tokens that can accumulate while the bucket is idle, i.e. the
+        largest burst allowed.
+    clock : callable
+        Returns the current time in seconds.
+    sleep : callable
+        Blocks for a given number of seconds.
+    """
+
+    def __init__(self, rate, capacity=1, clock=time.monotonic, sleep=time.sleep):
+        self.rate = rate
+        self.capacity = capacity
+        self._clock = clock
+        self._sleep = sleep
+        self._lock = threading.Lock()
+        self._tokens = capacity
+        self._updated = clock()
+
+    def acquire(self):
+        """
+        acquire()
+
+        Takes one token, blocking until it is available.
+
+        Returns
+        -------
+        float
+            The number of seconds spent waiting.
+        """
+
+        with self._lock:
+            self._refill()
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+        if wait:
+            self._sleep(wait)
+        return wait
+
+    def set_rate(self, rate):
+        """Changes the refill rate. Tokens accrued so far are kept."""
+        with self._lock:
+            self._refill()
+            self.rate = rate
+
+    def _refill(self):
+        now = self._clock()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+
+class AdaptiveRateController:
+    """
+    AdaptiveRateController(max_rate, min_rate=0.05, increase_step=0.05, decrease_factor=0.5,
+                           clock=time.monotonic, sleep=time.sleep)
+
+    Paces requests to a rate-limited API with additive-increase/multiplicative-decrease. A
+    throttled response cuts the rate by `decrease_factor` and pauses every caller for as long as
+    the server asks through `Retry-After` or its rate-limit headers. Each successful response
+    adds `increase_step` requests per second back, up to `max_rate`.
+
+    Parameters
+    ----------
+    max_rate : float
+        The documented request limit, in requests per second. The rate never goes above it.
+    min_rate : float
+        The rate never goes below it.
+    increase_step : float
+        Requests per second added after each successful response.
+    decrease_factor : float
+        The rate is multiplied by it after each throttled response.
+    clock : callable
+        Returns the current time in seconds.
+    sleep : callable
+        Blocks for a given number of seconds.
+    """
+
+    def __init__(self, max_rate, min_rate=0.05, increase_step=0.05, decrease_factor=0.5,
+                 clock=time.monotonic, sleep=time.sleep):
+        self.max_rate = max_rate
+        self.min_rate = min_rate
+        self.increase_step = increase_step
+        self.decrease_factor = decrease_factor
+        self.throttle_events = 0
+        self._clock = clock
+        self._sleep = sleep
+        self._lock = threading.Lock()
+        self._paused_until = 0
+        self.bucket = TokenBucket(max_rate, clock=clock, sleep=sleep)
+
+    @property
+    def rate(self):
+        return self.bucket.rate
+
+    def acquire(self):
+        """Blocks until the server's pause is over and the current rate allows a request."""
+        with self._lock:
+            pause = self._paused_until - self._clock()
+        if pause > 0:
+            self._sleep(pause)
+        return self.bucket.acquire()
+
+    def on_success(self, headers):
+        """Probes the rate back up and honours any rate-limit headers on a successful response."""
+        self._pause(rate_limit_reset_delay(headers))
+        if self.rate < self.max_rate:
+            new_rate = min(self.max_rate, self.rate + self.increase_step)
+            self.bucket.set_rate(new_rate)
+            if new_rate == self.max_rate:
+                log.info("Request rate back to %.2f req/s.", new_rate)
+
+    def on_throttle(self, headers):
+        """Backs off after a throttled (429) response."""
+        new_rate = max(self.min_rate, self.rate * self.decrease_factor)
+        self.bucket.set_rate(new_rate)
+        delay = retry_after_delay(headers) or rate_limit_reset_delay(headers) or 0
+        self._pause(delay)
+        with self._lock:
+            self.throttle_events += 1
+        log.warning("Throttled by the API (%d events). Rate lowered to %.2f req/s, pausing %.1f "
+                    "seconds.", self.throttle_events, new_rate, delay)
+
+    def call(self, send, max_attempts=8):
+        """
+        call(send, max_attempts=8)
+
+        Sends a request under the controller, retrying throttled responses.
+
+        Parameters
+        ----------
+        send : callable
+            Sends the request and returns a `requests.Response`-like object with `status_code`
+            and `headers`.
+        max_attempts : int
+            The number of throttled responses tolerated before the last one is returned.
+
+        Returns
+        -------
+        requests.Response
+        """
+
+        for attempt in range(max_attempts):
+            self.acquire()
+            response = send()
+            if response.status_code != 429:
+                self.on_success(response.headers)
+                return response
+            if attempt < max_attempts - 1:
+                self.on_throttle(response.headers)
+        return response
+
+    def _pause(self, delay):
+        if not delay:
+            return
+        with self._lock:
+            self._paused_until = max(self._paused_until, self._clock() + delay)
+
+
+def retry_after_delay(headers):
+    """Returns the delay in seconds requested by a `Retry-After` header, or None."""
+    value = headers.get("Retry-After")
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+
+def rate_limit_reset_delay(headers):
+    """
+    rate_limit_reset_delay(headers)
+
+    Returns how long to wait when `RateLimit-Remaining`/`X-RateLimit-Remaining` says the budget is
+    spent, based on the matching reset header, or None when there is budget left. Reset values
+    that look like epoch timestamps are converted to a delay.
+    """
+
+    for prefix in ("RateLimit-", "X-RateLimit-"):
+        remaining = headers.get(f"{prefix}Remaining")
+        reset = headers.get(f"{prefix}Reset")
+        if remaining is None or reset is None:
+            continue
+        try:
+            if float(remaining) > 0:
+                return None
+            reset = float(reset)
+        except ValueError:
+            continue
+        if reset > 1e9:
+            reset -= time.time()
+        return max(0.0, reset)
+    return None
+
+
+_shared_limiters = {}
+_shared_limiters_lock = threading.Lock()
+
+
+def _get_shared(name, factory):
+    with _shared_limiters_lock:
+        if name not in _shared_limiters:
+            _shared_limiters[name] = factory()
+        return _shared_limiters[name]
+
+
+def get_shared_bucket(name, rate, capacity=1):
+    """
+    get_shared_bucket(name, rate, capacity=1)
+
+    Returns the process-wide token bucket registered under `name`, creating it on first use.
+    Fetches that spend the same budget, e.g. two endpoints queried with one API key, should
+    share a bucket.
+
+    Parameters
+    ----------
+    name : str
+        Identifies the budget, e.g. the API key.
+    rate : float
+        The refill rate used if the bucket has to be created.
+    capacity : int
+        The capacity used if the bucket has to be created.
+
+    Returns
+    -------
+    TokenBucket
+    """
+
+    return _get_shared(("bucket", name), lambda: TokenBucket(rate, capacity))
+
+
+def get_shared_controller(name, max_rate):
+    """
+    get_shared_controller(name, max_rate)
+
+    Returns the process-wide AdaptiveRateController registered under `name`, creating it on
+    first use, so that every fetch spending the same API key's budget backs off together.
+
+    Parameters
+    ----------
+    name : str
+        Identifies the budget, e.g. the API key.
+    max_rate : float
+        The maximum rate used if the controller has to be created.
+
+    Returns
+    -------
+    AdaptiveRateController
+    """
+
+    return _get_shared(("controller", name), lambda: AdaptiveRateController(max_rate))
@@ -0,0 +1,99 @@
+"""Parses and loads archived Ada pages into BigQuery without calling the Ada API.
+
+Used to rebuild history after a change to the parsing, e.g.
+
+    python orchestration/dag/replay_archive.py --archive-dir /home/airflow/gcs/data/ada_archive \
+        --start 2021-06-01 --end 2021-07-30 --config rendered_config.json
+
+`--config` takes a rendered `ada_data_etl_config.json`. The flags override its values. BigQuery
+and DLP are reached with application default credentials, or with `--vault` BigQuery is reached
+with the DAG's service account key from Vault.
+"""
+import argparse
+import json
+import logging as log
+import time
+
+from etl_pipeline import parse_and_load_pages
+from page_archive import PageArchive, parse_day
+
+
+def replay_archive(archive, api_types, start_day, end_day, bq_client, conf):
+    """
+    replay_archive(archive, api_types, start_day, end_day, bq_client, conf)
+
+    Runs the parse and load of every archived day in a date range, in order. Each day replaces
+    its partition, like a scheduled run. Days missing from the archive are logged and skipped.
+
+    Parameters
+    ----------
+    archive : page_archive.PageArchive
+    api_types : list of str
+        The endpoints to replay, e.g. `["messages", "conversations"]`.
+    start_day : datetime
+        The first day replayed.
+    end_day : datetime
+        The last day replayed, inclusive.
+    bq_client : google.cloud.bigquery.Client()
+    conf : dict
+        The DAG config, see `etl_pipeline.parse_and_load_pages`.
+
+    Returns
+    -------
+    dict
+        The number of rows loaded per api type.
+    """
+
+    num_rows = {}
+    for api_type in api_types:
+        days = archive.days(api_type, start_day, end_day)
+        num_missing = (end_day - start_day).days + 1 - len(days)
+        if num_missing:
+            log.warning("%d days of %s are not archived and are skipped.", num_missing, api_type)
+        num_rows[api_type] = 0
+        start = time.perf_counter()
+        for i, day in enumerate(days):
+            num_rows[api_type] += parse_and_load_pages(archive.iter_pages(api_type, day),
+                                                       api_type, bq_client, day, conf)
+            log.info("Replayed %s %s (%d/%d days, %.1f s).", api_type, day.date(), i + 1,
+                     len(days), time.perf_counter() - start)
+    return num_rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--archive-dir", required=True)
+    parser.add_argument("--start", required=True, help="first day, YYYY-MM-DD")
+    parser.add_argument("--end", required=True, help="last day, inclusive, YYYY-MM-DD")
+    parser.add_argument("--api-types", default="messages,conversations")
+    parser.add_argument("--config", help="a rendered ada_data_etl_config.json")
+    parser.add_argument("--bq-project")
+    parser.add_argument("--dataset")
+    parser.add_argument("--load-format")
+    parser.add_argument("--parse-workers", type=int)
+    parser.add_argument("--vault", action="store_true",
+                        help="use the service account key held in Vault for BigQuery")
+    args = parser.parse_args()
+    log.basicConfig(level=log.INFO)
+
+    conf = {}
+    if args.config:
+        with open(args.config) as config_file:
+            conf = json.load(config_file)
+    for key in ("bq_project", "dataset", "load_format", "parse_workers"):
+        if getattr(args, key) is not None:
+            conf[key] = getattr(args, key)
+
+    if args.vault:
+        from bq_credentials import get_bq_client_from_vault
+        bq_client = get_bq_client_from_vault(conf)
+    else:
+        from google.cloud import bigquery
+        bq_client = bigquery.Client(project=conf.get("bq_project"))
+    num_rows = replay_archive(PageArchive(args.archive_dir), args.api_types.split(","),
+                              parse_day(args.start), parse_day(args.end), bq_client, conf)
+    log.info("Replay complete: %s", num_rows)
+
+
+if __name__ == "__main__":
+    main()
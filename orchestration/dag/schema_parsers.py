@@ -0,0 +1,217 @@
+import json
+import os
+
+
+# The schemas are deployed with the DAG files, since Composer only syncs the dags folder.
+# `ADA_SCHEMA_DIR` points elsewhere, e.g. to test a schema change.
+SCHEMA_DIR = os.environ.get(
+    "ADA_SCHEMA_DIR", os.path.join(os.path.dirname(os.path.realpath(__file__)), "schemas"))
+
+# Message records hold one `<_type>_data` sub-record per message type.
+DATA_SUFFIX = "_data"
+
+# The compiled record types by name, so pickled records find their type in another process.
+_record_types = {}
+
+
+def read_schema_fields(table_type, schema_dir=SCHEMA_DIR):
+    """Reads `<schema_dir>/<table_type>_schema.json` as a list of fields in BigQuery's JSON
+    format."""
+    with open(os.path.join(schema_dir, f"{table_type}_schema.json")) as schema_file:
+        return json.load(schema_file)
+
+
+def record_field(fields, name):
+    """Returns the sub-fields of the RECORD field `name`."""
+    for field in fields:
+        if field["name"] == name and field["type"] == "RECORD":
+            return field["fields"]
+    raise KeyError(f"'{name}' is not a RECORD field of the schema.")
+
+
+def _rebuild_record(type_name, values):
+    return _record_types[type_name](*values)
+
+
+class SlottedRecord:
+    """
+    The base of the record types built by `compile_record_type`. A record holds its values in
+    slots rather than in a dict, and reads like a dict of its fields, so the deidentifier and the
+    load sinks handle both.
+    """
+
+    __slots__ = ()
+    _fields = ()
+    _field_set = frozenset()
+    _field_types = {}
+
+    def __getitem__(self, key):
+        if key not in self._field_set:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __setitem__(self, key, value):
+        if key not in self._field_set:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def get(self, key, default=None):
+        return getattr(self, key) if key in self._field_set else default
+
+    def keys(self):
+        return self._fields
+
+    def _asdict(self):
+        """Returns the record as a dict, with its sub-records as dicts too."""
+        return {field: value._asdict() if isinstance(value, SlottedRecord) else value
+                for field, value in zip(self._fields, self._values())}
+
+    def _values(self):
+        return tuple(getattr(self, field) for field in self._fields)
+
+    def __eq__(self, other):
+        if isinstance(other, (SlottedRecord, dict)):
+            return self._asdict() == (other._asdict() if isinstance(other, SlottedRecord)
+                                      else other)
+        return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self):
+        values = ", ".join(f"{field}={value!r}"
+                           for field, value in zip(self._fields, self._values()))
+        return f"{type(self).__name__}({values})"
+
+    def __reduce__(self):
+        return _rebuild_record, (type(self).__name__, self._values())
+
+
+def compile_record_type(name, fields):
+    """
+    compile_record_type(name, fields)
+
+    Builds a `SlottedRecord` class with one slot per schema field, in schema order, and a
+    sub-record class for each RECORD field, found in its `_field_types`. A parsed row takes about
+    half the memory of the dicts it replaces, see `benchmarks/bench_record_memory.py`, and
+    `json_codec.dumps` serializes it as those dicts.
+
+    Parameters
+    ----------
+    name : str
+        The name of the class. Sub-record classes are named `<name>_<field>`. Names must be
+        unique, since pickled records are rebuilt from them.
+    fields : list of dicts
+        The fields of the record in BigQuery's JSON schema format.
+
+    Returns
+    -------
+    type
+        Takes the field values, by position or by name, and defaults missing ones to None.
+    """
+
+    names = tuple(field["name"] for field in fields)
+    # The __init__ source is generated for the same reason as the parsers, see
+    # `compile_record_parser`.
+    source = (
+        f"def __init__(self, {', '.join(f'{field}=None' for field in names)}):\n"
+        + "".join(f"    self.{field} = {field}\n" for field in names)
+    )
+    namespace = {}
+    exec(source, namespace)
+    record_type = type(name, (SlottedRecord,), {
+        "__slots__": names,
+        "__init__": namespace["__init__"],
+        "_fields": names,
+        "_field_set": frozenset(names),
+        "_field_types": {field["name"]: compile_record_type(f"{name}_{field['name']}",
+                                                            field["fields"])
+                         for field in fields if field["type"] == "RECORD"},
+    })
+    _record_types[name] = record_type
+    return record_type
+
+
+def compile_record_parser(fields, extractors=None, record_type=dict):
+    """
+    compile_record_parser(fields, extractors=None, record_type=dict)
+
+    Builds a function that extracts a record with exactly the given schema fields, in schema
+    order, from a dict of API data. The field names and extractors are resolved once here, so
+    parsing a record does no schema lookups or per-field branching.
+
+    Parameters
+    ----------
+    fields : list of dicts
+        The fields of the record in BigQuery's JSON schema format.
+    extractors : dict, optional
+        Maps the name of a field that is not copied as is from the API data to a function that
+        takes the whole dict of API data and returns the value of the field.
+    record_type : type
+        `dict`, or a type built by `compile_record_type` from the same fields.
+
+    Returns
+    -------
+    function
+        Takes a dict of API data and returns the parsed record.
+    """
+
+    extractors = extractors or {}
+    unknown = set(extractors) - {field["name"] for field in fields}
+    if unknown:
+        raise KeyError(f"Extractors for fields missing from the schema: {sorted(unknown)}.")
+    # The parser's source is generated so that each field is a single entry of a dict literal,
+    # the same way collections.namedtuple builds its classes, or a positional argument of the
+    # record type's constructor.
+    namespace = {"_record_type": record_type}
+    entries = []
+    for i, field in enumerate(fields):
+        if field["name"] in extractors:
+            namespace[f"_extract_{i}"] = extractors[field["name"]]
+            value = f"_extract_{i}(data)"
+        else:
+            value = f"get({field['name']!r})"
+        entries.append(f"{field['name']!r}: {value}" if record_type is dict else value)
+    if record_type is dict:
+        record = f"{{{', '.join(entries)}}}"
+    else:
+        record = f"_record_type({', '.join(entries)})"
+    source = (
+        "def parse_record(data):\n"
+        "    get = data.get\n"
+        f"    return {record}\n"
+    )
+    exec(source, namespace)
+    return namespace["parse_record"]
+
+
+def compile_message_data_parsers(fields, extractors=None, record_type=dict):
+    """
+    compile_message_data_parsers(fields, extractors=None, record_type=dict)
+
+    Builds the dispatch table of the message sub-parsers from the `<_type>_data` RECORD fields
+    of the messages schema.
+
+    Parameters
+    ----------
+    fields : list of dicts
+        The fields of the messages table in BigQuery's JSON schema format.
+    extractors : dict, optional
+        Maps the name of a `<_type>_data` field to the extractors of its sub-fields, see
+        `compile_record_parser`.
+    record_type : type
+        `dict`, or the message type built by `compile_record_type`, whose sub-record types the
+        parsers return.
+
+    Returns
+    -------
+    dict
+        Maps each `_type` to a tuple of the name of its sub-record field and its parser.
+    """
+
+    extractors = extractors or {}
+    return {field["name"][:-len(DATA_SUFFIX)]: (
+                field["name"], compile_record_parser(
+                    field["fields"], extractors.get(field["name"]),
+                    dict if record_type is dict else record_type._field_types[field["name"]]))
+            for field in fields
+            if field["type"] == "RECORD" and field["name"].endswith(DATA_SUFFIX)}
@@ -0,0 +1,124 @@
+"""A local stand-in for the Ada Data API, used to test the HTTP client offline.
+
+It serves the records in `tests/inputs/response_<api_type>.json` as paginated responses and can
+inject latency and 429 responses.
+"""
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from urllib.parse import parse_qs
+from urllib.parse import urlparse
+import json
+import os
+import threading
+import time
+
+
+file_dir = os.path.dirname(os.path.realpath(__file__))
+
+
+class AdaStubServer:
+    """
+    AdaStubServer(page_size=2, latency=0.0, min_interval=0.0, throttle_every=0, retry_after=None)
+
+    Parameters
+    ----------
+    page_size : int
+        The number of records per page.
+    latency : float
+        Seconds added to every response.
+    min_interval : float
+        Requests arriving sooner than this after the previous one get a 429, like the real
+        per-key limit.
+    throttle_every : int
+        Every n-th request gets a 429 regardless of timing. 0 disables it.
+    retry_after : str, optional
+        The `Retry-After` header sent with every 429.
+    """
+
+    def __init__(self, page_size=2, latency=0.0, min_interval=0.0, throttle_every=0,
+                 retry_after=None):
+        self.page_size = page_size
+        self.latency = latency
+        self.min_interval = min_interval
+        self.throttle_every = throttle_every
+        self.retry_after = retry_after
+        self.num_requests = 0
+        self.num_throttled = 0
+        self.connections = set()
+        self.request_headers = []
+        self.records = {}
+        for api_type in ("messages", "conversations"):
+            with open(f"{file_dir}/inputs/response_{api_type}.json") as f:
+                self.records[api_type] = json.load(f)
+        self._lock = threading.Lock()
+        self._last_request = None
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._make_handler())
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self._server.server_address[1]}"
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _should_throttle(self):
+        with self._lock:
+            self.num_requests += 1
+            now = time.monotonic()
+            too_soon = (self._last_request is not None
+                        and now - self._last_request < self.min_interval)
+            self._last_request = now
+            throttle = too_soon or (self.throttle_every
+                                    and self.num_requests % self.throttle_every == 0)
+            if throttle:
+                self.num_throttled += 1
+            return throttle
+
+    def _page(self, path, query):
+        api_type = path.rstrip("/").split("/")[-1]
+        records = [record for record in self.records[api_type]
+                   if query["created_since"][0] <= record["date_created"][:26]
+                   <= query["created_to"][0]]
+        page = int(query.get("page", ["1"])[0])
+        start = (page - 1) * self.page_size
+        next_page_uri = None
+        if start + self.page_size < len(records):
+            next_page_uri = (f"{path}?created_since={query['created_since'][0]}"
+                             f"&created_to={query['created_to'][0]}&page={page + 1}")
+        return {"data": records[start:start + self.page_size], "next_page_uri": next_page_uri}
+
+    def _make_handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                stub.connections.add(self.client_address)
+                stub.request_headers.append(dict(self.headers))
+                time.sleep(stub.latency)
+                if stub._should_throttle():
+                    self.send_response(429)
+                    if stub.retry_after is not None:
+                        self.send_header("Retry-After", stub.retry_after)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                parsed_url = urlparse(self.path)
+                body = json.dumps(stub._page(parsed_url.path, parse_qs(parsed_url.query)))
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body.encode("utf-8"))
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
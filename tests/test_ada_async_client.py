@@ -0,0 +1,64 @@
+from datetime import datetime
+from datetime import timedelta
+from itertools import groupby
+from operator import itemgetter
+import asyncio
+import sys
+import os
+import time
+
+file_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(1, f'{file_dir}/../orchestration/dag')
+from ada_async_client import AsyncRequestScheduler, iter_pages_async
+from ada_stub_server import AdaStubServer
+
+
+def test_scheduler_splits_budget_between_streams():
+    """Two streams waiting on one key alternate slots spaced by the key's rate"""
+    scheduler = AsyncRequestScheduler(rate=50)
+    grants = []
+
+    async def stream(name):
+        for _ in range(3):
+            grants.append((name, await scheduler.acquire()))
+
+    async def main():
+        await asyncio.gather(stream("messages"), stream("conversations"))
+
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(main())
+    loop.close()
+    assert [name for name, _ in grants] == ["messages", "conversations"] * 3
+    # The granted slots, not the times the sleeps woke up at, which depend on the machine's load.
+    gaps = [later - earlier for (_, earlier), (_, later) in zip(grants, grants[1:])]
+    assert min(gaps) >= 0.02 - 1e-9
+
+
+def test_iter_pages_async():
+    """Both endpoints are fetched in one event loop, retrying throttled pages"""
+    start_time = datetime(2021, 7, 26)
+    end_time = datetime(2021, 7, 27) - timedelta(microseconds=1)
+    with AdaStubServer(page_size=3, throttle_every=4, retry_after="0") as server:
+        pages = iter_pages_async(server.url, "placeholder_key", ["messages", "conversations"],
+                                 start_time, end_time, num_windows=2, rate=200)
+        records = {api_type: [record for _, page in api_pages for record in page]
+                   for api_type, api_pages in groupby(pages, key=itemgetter(0))}
+    assert list(records) == ["messages", "conversations"]
+    assert len(records["messages"]) == 23
+    assert len(records["conversations"]) == 5
+    assert server.num_throttled > 0
+
+
+def test_iter_pages_async_buffers_a_bounded_number_of_pages():
+    """Streams ahead of the one being consumed stop fetching once their buffer is full"""
+    start_time = datetime(2021, 7, 26)
+    end_time = datetime(2021, 7, 27) - timedelta(microseconds=1)
+    with AdaStubServer(page_size=1) as server:
+        pages = iter_pages_async(server.url, "placeholder_key", ["messages", "conversations"],
+                                 start_time, end_time, num_windows=2, rate=1000,
+                                 max_buffered_pages=1)
+        assert next(pages)[0] == "messages"
+        time.sleep(0.5)
+        # The page consumed, then one buffered and one waiting on a full buffer per stream.
+        assert server.num_requests <= 9
+        pages.close()
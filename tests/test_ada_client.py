@@ -0,0 +1,99 @@
+from datetime import datetime
+from datetime import timedelta
+import sys
+import os
+import time
+
+file_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(1, f'{file_dir}/../orchestration/dag')
+from ada_client import AdaClient, fetch_windows, get_ada_client, split_time_window
+from ada_stub_server import AdaStubServer
+from rate_limiter import AdaptiveRateController
+
+MESSAGES_URI = ("/data_api/v1/messages?created_since=2021-07-26T00%3A00%3A00.000000"
+                "&created_to=2021-07-26T23%3A59%3A59.999999")
+
+
+def test_iter_pages_reuses_one_connection():
+    """Every page is fetched over the same kept-alive connection with the session headers"""
+    with AdaStubServer(page_size=5) as server:
+        client = AdaClient(server.url, "placeholder_key",
+                           rate_controller=AdaptiveRateController(100))
+        pages = list(client.iter_pages(MESSAGES_URI))
+        client.close()
+    assert [len(page) for page in pages] == [5, 5, 5, 5, 3]
+    assert len(server.connections) == 1
+    assert server.request_headers[0]["Authorization"] == "Bearer placeholder_key"
+    assert "gzip" in server.request_headers[0]["Accept-Encoding"]
+
+
+def test_get_ada_client_is_shared():
+    """Fetches with the same endpoint and key share one client"""
+    client = get_ada_client("http://127.0.0.1", "placeholder_key")
+    assert get_ada_client("http://127.0.0.1", "placeholder_key") is client
+    assert get_ada_client("http://127.0.0.1", "other_key") is not client
+
+
+def test_split_time_window():
+    """Sub-windows cover the whole window without gaps or overlaps"""
+    start_time = datetime(2021, 7, 26)
+    end_time = datetime(2021, 7, 27) - timedelta(microseconds=1)
+    windows = split_time_window(start_time, end_time, 4)
+    assert windows[0] == (start_time, datetime(2021, 7, 26, 5, 59, 59, 999999))
+    assert windows[-1][1] == end_time
+    for (_, previous_end), (next_start, _) in zip(windows, windows[1:]):
+        assert next_start - previous_end == timedelta(microseconds=1)
+
+
+def test_fetch_windows_matches_single_fetch():
+    """Time-sliced fetching across keys returns the same records as one sequential fetch"""
+    start_time = datetime(2021, 7, 26)
+    end_time = datetime(2021, 7, 27) - timedelta(microseconds=1)
+    with AdaStubServer(page_size=3) as server:
+        clients = [AdaClient(server.url, f"key_{i}", rate_controller=AdaptiveRateController(100))
+                   for i in range(3)]
+        sequential = clients[0].fetch_window("messages", start_time, end_time)
+        sliced = [record for page in fetch_windows(clients, "messages", start_time, end_time, 8)
+                  for record in page]
+    # Pages come in the order they were fetched, not the order of their windows.
+    assert (sorted(record["_id"] for record in sliced)
+            == sorted(record["_id"] for record in sequential))
+    assert len(sliced) == 23
+
+
+def test_fetch_windows_buffers_a_bounded_number_of_pages():
+    """Windows stop fetching once the shared buffer is full"""
+    start_time = datetime(2021, 7, 26)
+    end_time = datetime(2021, 7, 27) - timedelta(microseconds=1)
+    with AdaStubServer(page_size=1) as server:
+        clients = [AdaClient(server.url, "placeholder_key",
+                             rate_controller=AdaptiveRateController(1000))]
+        pages = fetch_windows(clients, "messages", start_time, end_time, 2,
+                              max_buffered_pages=1)
+        assert len(next(pages)) == 1
+        time.sleep(0.5)
+        # The page consumed, two in the shared buffer and one blocked on it per window.
+        assert server.num_requests <= 5
+        pages.close()
+
+
+def test_fetch_windows_with_bounded_buffers_fetch_concurrently():
+    """Small buffers do not hold back the windows the consumer has not reached"""
+    # The messages were created within this minute, 9, 7 and 7 of them in each third.
+    start_time = datetime(2021, 7, 26, 8, 54)
+    end_time = datetime(2021, 7, 26, 8, 55) - timedelta(microseconds=1)
+
+    def fetch_time(num_keys):
+        with AdaStubServer(page_size=1, latency=0.05) as server:
+            clients = [AdaClient(server.url, f"key_{i}",
+                                 rate_controller=AdaptiveRateController(100))
+                       for i in range(num_keys)]
+            start = time.perf_counter()
+            pages = list(fetch_windows(clients, "messages", start_time, end_time, num_keys,
+                                       max_buffered_pages=1))
+            elapsed = time.perf_counter() - start
+        assert sum(len(page) for page in pages) == 23
+        return elapsed
+
+    # 23 pages in a row with one key, at most 9 in a row with three.
+    assert fetch_time(3) < 0.6 * fetch_time(1)
@@ -0,0 +1,82 @@
+from datetime import datetime
+import gzip
+import json
+import os
+import sys
+
+import pytest
+
+file_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(1, f'{file_dir}/../orchestration/dag')
+from ada_client import AdaClient
+from ada_stub_server import AdaStubServer
+from backfill import BackfillProgress, backfill
+from page_archive import PageArchive
+from rate_limiter import AdaptiveRateController
+from test_bq_loader import FakeBqClient
+
+CONF = {"bq_project": "project", "dataset": "dataset", "load_format": "ndjson"}
+
+
+def loaded_rows(client):
+    return {table_id: [json.loads(line) for line in gzip.decompress(data).splitlines()]
+            for data, table_id, _ in client.loads}
+
+
+def test_backfill_loads_each_day_with_one_job(tmp_path):
+    """Every day and endpoint is loaded into its partition with a single job"""
+    conf = dict(CONF, archive_dir=str(tmp_path / "archive"),
+                checkpoint_dir=str(tmp_path / "checkpoints"))
+    bq_client = FakeBqClient()
+    with AdaStubServer(page_size=5) as server:
+        clients = [AdaClient(server.url, f"key_{i}", rate_controller=AdaptiveRateController(100))
+                   for i in range(2)]
+        num_rows = backfill(datetime(2021, 7, 25), datetime(2021, 7, 27), ["messages"], clients,
+                            bq_client, conf, concurrent_days=3)
+        num_requests = server.num_requests
+    assert num_rows == {(datetime(2021, 7, 25), "messages"): 0,
+                        (datetime(2021, 7, 26), "messages"): 23,
+                        (datetime(2021, 7, 27), "messages"): 0}
+    rows = loaded_rows(bq_client)
+    assert sorted(rows) == ["project.dataset.messages$20210725",
+                            "project.dataset.messages$20210726",
+                            "project.dataset.messages$20210727"]
+    with open(f'{file_dir}/outputs/response_messages.json') as f:
+        assert rows["project.dataset.messages$20210726"] == json.load(f)
+    assert os.listdir(tmp_path / "checkpoints" / "messages") == []
+
+    # Archived days are replayed without the API.
+    replay_client = FakeBqClient()
+    backfill(datetime(2021, 7, 25), datetime(2021, 7, 27), ["messages"], [], replay_client, conf)
+    assert loaded_rows(replay_client) == rows
+    assert PageArchive(conf["archive_dir"]).has_day("messages", datetime(2021, 7, 26))
+    assert num_requests == 7
+
+
+# Stands in for an AdaClient whose every fetch fails.
+class FailingClient():
+    def iter_pages(self, uri, checkpoint=None):
+        raise ValueError("Error response received: 500.")
+
+
+def test_backfill_reports_failed_days():
+    """A failing day does not stop the others and is named in the error"""
+    bq_client = FakeBqClient()
+    with AdaStubServer(page_size=5) as server:
+        live = AdaClient(server.url, "live_key", rate_controller=AdaptiveRateController(100))
+        with pytest.raises(RuntimeError, match="1 of 2 partitions failed: messages 2021-07-25"):
+            backfill(datetime(2021, 7, 25), datetime(2021, 7, 26), ["messages"],
+                     [FailingClient(), live], bq_client, CONF)
+    assert list(loaded_rows(bq_client)) == ["project.dataset.messages$20210726"]
+
+
+def test_backfill_progress_eta():
+    """The ETA extrapolates the average time per finished task"""
+    now = [0.0]
+    progress = BackfillProgress(10, clock=lambda: now[0])
+    assert progress.eta is None
+    now[0] = 60.0
+    progress.task_done(100)
+    progress.task_done(50)
+    assert progress.num_rows == 150
+    assert progress.eta == pytest.approx(240.0)
@@ -0,0 +1,67 @@
+import json
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+file_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(1, f'{file_dir}/../orchestration/dag')
+from bq_credentials import CachedCredentials
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+def make_cache(clock, secrets):
+    return CachedCredentials(lambda: secrets.pop(0), ttl=3600, refresh_margin=300,
+                             credentials_factory=lambda info: ("credentials", info["key"]),
+                             client_factory=lambda credentials, project: (credentials, project),
+                             clock=clock)
+
+
+def test_credentials_are_reused_until_shortly_before_they_expire():
+    clock = Clock()
+    cache = make_cache(clock, [{"key": 1}, {"key": 2}])
+    assert cache.get_credentials() == ("credentials", 1)
+    clock.now = 3299
+    assert cache.get_credentials() == ("credentials", 1)
+    clock.now = 3300
+    assert cache.get_credentials() == ("credentials", 2)
+    assert cache.num_fetches == 2
+
+
+def test_clients_are_cached_per_project_and_rebuilt_with_new_credentials():
+    clock = Clock()
+    cache = make_cache(clock, [{"key": 1}, {"key": 2}])
+    client = cache.get_bq_client("project")
+    assert cache.get_bq_client("project") is client
+    assert cache.get_bq_client("other") == (("credentials", 1), "other")
+    clock.now = 3600
+    assert cache.get_bq_client("project") == (("credentials", 2), "project")
+
+
+def test_concurrent_callers_fetch_the_secret_once():
+    cache = make_cache(Clock(), [{"key": 1}])
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        clients = list(executor.map(lambda _: cache.get_bq_client("project"), range(32)))
+    assert all(client is clients[0] for client in clients)
+    assert cache.num_fetches == 1
+
+
+def test_credentials_are_built_in_memory(tmp_path, monkeypatch):
+    key_path = os.environ.get("GOOGLE_APPLICATION_CREDENTIALS")
+    if not key_path or not os.path.exists(key_path):
+        pytest.skip("needs a service account key file")
+    monkeypatch.chdir(tmp_path)
+    with open(key_path) as key_file:
+        key = json.load(key_file)
+    cache = CachedCredentials(lambda: key)
+    assert cache.get_credentials().service_account_email == key["client_email"]
+    assert cache.get_bq_client("project").project == "project"
+    assert os.listdir(tmp_path) == []
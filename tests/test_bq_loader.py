@@ -0,0 +1,205 @@
+from datetime import datetime
+import gzip
+import json
+import sys
+import os
+
+file_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(1, f'{file_dir}/../orchestration/dag')
+import pytest
+
+from bq_loader import (ChunkedLoadSink, NdjsonLoadSink, ParallelLoadSink, load_schema,
+                       partition_table_id)
+from etl_pipeline import parse_and_load_pages
+
+
+class Object():
+    pass
+
+
+# Stands in for bigquery.Client, recording every load job it is asked to run.
+class FakeBqClient():
+    def __init__(self):
+        self.loads = []
+        self.tables = {}
+        self.copies = []
+
+    def load_table_from_json(self, records, table_id, job_config):
+        self.loads.append((list(records), table_id, job_config.write_disposition))
+        job = Object()
+        job.result = lambda: None
+        return job
+
+    def load_table_from_file(self, file_obj, table_id, job_config):
+        self.loads.append((file_obj.read(), table_id, job_config))
+        job = Object()
+        job.result = lambda: None
+        return job
+
+    def create_table(self, table):
+        self.tables[f"{table.project}.{table.dataset_id}.{table.table_id}"] = table
+
+    def copy_table(self, source_table_id, table_id, job_config):
+        self.copies.append((source_table_id, table_id, job_config.write_disposition))
+        job = Object()
+        job.result = lambda: None
+        return job
+
+    def delete_table(self, table_id, not_found_ok=False):
+        del self.tables[table_id]
+
+
+def test_partition_table_id():
+    assert (partition_table_id("project", "dataset", "messages", datetime(2021, 7, 26))
+            == "project.dataset.messages$20210726")
+
+
+def test_chunked_load_sink():
+    """Chunks are appended to a staging table, which then replaces the partition"""
+    client = FakeBqClient()
+    sink = ChunkedLoadSink(client, "project.dataset.messages$20210726", load_schema("messages"))
+    staging_table_id = sink.staging_table_id
+    assert staging_table_id.startswith("project.dataset.messages_load_20210726_")
+    assert client.tables[staging_table_id].expires is not None
+    sink.write([{"message_id": "1"}, {"message_id": "2"}])
+    sink.write([{"message_id": "3"}])
+    sink.close()
+    assert client.loads == [([{"message_id": "1"}, {"message_id": "2"}], staging_table_id,
+                             "WRITE_APPEND"),
+                            ([{"message_id": "3"}], staging_table_id, "WRITE_APPEND")]
+    assert client.copies == [(staging_table_id, "project.dataset.messages$20210726",
+                              "WRITE_TRUNCATE")]
+    assert client.tables == {}
+    assert sink.num_rows == 3
+
+
+def test_chunked_load_sink_empty_day():
+    """A day without records still truncates its partition"""
+    client = FakeBqClient()
+    sink = ChunkedLoadSink(client, "project.dataset.messages$20210726", load_schema("messages"))
+    sink.close()
+    assert client.loads == []
+    assert client.copies == [(sink.staging_table_id, "project.dataset.messages$20210726",
+                              "WRITE_TRUNCATE")]
+    assert client.tables == {}
+
+
+class FailingJsonLoadBqClient(FakeBqClient):
+    def load_table_from_json(self, records, table_id, job_config):
+        if self.loads:
+            raise RuntimeError("load failed")
+        return super().load_table_from_json(records, table_id, job_config)
+
+
+def test_chunked_load_sink_failure_keeps_the_partition():
+    """A chunk failing after the first was loaded leaves the partition as it was"""
+    client = FailingJsonLoadBqClient()
+    sink = ChunkedLoadSink(client, "project.dataset.messages$20210726", load_schema("messages"))
+    sink.write([{"message_id": "1"}])
+    with pytest.raises(RuntimeError):
+        sink.write([{"message_id": "2"}])
+    sink.abort()
+    assert [table_id for _, table_id, _ in client.loads] == [sink.staging_table_id]
+    assert client.copies == []
+    assert client.tables == {}
+
+
+def test_load_schema():
+    """Schemas are read from the schema files, including nested records"""
+    schema = load_schema("messages")
+    assert schema[0].name == "message_id"
+    text_data = [field for field in schema if field.name == "text_data"][0]
+    assert [field.name for field in text_data.fields][0] == "body"
+
+
+def test_ndjson_load_sink(tmp_path):
+    """Records are spooled to compressed NDJSON and loaded in one job with the schema"""
+    with open(f'{file_dir}/outputs/response_messages.json') as f:
+        records = json.load(f)
+    client = FakeBqClient()
+    schema = load_schema("messages")
+    sink = NdjsonLoadSink(client, "project.dataset.messages$20210726", schema,
+                          spool_dir=str(tmp_path))
+    sink.write(records[:10])
+    sink.write(records[10:])
+    sink.close()
+    (data, table_id, job_config), = client.loads
+    assert [json.loads(line) for line in gzip.decompress(data).splitlines()] == records
+    assert job_config.source_format == "NEWLINE_DELIMITED_JSON"
+    assert job_config.write_disposition == "WRITE_TRUNCATE"
+    assert job_config.schema == schema
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_parallel_load_sink(tmp_path):
+    """Chunks are loaded into a staging table, which then replaces the partition"""
+    with open(f'{file_dir}/outputs/response_messages.json') as f:
+        records = json.load(f)
+    client = FakeBqClient()
+    sink = ParallelLoadSink(client, "project.dataset.messages$20210726", load_schema("messages"),
+                            chunk_rows=4, max_workers=3, spool_dir=str(tmp_path))
+    staging_table_id = sink.staging_table_id
+    assert staging_table_id.startswith("project.dataset.messages_load_20210726_")
+    assert client.tables[staging_table_id].expires is not None
+    sink.write(records[:5])
+    sink.write(records[5:])
+    sink.close()
+    assert len(client.loads) == sink.num_chunks == -(-len(records) // 4)
+    loaded = [json.loads(line) for data, _, _ in client.loads
+              for line in gzip.decompress(data).splitlines()]
+    assert sorted(loaded, key=records.index) == records
+    assert {(table_id, job_config.write_disposition) for _, table_id, job_config
+            in client.loads} == {(staging_table_id, "WRITE_APPEND")}
+    assert client.copies == [(staging_table_id, "project.dataset.messages$20210726",
+                              "WRITE_TRUNCATE")]
+    assert client.tables == {}
+    assert os.listdir(tmp_path) == []
+
+
+class FailingLoadBqClient(FakeBqClient):
+    def load_table_from_file(self, file_obj, table_id, job_config):
+        raise RuntimeError("load failed")
+
+
+def test_parallel_load_sink_failure_keeps_the_partition(tmp_path):
+    """A failed chunk load leaves the partition as it was and drops the staging table"""
+    client = FailingLoadBqClient()
+    sink = ParallelLoadSink(client, "project.dataset.messages$20210726", load_schema("messages"),
+                            chunk_rows=1, max_workers=2, spool_dir=str(tmp_path))
+    sink.write([{"message_id": "1"}, {"message_id": "2"}])
+    with pytest.raises(RuntimeError):
+        sink.close()
+    assert client.copies == []
+    assert client.tables == {}
+    assert os.listdir(tmp_path) == []
+
+
+@pytest.mark.parametrize("sink_type", [NdjsonLoadSink, ParallelLoadSink])
+def test_aborted_sink_leaves_nothing_behind(sink_type, tmp_path):
+    """An abort deletes the spool files and the staging table without loading anything"""
+    client = FakeBqClient()
+    sink = sink_type(client, "project.dataset.messages$20210726", load_schema("messages"),
+                     spool_dir=str(tmp_path))
+    sink.write([{"message_id": "1"}, {"message_id": "2"}])
+    sink.abort()
+    assert client.loads == client.copies == []
+    assert client.tables == {}
+    assert os.listdir(tmp_path) == []
+
+
+def test_failed_fetch_drops_the_staging_table():
+    """A fetch failing after some records were written leaves the partition as it was"""
+    with open(f'{file_dir}/inputs/response_messages.json') as f:
+        records = json.load(f)
+
+    def pages():
+        yield records[:5]
+        raise RuntimeError("fetch failed")
+
+    client = FakeBqClient()
+    conf = {"bq_project": "project", "dataset": "dataset", "load_format": "ndjson",
+            "load_chunk_size": 2, "load_workers": 2, "upload_chunk_rows": 2}
+    with pytest.raises(RuntimeError):
+        parse_and_load_pages(pages(), "messages", client, datetime(2021, 7, 26), conf)
+    assert client.copies == []
+    assert client.tables == {}
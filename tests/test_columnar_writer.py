@@ -0,0 +1,152 @@
+from datetime import datetime
+from datetime import timezone
+import gzip
+import io
+import json
+import sys
+import os
+
+import fastavro
+import pyarrow.parquet as pq
+import pytest
+
+file_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(1, f'{file_dir}/../orchestration/dag')
+from bq_loader import NdjsonLoadSink, load_schema, read_schema_fields
+from columnar_writer import ColumnarLoadSink, coerce_record, to_timestamp
+from test_bq_loader import FakeBqClient
+
+
+def get_parsed_records(table_type):
+    with open(f'{file_dir}/outputs/response_{table_type}.json') as f:
+        return json.load(f)
+
+
+def test_coerce_record():
+    """Values are converted to their schema types, recursing into records"""
+    fields = read_schema_fields("conversations")
+    record = coerce_record(get_parsed_records("conversations")[0], fields)
+    assert record["date_created"] == datetime(2021, 7, 26, 8, 54, 3, 464000, timezone.utc)
+    assert record["metavariables"]["introshown"] is False
+    assert record["metavariables"]["embed"] == 1
+    assert record["variables"]["order_number"] == -1
+
+
+def test_to_timestamp():
+    """Timestamps are read in every format a JSON load accepts, and bad ones raise"""
+    expected = datetime(2021, 7, 26, 8, 54, 21, 336000, timezone.utc)
+    for value in ("2021-07-26 08:54:21.336000", "2021-07-26T08:54:21.336",
+                  "2021-07-26T08:54:21.336Z", "2021-07-26T10:54:21.336+02:00",
+                  "2021-07-26 03:54:21.336-0500"):
+        assert to_timestamp(value) == expected
+    assert to_timestamp(None) is None
+    with pytest.raises(ValueError):
+        to_timestamp("26/07/2021")
+
+
+def test_coerce_list_selection_created():
+    """The list selection row's space-separated `created` timestamp is kept"""
+    record, = [record for record in get_parsed_records("messages")
+               if record["message_type"] == "list_selection"]
+    coerced = coerce_record(record, read_schema_fields("messages"))
+    assert coerced["list_selection_data"]["created"] == datetime(2021, 7, 26, 8, 54, 21, 336000,
+                                                                 timezone.utc)
+
+
+def normalize(value, field):
+    """Reads a value of an NDJSON row the way a JSON load types it."""
+    if value is None:
+        return None
+    if field["type"] == "RECORD":
+        return {sub_field["name"]: normalize(value.get(sub_field["name"]), sub_field)
+                for sub_field in field["fields"]}
+    if field["type"] == "TIMESTAMP":
+        return datetime.fromisoformat(value).replace(tzinfo=timezone.utc)
+    if field["type"] in ("BOOL", "BOOLEAN") and isinstance(value, str):
+        return value.lower() == "true"
+    return value
+
+
+def read_ndjson_rows(table_type, records, tmp_path):
+    client = FakeBqClient()
+    sink = NdjsonLoadSink(client, "project.dataset.table$20210726", load_schema(table_type),
+                          spool_dir=str(tmp_path))
+    sink.write(records)
+    sink.close()
+    (data, _, _), = client.loads
+    return [json.loads(line) for line in gzip.decompress(data).splitlines()]
+
+
+def read_columnar_rows(load_format, data):
+    if load_format == "parquet":
+        return pq.ParquetFile(io.BytesIO(data)).read().to_pylist()
+    return list(fastavro.reader(io.BytesIO(data)))
+
+
+@pytest.mark.parametrize("load_format", ["parquet", "avro"])
+@pytest.mark.parametrize("table_type", ["messages", "conversations"])
+def test_columnar_matches_ndjson(load_format, table_type, tmp_path):
+    """Parquet and Avro loads hold the same value as the NDJSON load in every column"""
+    records = get_parsed_records(table_type)
+    fields = read_schema_fields(table_type)
+    ndjson_rows = [{field["name"]: normalize(row.get(field["name"]), field) for field in fields}
+                   for row in read_ndjson_rows(table_type, records, tmp_path)]
+    client = FakeBqClient()
+    sink = ColumnarLoadSink(client, "project.dataset.table$20210726", fields, load_format,
+                            spool_dir=str(tmp_path))
+    sink.write(records)
+    sink.close()
+    (data, _, _), = client.loads
+    columnar_rows = read_columnar_rows(load_format, data)
+    for field in fields:
+        assert ([row[field["name"]] for row in columnar_rows]
+                == [row[field["name"]] for row in ndjson_rows]), field["name"]
+
+
+def test_parquet_load_sink(tmp_path):
+    """Messages are written as Parquet row groups with struct columns and loaded in one job"""
+    records = get_parsed_records("messages")
+    client = FakeBqClient()
+    sink = ColumnarLoadSink(client, "project.dataset.messages$20210726",
+                            read_schema_fields("messages"), "parquet", spool_dir=str(tmp_path))
+    sink.write(records[:10])
+    sink.write(records[10:])
+    sink.close()
+    (data, _, job_config), = client.loads
+    parquet_file = pq.ParquetFile(io.BytesIO(data))
+    assert parquet_file.metadata.num_row_groups == 2
+    rows = parquet_file.read().to_pylist()
+    assert [row["message_id"] for row in rows] == [record["message_id"] for record in records]
+    assert rows[3]["text_data"]["body"] == records[3]["text_data"]["body"]
+    assert job_config.source_format == "PARQUET"
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_avro_load_sink(tmp_path):
+    """Conversations are written as Avro records with nested records and loaded in one job"""
+    records = get_parsed_records("conversations")
+    client = FakeBqClient()
+    sink = ColumnarLoadSink(client, "project.dataset.conversations$20210726",
+                            read_schema_fields("conversations"), "avro",
+                            spool_dir=str(tmp_path))
+    sink.write(records)
+    sink.close()
+    (data, _, job_config), = client.loads
+    rows = list(fastavro.reader(io.BytesIO(data)))
+    assert [row["conversation_id"] for row in rows] == [record["conversation_id"]
+                                                        for record in records]
+    assert rows[0]["metavariables"]["browser"] == "chrome"
+    assert job_config.source_format == "AVRO"
+    assert job_config.use_avro_logical_types
+
+
+@pytest.mark.parametrize("load_format", ["parquet", "avro"])
+def test_aborted_columnar_sink_deletes_its_spool_file(load_format, tmp_path):
+    records = get_parsed_records("messages")
+    client = FakeBqClient()
+    sink = ColumnarLoadSink(client, "project.dataset.messages$20210726",
+                            read_schema_fields("messages"), load_format, spool_dir=str(tmp_path))
+    sink.write(records)
+    sink.abort()
+    assert client.loads == []
+    assert list(tmp_path.iterdir()) == []
@@ -0,0 +1,97 @@
+import ast
+import json
+import os
+import re
+import subprocess
+import sys
+
+import pytest
+
+file_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(1, f'{file_dir}/../orchestration/dag')
+from dag_config import CONFIG_VARIABLE, get_dag_config
+
+DAG_FILE = f'{file_dir}/../orchestration/dag/ada_to_bq.py'
+# Modules the scheduler must not import while it parses the DAG file.
+HEAVY_MODULES = ("google", "requests", "commons", "pyarrow", "orjson", "aiohttp", "ada_client",
+                 "ada_async_client", "bq_loader", "etl_pipeline", "deidentify_ada_data",
+                 "parse_ada_data", "incremental_sync", "page_archive", "fetch_checkpoint")
+IMPORT_BUDGET_SECONDS = 2.0
+
+
+class VariableGetter:
+    def __init__(self, conf):
+        self.conf = conf
+        self.calls = 0
+
+    def __call__(self, key, default=None):
+        self.calls += 1
+        return json.dumps(self.conf)
+
+
+def test_first_read_writes_the_cache(tmp_path):
+    cache_path = str(tmp_path / "config.json")
+    variable_get = VariableGetter({"dataset": "ada"})
+    assert get_dag_config(variable_get, cache_path, clock=lambda: 0) == {"dataset": "ada"}
+    assert variable_get.calls == 1
+    with open(cache_path) as cache_file:
+        assert json.load(cache_file) == {"dataset": "ada"}
+
+
+def test_cache_is_used_within_the_ttl(tmp_path):
+    cache_path = str(tmp_path / "config.json")
+    get_dag_config(VariableGetter({"dataset": "ada"}), cache_path)
+    variable_get = VariableGetter({"dataset": "changed"})
+    mtime = os.path.getmtime(cache_path)
+    conf = get_dag_config(variable_get, cache_path, ttl=300, clock=lambda: mtime + 299)
+    assert conf == {"dataset": "ada"}
+    assert variable_get.calls == 0
+
+
+def test_cache_is_refreshed_after_the_ttl(tmp_path):
+    cache_path = str(tmp_path / "config.json")
+    get_dag_config(VariableGetter({"dataset": "ada"}), cache_path)
+    variable_get = VariableGetter({"dataset": "changed"})
+    mtime = os.path.getmtime(cache_path)
+    conf = get_dag_config(variable_get, cache_path, ttl=300, clock=lambda: mtime + 301)
+    assert conf == {"dataset": "changed"}
+    assert variable_get.calls == 1
+    with open(cache_path) as cache_file:
+        assert json.load(cache_file) == {"dataset": "changed"}
+
+
+def test_dag_file_has_no_heavy_top_level_imports():
+    with open(DAG_FILE) as dag_file:
+        tree = ast.parse(dag_file.read())
+    imported = []
+    for node in tree.body:
+        if isinstance(node, ast.Import):
+            imported += [alias.name for alias in node.names]
+        elif isinstance(node, ast.ImportFrom):
+            imported.append(node.module)
+    assert not [module for module in imported if module.split(".")[0] in HEAVY_MODULES]
+
+
+def test_dag_file_import_time(tmp_path):
+    pytest.importorskip("airflow")
+    with open(f'{file_dir}/../orchestration/config/ada_data_etl_config.json') as config_file:
+        # The config is a template, rendered with placeholder values.
+        config_str = re.sub(r'{{ email_on_failure }}', 'false', config_file.read())
+        config_str = re.sub(r'{{ (archive_dir|checkpoint_dir) }}', 'null', config_str)
+        config_str = re.sub(r'{{ \w+ }}', 'test', config_str)
+    script = f"""
+import sys, time
+sys.path.insert(1, {f'{file_dir}/../orchestration/dag'!r})
+from airflow import models
+models.Variable.get = lambda key, default=None, **kwargs: {config_str!r}
+start = time.perf_counter()
+import ada_to_bq
+print(time.perf_counter() - start)
+print("google.cloud.bigquery" in sys.modules)
+"""
+    # The config cache goes to the temporary directory, so the first parse reads the Variable.
+    env = dict(os.environ, TMPDIR=str(tmp_path))
+    output = subprocess.run([sys.executable, "-c", script], check=True, env=env,
+                            stdout=subprocess.PIPE).stdout.decode().split()
+    assert float(output[0]) < IMPORT_BUDGET_SECONDS
+    assert output[1] == "False"
@@ -0,0 +1,41 @@
+from datetime import datetime
+import json
+import os
+import sys
+
+file_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(1, f'{file_dir}/../orchestration/dag')
+from dedup_index import DedupIndex, dedup_pages, record_key
+from etl_pipeline import parse_and_load_pages
+from test_backfill import CONF, loaded_rows
+from test_bq_loader import FakeBqClient
+
+
+def test_record_key():
+    """ObjectIds are read as numbers, other ids are hashed"""
+    assert record_key("60fe782b1fc5cdd001545602") == 0x60fe782b1fc5cdd001545602
+    assert record_key("not-an-object-id") == record_key("not-an-object-id")
+    assert record_key("not-an-object-id") != record_key("not-an-object-id2")
+
+
+def test_dedup_pages_across_pages_and_calls():
+    """Repeats within a page, across pages and across calls sharing an index are dropped"""
+    index = DedupIndex()
+    pages = [[{"_id": "a"}, {"_id": "b"}, {"_id": "a"}], [{"_id": "b"}], [{"_id": "c"}, {}]]
+    assert list(dedup_pages(pages, "messages", index)) == [[{"_id": "a"}, {"_id": "b"}],
+                                                           [{"_id": "c"}, {}]]
+    assert (index.num_seen, index.num_dropped, len(index)) == (6, 2, 3)
+    assert list(dedup_pages([[{"_id": "c"}, {"_id": "d"}]], "messages", index)) == [[{"_id": "d"}]]
+    assert index.num_dropped == 3
+
+
+def test_parse_and_load_pages_drops_repeated_records():
+    """A page returned twice by a shifted pagination is loaded once"""
+    with open(f'{file_dir}/inputs/response_messages.json') as f:
+        records = json.load(f)
+    bq_client = FakeBqClient()
+    pages = [records[:10], records[5:15], records[15:]]
+    num_rows = parse_and_load_pages(pages, "messages", bq_client, datetime(2021, 7, 26), CONF)
+    assert num_rows == len(records)
+    with open(f'{file_dir}/outputs/response_messages.json') as f:
+        assert loaded_rows(bq_client)["project.dataset.messages$20210726"] == json.load(f)
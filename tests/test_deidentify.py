@@ -0,0 +1,165 @@
+import sys
+import os
+import sqlite3
+import threading
+
+from google.api_core.exceptions import ResourceExhausted
+
+file_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(1, f'{file_dir}/../orchestration/dag')
+import deidentify_ada_data
+from deidentify_ada_data import BatchDeidentifier, DeidentifyCache, pack_batches
+from parse_ada_data import parse_message_list
+from pii_prefilter import CONSERVATIVE, PiiPrefilter
+
+
+class Object():
+    pass
+
+
+# Stands in for DlpServiceClient.deidentify_content, echoing every cell back in upper case.
+# The first `num_quota_errors` calls fail with RESOURCE_EXHAUSTED.
+class FakeDlpClient():
+    def __init__(self, num_quota_errors=0):
+        self.requests = []
+        self.num_quota_errors = num_quota_errors
+        self.lock = threading.Lock()
+
+    def deidentify_content(self, request):
+        with self.lock:
+            self.requests.append(request)
+            if len(self.requests) <= self.num_quota_errors:
+                raise ResourceExhausted("Quota exceeded")
+        response = Object()
+        response.item = Object()
+        item = request["item"]
+        if "value" in item:
+            response.item.value = item["value"].upper()
+            return response
+        response.item.table = Object()
+        response.item.table.rows = []
+        for row in item["table"]["rows"]:
+            cell = Object()
+            cell.string_value = row["values"][0]["string_value"].upper()
+            out_row = Object()
+            out_row.values = [cell]
+            response.item.table.rows.append(out_row)
+        return response
+
+
+def test_pack_batches():
+    """Batches respect both the row and the byte limits and keep their order"""
+    assert pack_batches(["a", "b", "c"], max_bytes=100, max_rows=2) == [["a", "b"], ["c"]]
+    assert pack_batches(["aaa", "bb", "c"], max_bytes=4, max_rows=10) == [["aaa"], ["bb", "c"]]
+    assert pack_batches(["toolong", "a"], max_bytes=3, max_rows=10) == [["toolong"], ["a"]]
+    assert pack_batches([]) == []
+
+
+def test_deidentify_many():
+    """Distinct strings are sent once in a table and mapped back in order"""
+    client = FakeDlpClient()
+    deidentifier = BatchDeidentifier("placeholder_project_name", client=client)
+    result = deidentifier.deidentify_many(["hi", None, "bob", "hi", ""])
+    assert result == ["HI", None, "BOB", "HI", ""]
+    assert len(client.requests) == 1
+    assert len(client.requests[0]["item"]["table"]["rows"]) == 2
+
+
+def test_parse_message_list_batches_customer_text():
+    """Customer messages are de-identified in one request, bot messages are left alone"""
+    messages = [
+        {"_id": str(i), "date_created": "2021-07-26T08:54:03.409000+00:00",
+         "conversation_id": "c", "message_data": {"_type": "text", "body": body},
+         "sender": sender, "recipient": "r", "review": 0, "answer_title": None}
+        for i, (body, sender) in enumerate([("hello", "bot"), ("my name is bob", "user"),
+                                            ("call me", "user")])
+    ]
+    client = FakeDlpClient()
+    parsed = parse_message_list(messages, "placeholder_project_name",
+                                BatchDeidentifier("placeholder_project_name", client=client))
+    assert [m["text_data"]["body"] for m in parsed] == ["hello", "MY NAME IS BOB", "CALL ME"]
+    assert len(client.requests) == 1
+
+
+def test_deidentify_cache(tmp_path):
+    """Repeated strings are served from memory, then from disk in a later run"""
+    cache_path = str(tmp_path / "cache.sqlite")
+    client = FakeDlpClient()
+    cache = DeidentifyCache(max_entries=10, path=cache_path)
+    deidentifier = BatchDeidentifier("placeholder_project_name", client=client, cache=cache)
+    assert deidentifier.deidentify_many(["agent", "hi"]) == ["AGENT", "HI"]
+    assert deidentifier.deidentify_many(["agent"]) == ["AGENT"]
+    assert (cache.memory_hits, cache.disk_hits, cache.misses) == (1, 0, 2)
+    cache.close()
+
+    next_run_cache = DeidentifyCache(max_entries=1, path=cache_path)
+    deidentifier = BatchDeidentifier("placeholder_project_name", client=client,
+                                     cache=next_run_cache)
+    assert deidentifier.deidentify_many(["hi", "agent", "new"]) == ["HI", "AGENT", "NEW"]
+    assert (next_run_cache.memory_hits, next_run_cache.disk_hits, next_run_cache.misses) == (0, 2, 1)
+    assert len(client.requests) == 2
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+def test_deidentify_cache_eviction(tmp_path):
+    """The sqlite store drops rows past their age, then the oldest rows beyond its size"""
+    cache_path = str(tmp_path / "cache.sqlite")
+    clock = Clock()
+    cache = DeidentifyCache(path=cache_path, disk_max_entries=2, disk_max_age_days=1,
+                            clock=clock)
+    for now, string in [(0, "old"), (86400, "a"), (86401, "b"), (86402, "c")]:
+        clock.now = now
+        cache.put_many({string: string.upper()})
+    cache.close()
+
+    clock.now = 86410
+    cache = DeidentifyCache(path=cache_path, disk_max_entries=2, disk_max_age_days=1,
+                            clock=clock)
+    assert cache.get_many(["old", "a", "b", "c"]) == {"b": "B", "c": "C"}
+    assert cache._db.execute("PRAGMA journal_mode").fetchone() == ("wal",)
+    cache.close()
+
+
+def test_deidentify_cache_evicts_undated_rows(tmp_path):
+    """Rows of a store written before rows were dated are evicted when it is opened"""
+    cache_path = str(tmp_path / "cache.sqlite")
+    db = sqlite3.connect(cache_path)
+    db.execute("CREATE TABLE dlp_cache (key TEXT PRIMARY KEY, value TEXT)")
+    db.execute("INSERT INTO dlp_cache VALUES (?, ?)", (DeidentifyCache.make_key("hi"), "HI"))
+    db.commit()
+    db.close()
+    cache = DeidentifyCache(path=cache_path)
+    assert cache.get_many(["hi"]) == {}
+    cache.put_many({"hi": "HI"})
+    assert DeidentifyCache(path=cache_path).get_many(["hi"]) == {"hi": "HI"}
+    cache.close()
+
+
+def test_deidentify_many_concurrent(monkeypatch):
+    """Concurrent batches keep their order and quota errors are retried"""
+    monkeypatch.setattr(deidentify_ada_data.time, "sleep", lambda seconds: None)
+    client = FakeDlpClient(num_quota_errors=2)
+    deidentifier = BatchDeidentifier("placeholder_project_name", client=client, max_batch_rows=3,
+                                     max_workers=4, requests_per_minute=None)
+    strings = [f"text {i}" for i in range(20)]
+    assert deidentifier.deidentify_many(strings) == [string.upper() for string in strings]
+    assert deidentifier.num_retries == 2
+    assert len(client.requests) == 7 + 2
+
+
+def test_deidentify_many_prefilter():
+    """Strings ruled out by the prefilter are returned unchanged without a DLP call"""
+    client = FakeDlpClient()
+    deidentifier = BatchDeidentifier("placeholder_project_name", client=client,
+                                     prefilter=PiiPrefilter(CONSERVATIVE))
+    assert deidentifier.deidentify_many(["yes", "1", "my name is bob"]) == ["yes", "1",
+                                                                            "MY NAME IS BOB"]
+    assert deidentifier.num_prefiltered == 2
+    assert len(client.requests) == 1
@@ -0,0 +1,89 @@
+from datetime import datetime
+from datetime import timedelta
+import itertools
+import os
+import sys
+
+import pytest
+
+file_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(1, f'{file_dir}/../orchestration/dag')
+from ada_client import AdaClient, fetch_windows, split_time_window
+from ada_stub_server import AdaStubServer
+from fetch_checkpoint import (PageCheckpoint, atomic_write, purge_stale_checkpoints,
+                              window_checkpoints)
+from rate_limiter import AdaptiveRateController
+
+START_TIME = datetime(2021, 7, 26)
+END_TIME = datetime(2021, 7, 27) - timedelta(microseconds=1)
+MESSAGES_URI = ("/data_api/v1/messages?created_since=2021-07-26T00%3A00%3A00.000000"
+                "&created_to=2021-07-26T23%3A59%3A59.999999")
+
+
+def test_resume_after_failure(tmp_path):
+    """A rerun replays the saved pages and only fetches the pages after them"""
+    with AdaStubServer(page_size=5) as server:
+        client = AdaClient(server.url, "placeholder_key",
+                           rate_controller=AdaptiveRateController(100))
+        checkpoint = PageCheckpoint(str(tmp_path), "messages", START_TIME, END_TIME)
+        # The first attempt dies after three pages.
+        first_attempt = list(itertools.islice(client.iter_pages(MESSAGES_URI, checkpoint), 3))
+        assert server.num_requests == 3
+
+        checkpoint = PageCheckpoint(str(tmp_path), "messages", START_TIME, END_TIME)
+        pages = list(client.iter_pages(MESSAGES_URI, checkpoint))
+        assert server.num_requests == 5
+        assert pages[:3] == first_attempt
+        assert [len(page) for page in pages] == [5, 5, 5, 5, 3]
+
+        # A complete checkpoint needs no requests at all.
+        checkpoint = PageCheckpoint(str(tmp_path), "messages", START_TIME, END_TIME)
+        assert checkpoint.is_complete
+        assert list(client.iter_pages(MESSAGES_URI, checkpoint)) == pages
+        assert server.num_requests == 5
+        client.close()
+    checkpoint.clear()
+    assert not os.path.exists(checkpoint.path)
+
+
+def test_fetch_windows_with_checkpoints(tmp_path):
+    """Each sub-window is checkpointed separately and resumes to the same records"""
+    windows = split_time_window(START_TIME, END_TIME, 4)
+    with AdaStubServer(page_size=3) as server:
+        clients = [AdaClient(server.url, "placeholder_key",
+                             rate_controller=AdaptiveRateController(100))]
+        records = list(fetch_windows(clients, "messages", START_TIME, END_TIME, 4,
+                                     window_checkpoints(str(tmp_path), "messages", windows)))
+        num_requests = server.num_requests
+        resumed = list(fetch_windows(clients, "messages", START_TIME, END_TIME, 4,
+                                     window_checkpoints(str(tmp_path), "messages", windows)))
+        assert server.num_requests == num_requests
+    assert sorted(map(str, resumed)) == sorted(map(str, records))
+    assert len(os.listdir(tmp_path / "messages")) == 4
+    assert window_checkpoints(None, "messages", windows) == [None] * 4
+
+
+def test_atomic_write_leaves_no_partial_file(tmp_path):
+    """A failed write keeps the previous file and leaves no temp file behind"""
+    path = str(tmp_path / "state.json")
+    atomic_write(path, b"old")
+    with pytest.raises(TypeError):
+        atomic_write(path, None)
+    with open(path, "rb") as f:
+        assert f.read() == b"old"
+    assert os.listdir(tmp_path) == ["state.json"]
+
+
+def test_purge_stale_checkpoints(tmp_path):
+    """Checkpoints without a page saved for longer than the max age are deleted"""
+    stale = PageCheckpoint(str(tmp_path), "messages", START_TIME, END_TIME)
+    stale.save_page([{"_id": "a"}], "next")
+    fresh = PageCheckpoint(str(tmp_path), "conversations", START_TIME, END_TIME)
+    fresh.save_page([{"_id": "b"}], "next")
+    week_ago = os.path.getmtime(stale.path) - 7 * 86400
+    for path in [stale.path] + [os.path.join(stale.path, name) for name in os.listdir(stale.path)]:
+        os.utime(path, (week_ago, week_ago))
+    assert purge_stale_checkpoints(str(tmp_path), max_age_days=3) == 1
+    assert not os.path.exists(stale.path)
+    assert os.path.exists(fresh.path)
+    assert purge_stale_checkpoints(str(tmp_path / "missing")) == 0
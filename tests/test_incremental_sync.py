@@ -0,0 +1,85 @@
+from datetime import date
+from datetime import datetime
+import gzip
+import json
+import os
+import sys
+
+file_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(1, f'{file_dir}/../orchestration/dag')
+from ada_client import AdaClient
+from ada_stub_server import AdaStubServer
+from incremental_sync import SyncState, merge_query, run_incremental_sync
+from rate_limiter import AdaptiveRateController
+from schema_parsers import read_schema_fields
+from test_bq_loader import FakeBqClient, Object
+
+CONF = {"bq_project": "project", "dataset": "dataset", "load_format": "json"}
+
+
+# Adds query jobs to the fake client, recording the statement and its parameters.
+class FakeQueryBqClient(FakeBqClient):
+    def __init__(self):
+        super().__init__()
+        self.queries = []
+
+    def query(self, query, job_config):
+        self.queries.append((query, {param.name: param.value
+                                     for param in job_config.query_parameters}))
+        job = Object()
+        job.result = lambda: None
+        job.num_dml_affected_rows = 0
+        job.total_bytes_billed = 0
+        return job
+
+
+def test_merge_query_ingestion_time():
+    """New rows go into the partition of their date_created and the target scan is pruned"""
+    query = merge_query("p.d.messages", "p.d.messages_staging", "messages",
+                        read_schema_fields("messages"))
+    assert "MERGE `p.d.messages` T" in query
+    assert "ON T.message_id = S.message_id AND DATE(T._PARTITIONTIME) >= @since_date" in query
+    assert "INSERT (_PARTITIONTIME, message_id, date_created," in query
+    assert "VALUES (TIMESTAMP_TRUNC(S.date_created, DAY), S.message_id," in query
+    # The key is matched on, never updated.
+    assert "    message_id = S.message_id" not in query
+    assert "PARTITION BY message_id" in query
+
+
+def test_merge_query_partition_column():
+    query = merge_query("p.d.conversations", "p.d.conversations_staging", "conversations",
+                        read_schema_fields("conversations"), partition_field="date_created")
+    assert "AND DATE(T.date_created) >= @since_date" in query
+    assert "_PARTITIONTIME" not in query
+    assert "ORDER BY date_updated DESC" in query
+
+
+def test_sync_state(tmp_path):
+    state = SyncState(str(tmp_path))
+    assert state.get("messages") is None
+    state.set("messages", datetime(2021, 7, 26, 12, 30))
+    assert SyncState(str(tmp_path)).get("messages") == datetime(2021, 7, 26, 12, 30)
+
+
+def test_run_incremental_sync(tmp_path):
+    """Each run stages only the rows since the mark and merges them"""
+    with open(f'{file_dir}/inputs/response_messages.json') as f:
+        created = sorted(record["date_created"][:26] for record in json.load(f))
+    noon, evening = datetime(2021, 7, 26, 12), datetime(2021, 7, 26, 23)
+    state = SyncState(str(tmp_path))
+    bq_client = FakeQueryBqClient()
+    with AdaStubServer(page_size=5) as server:
+        client = AdaClient(server.url, "placeholder_key",
+                           rate_controller=AdaptiveRateController(100))
+        first = run_incremental_sync("messages", client, bq_client, CONF, state, now=noon)
+        second = run_incremental_sync("messages", client, bq_client, CONF, state, now=evening)
+    assert first == sum(t <= "2021-07-26T12:00:00.000000" for t in created)
+    assert second == sum("2021-07-26T11:00:00.000000" <= t <= "2021-07-26T23:00:00.000000"
+                         for t in created)
+    assert state.get("messages") == evening
+    # Staging is always loaded with the table's schema, whatever the configured format.
+    staging_table_id = "project.dataset.messages_staging"
+    assert [table_id for _, table_id, _ in bq_client.loads] == [staging_table_id] * 2
+    staged = [json.loads(line) for line in gzip.decompress(bq_client.loads[1][0]).splitlines()]
+    assert len(staged) == second
+    assert [params for _, params in bq_client.queries][-1] == {"since_date": date(2021, 7, 26)}
@@ -0,0 +1,48 @@
+import json
+import sys
+import os
+
+import pytest
+
+file_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(1, f'{file_dir}/../orchestration/dag')
+import json_codec
+from json_codec import dumps, loads, obj_encoder
+from parse_ada_data import parse_api_data
+from parse_ada_data_arrow import parse_api_data_arrow
+
+
+@pytest.fixture(params=["orjson", "stdlib"])
+def codec(request, monkeypatch):
+    if request.param == "stdlib":
+        monkeypatch.setattr(json_codec, "orjson", None)
+    elif json_codec.orjson is None:
+        pytest.skip("orjson is not installed")
+
+
+def test_loads(codec):
+    """Pages decode the same from bytes or str, with or without orjson"""
+    assert loads(b'{"data": [{"body": "caf\\u00e9"}]}') == {"data": [{"body": "café"}]}
+    assert loads('{"next_page_uri": null}') == {"next_page_uri": None}
+
+
+def test_dumps(codec):
+    """Records encode as compact JSON that keeps non-ASCII characters"""
+    assert dumps({"body": "café", "ok": True, "n": None}) == '{"body":"café","ok":true,"n":null}'
+
+
+def test_obj_encoder():
+    assert obj_encoder("repr")({"a": True}) == "{'a': True}"
+    assert obj_encoder("json")({"a": True}) == '{"a":true}'
+    with pytest.raises(ValueError):
+        obj_encoder("pickle")
+
+
+@pytest.mark.parametrize("parser", [parse_api_data, parse_api_data_arrow])
+def test_parse_obj_format_json(parser):
+    """With the json obj format, message_obj is valid JSON of the raw API record"""
+    with open(f'{file_dir}/inputs/response_messages.json') as f:
+        input_data = json.load(f)
+    bot_messages = [message for message in input_data if message["sender"] in ("bot", "ada")]
+    parsed = parser(bot_messages, "messages", "placeholder_project_name", obj_format="json")
+    assert [json.loads(record["message_obj"]) for record in parsed] == bot_messages
@@ -0,0 +1,59 @@
+from datetime import datetime
+import json
+import os
+import sys
+
+file_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(1, f'{file_dir}/../orchestration/dag')
+from page_archive import PageArchive, parse_day
+from replay_archive import replay_archive
+from test_bq_loader import FakeBqClient
+
+DAY = datetime(2021, 7, 26)
+
+
+def get_pages(page_size=4):
+    with open(f'{file_dir}/inputs/response_messages.json') as f:
+        input_data = json.load(f)
+    return [input_data[i:i + page_size] for i in range(0, len(input_data), page_size)]
+
+
+def num_objects(archive_dir):
+    return sum(len(files) for _, _, files in os.walk(os.path.join(archive_dir, "objects")))
+
+
+def test_archive_round_trip(tmp_path):
+    """Pages pass through unchanged and replay in order once the day is complete"""
+    archive = PageArchive(str(tmp_path))
+    pages = get_pages()
+    passed = archive.archive_pages(iter(pages), "messages", DAY)
+    next(passed)
+    # A partially fetched day is not listed.
+    assert not archive.has_day("messages", DAY)
+    assert [pages[0]] + list(passed) == pages
+    assert archive.has_day("messages", DAY)
+    assert list(archive.iter_pages("messages", DAY)) == pages
+
+
+def test_archive_is_content_addressed(tmp_path):
+    """Archiving the same pages again stores no new objects"""
+    archive = PageArchive(str(tmp_path))
+    list(archive.archive_pages(get_pages(), "messages", DAY))
+    num_stored = num_objects(str(tmp_path))
+    list(archive.archive_pages(get_pages(), "messages", datetime(2021, 7, 27)))
+    assert num_objects(str(tmp_path)) == num_stored == len(get_pages())
+
+
+def test_replay_archive(tmp_path):
+    """Archived days are parsed and loaded into their partitions without the API"""
+    archive = PageArchive(str(tmp_path))
+    list(archive.archive_pages(get_pages(), "messages", DAY))
+    client = FakeBqClient()
+    conf = {"bq_project": "project", "dataset": "dataset", "load_format": "json"}
+    num_rows = replay_archive(archive, ["messages"], parse_day("2021-07-25"),
+                              parse_day("2021-07-27"), client, conf)
+    with open(f'{file_dir}/outputs/response_messages.json') as f:
+        output_data = json.load(f)
+    assert num_rows == {"messages": len(output_data)}
+    assert [records for records, _, _ in client.loads] == [output_data]
+    assert [table_id for _, table_id, _ in client.copies] == ["project.dataset.messages$20210726"]
@@ -0,0 +1,122 @@
+from functools import partial
+import json
+import sys
+import os
+
+import pytest
+
+file_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(1, f'{file_dir}/../orchestration/dag')
+import parallel_parse
+from deidentify_ada_data import BatchDeidentifier
+from parallel_parse import parse_api_data_parallel
+from parse_ada_data import parse_api_data
+from parse_ada_data_arrow import parse_api_data_arrow
+from pii_prefilter import CONSERVATIVE, PiiPrefilter
+from schema_parsers import SlottedRecord
+from test_deidentify import FakeDlpClient
+
+
+def get_pages(file_name, page_size=4):
+    with open(f'{file_dir}/inputs/{file_name}') as f:
+        input_data = json.load(f)
+    return [input_data[i:i + page_size] for i in range(0, len(input_data), page_size)]
+
+
+def test_serial_parse_regroups_pages_into_chunks():
+    """Parsing pages in chunks gives the same records as parsing them all at once"""
+    pages = (page for page in get_pages("response_messages.json"))
+    chunks = list(parse_api_data_parallel(pages, "messages", "placeholder_project_name",
+                                          chunk_size=5))
+    assert [len(chunk) for chunk in chunks] == [5, 5, 5, 5, 3]
+    with open(f'{file_dir}/outputs/response_messages.json') as f:
+        assert [record for chunk in chunks for record in chunk] == json.load(f)
+
+
+@pytest.mark.parametrize("data_type", ["messages", "conversations"])
+def test_parallel_matches_serial(data_type):
+    """Worker processes give the same de-identified records, in order, as serial parsing"""
+    pages = get_pages(f"response_{data_type}.json")
+    serial_client = FakeDlpClient()
+    serial = parse_api_data([record for page in pages for record in page], data_type,
+                            "placeholder_project_name",
+                            BatchDeidentifier("placeholder_project_name", client=serial_client))
+    client = FakeDlpClient()
+    chunks = list(parse_api_data_parallel(
+        iter(pages), data_type, "placeholder_project_name",
+        BatchDeidentifier("placeholder_project_name", client=client), chunk_size=2,
+        max_workers=2))
+    assert all(len(chunk) <= 2 for chunk in chunks)
+    assert [record for chunk in chunks for record in chunk] == serial
+    # The workers never see the parent's client, so any DLP call was made by the parent.
+    assert bool(client.requests) == bool(serial_client.requests)
+
+
+@pytest.mark.parametrize("data_type", ["messages", "conversations"])
+def test_parallel_slotted_records_match_dicts(data_type):
+    """Slotted records parsed by the workers equal the dicts, DLP results included"""
+    pages = get_pages(f"response_{data_type}.json")
+    serial = parse_api_data([record for page in pages for record in page], data_type,
+                            "placeholder_project_name",
+                            BatchDeidentifier("placeholder_project_name", client=FakeDlpClient()))
+    chunks = list(parse_api_data_parallel(
+        iter(pages), data_type, "placeholder_project_name",
+        BatchDeidentifier("placeholder_project_name", client=FakeDlpClient()), chunk_size=2,
+        parser=partial(parse_api_data, record_format="slots"), max_workers=2))
+    records = [record for chunk in chunks for record in chunk]
+    assert all(isinstance(record, SlottedRecord) for record in records)
+    assert records == serial
+
+
+def test_parallel_allowlist_reaches_parent():
+    """Quick reply labels seen by a worker skip DLP in the parent"""
+    messages = [
+        {"_id": str(i), "date_created": "2021-07-26T08:54:03.409000+00:00",
+         "conversation_id": "c", "message_data": m_data, "sender": sender, "recipient": "r",
+         "review": 0, "answer_title": None}
+        for i, (m_data, sender) in enumerate([
+            ({"_type": "quick_replies", "quick_replies": [{"label": "Pick up my order"}]},
+             "bot"),
+            ({"_type": "text", "body": "Pick up my order"}, "user"),
+            ({"_type": "text", "body": "my name is bob"}, "user"),
+        ])
+    ]
+    client = FakeDlpClient()
+    deidentifier = BatchDeidentifier("placeholder_project_name", client=client,
+                                     prefilter=PiiPrefilter(CONSERVATIVE))
+    chunks = list(parse_api_data_parallel([messages[:1], messages[1:]], "messages",
+                                          "placeholder_project_name", deidentifier,
+                                          chunk_size=1, max_workers=2))
+    bodies = [chunk[0]["text_data"]["body"] for chunk in chunks[1:]]
+    assert bodies == ["Pick up my order", "MY NAME IS BOB"]
+
+
+def test_small_day_is_parsed_serially(monkeypatch):
+    """A day that fits in one chunk never starts a process pool"""
+    def no_pool(*args, **kwargs):
+        raise AssertionError("A process pool was started.")
+    monkeypatch.setattr(parallel_parse, "_start_pool", no_pool)
+    pages = get_pages("response_messages.json")
+    chunks = list(parse_api_data_parallel(pages, "messages", "placeholder_project_name",
+                                          chunk_size=1000, max_workers=4))
+    with open(f'{file_dir}/outputs/response_messages.json') as f:
+        assert chunks == [json.load(f)]
+
+
+@pytest.mark.parametrize("parser", [parse_api_data, parse_api_data_arrow])
+def test_labels_with_variables_are_not_allowlisted(parser):
+    """A label of a quick reply with variables can hold customer data and still goes to DLP"""
+    messages = [
+        {"_id": str(i), "date_created": "2021-07-26T08:54:03.409000+00:00",
+         "conversation_id": "c", "message_data": m_data, "sender": sender, "recipient": "r",
+         "review": 0, "answer_title": None}
+        for i, (m_data, sender) in enumerate([
+            ({"_type": "quick_replies", "has_variables": True,
+              "quick_replies": [{"label": "Pick up my order"}]}, "bot"),
+            ({"_type": "text", "body": "Pick up my order"}, "user"),
+        ])
+    ]
+    deidentifier = BatchDeidentifier("placeholder_project_name", client=FakeDlpClient(),
+                                     prefilter=PiiPrefilter(CONSERVATIVE))
+    parsed = parser(messages, "messages", "placeholder_project_name", deidentifier)
+    assert parsed[1]["text_data"]["body"] == "PICK UP MY ORDER"
@@ -6,7 +6,10 @@ import pytest
 # import pytest
 file_dir = os.path.dirname(os.path.realpath(__file__))
 sys.path.insert(1, f'{file_dir}/../orchestration/dag')
+from deidentify_ada_data import BatchDeidentifier
+from parse_ada_data_arrow import parse_api_data_arrow
 from parse_ada_data import check_int, parse_conversation_variables, check_order_num, deidentify, parse_list_selection_data, parse_surfaceable_list_selection_data, parse_presence_data, parse_quick_replies_data, parse_api_data
+from test_deidentify import FakeDlpClient
 
 
 # This class is used to mock the output of the DlpServiceClient.deidentify_content in the test
@@ -114,6 +117,33 @@ def test_parse_api_data_conversations(mocker):
     assert parse_api_data(input_data, "conversations", "placeholder_project_name") == output_data
 
 
+def test_parse_api_data_arrow_messages():
+    """The arrow engine parses a full response from the messages API like parse_api_data"""
+    input_data, output_data = get_input_output_vars("response_messages.json")
+    parsed = parse_api_data_arrow(input_data, "messages", "placeholder_project_name")
+    assert parsed == output_data
+    # The fields come in schema order too, down to the `*_data` sub-records.
+    assert json.dumps(parsed) == json.dumps(parse_api_data(input_data, "messages",
+                                                           "placeholder_project_name"))
+    assert parse_api_data_arrow([], "messages", "placeholder_project_name") == []
+
+
+def test_parse_api_data_arrow_conversations():
+    """The arrow engine parses a full response from the conversations API like parse_api_data"""
+    input_data, output_data = get_input_output_vars("response_conversations.json")
+    # The fake DLP client upper-cases the question where the fixture expects "example_text".
+    output_data = json.loads(json.dumps(output_data).replace(
+        "example_text", "CAN I CALL AND CHANGE MY TIMESLOT"))
+
+    parsed = parse_api_data_arrow(input_data, "conversations", "placeholder_project_name",
+                                  BatchDeidentifier("placeholder_project_name",
+                                                    client=FakeDlpClient()))
+    assert parsed == output_data
+    assert json.dumps(parsed) == json.dumps(parse_api_data(
+        input_data, "conversations", "placeholder_project_name",
+        BatchDeidentifier("placeholder_project_name", client=FakeDlpClient())))
+
+
 def test_exception_thrown():
     with pytest.raises(Exception) as e_info:
         parse_api_data([], "Incorrect API type input", "placeholder_project_name")
@@ -0,0 +1,51 @@
+import sys
+import os
+import json
+
+file_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(1, f'{file_dir}/../orchestration/dag')
+from pii_prefilter import AGGRESSIVE, CONSERVATIVE, PiiPrefilter, measure_false_negatives
+
+
+def get_labelled_sample():
+    with open(f'{file_dir}/inputs/pii_prefilter_sample.json') as f:
+        return json.load(f)
+
+
+def test_conservative_has_no_false_negatives():
+    """The conservative prefilter never skips a labelled string with PII"""
+    result = measure_false_negatives(PiiPrefilter(CONSERVATIVE), get_labelled_sample())
+    assert result["false_negatives"] == []
+    assert result["skip_rate"] > 0.2
+
+
+def test_aggressive_false_negative_rate():
+    """The aggressive prefilter skips more strings and misses few labelled PII strings"""
+    sample = get_labelled_sample()
+    conservative = measure_false_negatives(PiiPrefilter(CONSERVATIVE), sample)
+    aggressive = measure_false_negatives(PiiPrefilter(AGGRESSIVE), sample)
+    assert aggressive["false_negative_rate"] <= 0.1
+    assert aggressive["skip_rate"] > conservative["skip_rate"]
+
+
+def test_prefilter_allowlist():
+    """Quick reply labels added to the allowlist are skipped in both modes"""
+    label = "Change from Delivery order to Pick up"
+    for mode in (CONSERVATIVE, AGGRESSIVE):
+        prefilter = PiiPrefilter(mode)
+        assert prefilter.might_contain_pii(label)
+        prefilter.allow([label])
+        assert not prefilter.might_contain_pii("change from delivery order to pick up!")
+        assert not prefilter.might_contain_pii("yes")
+        assert not prefilter.might_contain_pii("1")
+        assert prefilter.might_contain_pii("416 555 0199")
+
+
+def test_prefilter_allowlist_skips_labels_with_pii():
+    """Labels that could hold customer data are not allowlisted, in either mode"""
+    for mode in (CONSERVATIVE, AGGRESSIVE):
+        prefilter = PiiPrefilter(mode)
+        prefilter.allow(["John Smith", "Yes, ship to 123 Main St", "Call 416 555 0199"])
+        assert prefilter.might_contain_pii("john smith")
+        assert prefilter.might_contain_pii("Yes, ship to 123 Main St")
+        assert prefilter.might_contain_pii("call 416 555 0199")
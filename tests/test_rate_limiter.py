@@ -0,0 +1,96 @@
+import sys
+import os
+
+import requests
+
+file_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(1, f'{file_dir}/../orchestration/dag')
+from ada_stub_server import AdaStubServer
+from rate_limiter import (AdaptiveRateController, TokenBucket, get_shared_bucket,
+                          rate_limit_reset_delay, retry_after_delay)
+
+
+# A clock that only moves when the bucket sleeps or the test advances it.
+class FakeClock():
+    def __init__(self):
+        self.now = 0.0
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+def test_token_bucket_spaces_requests():
+    """Requests are spaced by the rate and only wait for the remaining budget"""
+    clock = FakeClock()
+    bucket = TokenBucket(1, clock=clock.time, sleep=clock.sleep)
+    assert bucket.acquire() == 0
+    assert bucket.acquire() == 1
+    clock.now += 0.75  # the request itself took 0.75 seconds
+    assert bucket.acquire() == 0.25
+    clock.now += 5  # idle time does not build up a burst beyond the capacity
+    assert bucket.acquire() == 0
+    assert bucket.acquire() == 1
+
+
+def test_token_bucket_set_rate():
+    """A new rate applies to the next reservation"""
+    clock = FakeClock()
+    bucket = TokenBucket(1, clock=clock.time, sleep=clock.sleep)
+    bucket.acquire()
+    bucket.set_rate(0.5)
+    assert bucket.acquire() == 2
+
+
+def test_get_shared_bucket():
+    """Fetches using the same budget get the same bucket"""
+    assert get_shared_bucket("key-a", 1) is get_shared_bucket("key-a", 1)
+    assert get_shared_bucket("key-a", 1) is not get_shared_bucket("key-b", 1)
+
+
+def test_retry_after_delay():
+    """Retry-After is read as seconds or as an HTTP date"""
+    assert retry_after_delay({"Retry-After": "3"}) == 3
+    assert retry_after_delay({"Retry-After": "Wed, 21 Oct 2015 07:28:00 GMT"}) == 0
+    assert retry_after_delay({}) is None
+    assert rate_limit_reset_delay({"X-RateLimit-Remaining": "0", "X-RateLimit-Reset": "2"}) == 2
+    assert rate_limit_reset_delay({"RateLimit-Remaining": "4", "RateLimit-Reset": "2"}) is None
+
+
+def test_adaptive_rate_controller():
+    """Throttling halves the rate and pauses, successes probe back up to the maximum"""
+    clock = FakeClock()
+    controller = AdaptiveRateController(1, increase_step=0.25, clock=clock.time,
+                                        sleep=clock.sleep)
+    controller.acquire()
+    controller.on_throttle({"Retry-After": "10"})
+    assert controller.rate == 0.5
+    assert controller.throttle_events == 1
+    controller.acquire()
+    assert clock.now >= 10
+    controller.on_success({})
+    controller.on_success({})
+    assert controller.rate == 1
+
+
+def test_adaptive_rate_controller_against_stub_server():
+    """The controller fetches every page from a server that throttles it"""
+    controller = AdaptiveRateController(50, increase_step=1)
+    uri = ("/data_api/v1/messages?created_since=2021-07-26T00%3A00%3A00.000000"
+           "&created_to=2021-07-26T23%3A59%3A59.999999")
+    records = []
+    with AdaStubServer(page_size=4, latency=0.01, min_interval=0.05, throttle_every=5,
+                       retry_after="0") as server:
+        with requests.Session() as http:
+            while uri:
+                response = controller.call(lambda: http.get(server.url + uri, timeout=5))
+                assert response.status_code == 200
+                payload = response.json()
+                records.extend(payload["data"])
+                uri = payload["next_page_uri"]
+    assert len(records) == 23
+    assert server.num_throttled > 0
+    assert controller.throttle_events == server.num_throttled
+    assert controller.rate < 50
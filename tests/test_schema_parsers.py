@@ -0,0 +1,100 @@
+import json
+import pickle
+import shutil
+import subprocess
+import sys
+import os
+
+import pytest
+
+file_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(1, f'{file_dir}/../orchestration/dag')
+from json_codec import dumps
+from parse_ada_data import MESSAGE_DATA_PARSERS, MESSAGE_FIELDS, parse_message
+from schema_parsers import compile_record_parser, compile_record_type, read_schema_fields
+
+RECORD_FIELDS = [{"name": "a", "type": "STRING"},
+                 {"name": "sub", "type": "RECORD", "fields": [{"name": "b", "type": "INTEGER"}]}]
+Row = compile_record_type("TestRow", RECORD_FIELDS)
+
+
+def test_compile_record_parser():
+    """Compiled parsers copy every schema field in order and run the extractors"""
+    fields = [{"name": "a", "type": "STRING"}, {"name": "b", "type": "INTEGER"}]
+    parser = compile_record_parser(fields, {"b": lambda data: len(data["raw"])})
+    parsed = parser({"a": "x", "raw": "four", "ignored": 1})
+    assert parsed == {"a": "x", "b": 4}
+    assert list(parsed) == ["a", "b"]
+
+
+def test_compile_record_parser_unknown_extractor():
+    """An extractor for a field missing from the schema is rejected"""
+    with pytest.raises(KeyError):
+        compile_record_parser([{"name": "a", "type": "STRING"}], {"b": str})
+
+
+def test_message_data_parsers_cover_schema():
+    """Every `<_type>_data` record of the schema has a sub-parser"""
+    data_fields = [field["name"] for field in read_schema_fields("messages")
+                   if field["type"] == "RECORD"]
+    assert sorted(field for field, _ in MESSAGE_DATA_PARSERS.values()) == sorted(data_fields)
+
+
+@pytest.mark.parametrize("message_type", sorted(MESSAGE_DATA_PARSERS))
+def test_parse_message_matches_schema(message_type):
+    """Parsed messages have exactly the fields of the schema and only their own sub-record"""
+    message = {"_id": "1", "date_created": "2021-07-26T00:00:00+00:00", "conversation_id": "2",
+               "message_data": {"_type": message_type, "body": "hi"}, "sender": "bot",
+               "recipient": "3", "review": 0, "answer_title": None}
+    parsed = parse_message(message, "placeholder_project_name")
+    assert list(parsed) == [field["name"] for field in MESSAGE_FIELDS]
+    data_field = MESSAGE_DATA_PARSERS[message_type][0]
+    sub_fields = next(field["fields"] for field in MESSAGE_FIELDS
+                      if field["name"] == data_field)
+    assert list(parsed[data_field]) == [field["name"] for field in sub_fields]
+    assert [field for field, _ in MESSAGE_DATA_PARSERS.values()
+            if parsed[field] is not None] == [data_field]
+
+
+def test_compile_record_type():
+    """Slotted records read and write like dicts of their schema fields"""
+    row = Row("x", Row._field_types["sub"](b=1))
+    assert not hasattr(row, "__dict__")
+    assert row["a"] == "x" and row.get("sub")["b"] == 1 and row.get("missing") is None
+    row["a"] = "y"
+    with pytest.raises(KeyError):
+        row["missing"] = 1
+    assert list(row.keys()) == ["a", "sub"]
+    assert row == {"a": "y", "sub": {"b": 1}}
+    assert row._asdict() == {"a": "y", "sub": {"b": 1}}
+    assert json.loads(dumps([row])) == [{"a": "y", "sub": {"b": 1}}]
+
+
+def test_slotted_records_pickle_by_identity():
+    """Pickled records are rebuilt with their types, sharing sub-records like the originals"""
+    row = Row("x", Row._field_types["sub"](b=1))
+    copy, sub = pickle.loads(pickle.dumps((row, row.sub)))
+    assert type(copy) is Row and copy == row
+    assert copy.sub is sub
+
+
+def test_compile_record_parser_slotted():
+    """A parser compiled with a record type returns that type"""
+    parser = compile_record_parser(RECORD_FIELDS[1]["fields"], {"b": lambda data: data["c"] * 2},
+                                   Row._field_types["sub"])
+    parsed = parser({"c": 2})
+    assert type(parsed) is Row._field_types["sub"] and parsed == {"b": 4}
+
+
+def test_parsers_import_from_the_dags_folder_alone(tmp_path):
+    """Composer deploys only the dags folder, which holds everything the parsers read"""
+    dags_dir = tmp_path / "dags"
+    shutil.copytree(f'{file_dir}/../orchestration/dag', dags_dir,
+                    ignore=shutil.ignore_patterns("__pycache__"))
+    env = {key: value for key, value in os.environ.items() if key != "ADA_SCHEMA_DIR"}
+    script = "import parse_ada_data; print(parse_ada_data.MESSAGE_FIELDS[0]['name'])"
+    result = subprocess.run(
+        [sys.executable, "-c", script], cwd=str(dags_dir), env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        universal_newlines=True)
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.strip() == "message_id"